@@ -0,0 +1,151 @@
+# end-to-end benchmark of the fetchers against local stand-ins, no network needed:
+#   - SOCKS5 (CONNECT and UDP ASSOCIATE) as the tunnel, a DNS responder reached through it,
+#     and three hosts resolving to 127.0.0.1:
+#       migrating.bench  HTTP/3 origin that accepts migration, h11 origin advertising it with Alt-Svc
+#       refusing.bench   HTTP/3 origin that ignores migrated paths, h11 origin advertising it with Alt-Svc
+#       tunnel.bench     h11 origin only
+#   - fetch_snic.fetch against migrating.bench, fetch_proxy.fetch against tunnel.bench, and
+#     fetch_adaptive.fetch against every host (after warming up, so that verdicts and Alt-Svc are known)
+#   - for every object size and concurrency: requests per second, MB/s, p50 / p90 / p99 latency,
+#     and the offload, the share of the payload that did not go through the tunnel
+#
+#   python -m proxy.bench.bench_fetch [--engine process] [--sizes 1024,65536,1048576] [--concurrency 1,8,32] [--requests 64]
+
+import argparse
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from time import perf_counter, sleep
+from typing import Callable
+
+from proxy import fetch_adaptive, fetch_proxy, fetch_snic
+from proxy.bench import standins
+from proxy.config import conf
+from proxy.interface import Request, Response
+
+HOSTS = ('migrating.bench', 'refusing.bench', 'tunnel.bench')
+WARMUP_TIMEOUT = 10     # seconds to wait for the background SNIC checks of fetch_adaptive
+
+req_counter = count(1)
+
+Fetch = Callable[[Request, tuple[str, int]], Response]
+
+class Bench:
+    """ the stand-ins, and the base URL of every (fetcher, host) to measure """
+    def __init__(self):
+        workdir = tempfile.mkdtemp()
+        paths = standins.make_certs(workdir, list(HOSTS))
+        self.loop = standins.LoopThread()
+        self.socks5 = standins.Socks5Server()
+        self.loop.run(self.socks5.start())
+        self.dns = standins.DNSServer({host: ["127.0.0.1"] for host in HOSTS})
+        self.loop.run(self.dns.start())
+
+        origins = {}
+        for host, allow_migration in (('migrating.bench', True), ('refusing.bench', False)):
+            h3 = standins.H3Server(paths["cert"], paths["key"], allow_migration=allow_migration)
+            self.loop.run(h3.start())
+            h11 = standins.H11Origin(paths["cert"], paths["key"], alt_svc=f'h3=":{h3.port}"; ma=3600')
+            self.loop.run(h11.start())
+            origins[host] = (h3.port, h11.port)
+        tunnel_only = standins.H11Origin(paths["cert"], paths["key"])
+        self.loop.run(tunnel_only.start())
+
+        conf.ca_file = paths["ca_cert"]
+        conf.dns_server_addr, conf.dns_server_port = self.dns.host, self.dns.port
+        conf.dns_backend = 'udp'
+        conf.fetch_adaptive_verdict_db = os.path.join(workdir, "verdicts.sqlite3")
+        conf.fetch_adaptive_snic_timeout = 1
+        self.proxy_config = (self.socks5.host, self.socks5.port)
+
+        h3_port, _ = origins['migrating.bench']
+        self.targets: list[tuple[str, Fetch, str]] = [
+            ('fetch_snic', fetch_snic.fetch, f"https://migrating.bench:{h3_port}"),
+            ('fetch_proxy', fetch_proxy.fetch, f"https://tunnel.bench:{tunnel_only.port}"),
+        ]
+        for host in ('migrating.bench', 'refusing.bench'):
+            self.targets.append(('fetch_adaptive', fetch_adaptive.fetch, f"https://{host}:{origins[host][1]}"))
+        self.targets.append(('fetch_adaptive', fetch_adaptive.fetch, f"https://tunnel.bench:{tunnel_only.port}"))
+
+    def get(self, fetch: Fetch, url: str, size: int):
+        req = Request(method="GET", url=f"{url}/bytes/{size}", header={}, req_id=next(req_counter))
+        res = fetch(req, self.proxy_config)
+        assert res.status_code == 200 and res.body is not None and len(res.body) == size
+
+    def warm_up(self):
+        """ first requests of fetch_adaptive discover Alt-Svc and check SNIC in the background, measured ones should not """
+        for _, fetch, url in self.targets:
+            self.get(fetch, url, 1)
+        deadline = perf_counter() + WARMUP_TIMEOUT
+        while fetch_adaptive.verifying and perf_counter() < deadline:
+            sleep(0.1)
+        for _, fetch, url in self.targets:
+            self.get(fetch, url, 1)
+
+    def run(self, fetch: Fetch, url: str, size: int, concurrency: int, requests: int) -> dict[str, float]:
+        latencies: list[float] = []
+
+        def fetch_one(_):
+            start = perf_counter()
+            self.get(fetch, url, size)
+            latencies.append(perf_counter() - start)
+
+        tunneled = self.socks5.bytes_up + self.socks5.bytes_down
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(fetch_one, range(requests)))
+        elapsed = perf_counter() - start
+        tunneled = self.socks5.bytes_up + self.socks5.bytes_down - tunneled
+
+        latencies.sort()
+        payload = size * requests
+        return {
+            'rps': requests / elapsed,
+            'mbps': payload / elapsed / 2**20,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'tunneled': tunneled,
+            # TLS and QUIC overhead can make the tunnel carry more than the payload
+            'offload': max(0.0, 1 - tunneled / payload),
+        }
+
+def percentile(values: list[float], q: float) -> float:
+    """ q-th percentile of sorted values """
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_fetch')
+    parser.add_argument('--engine', default='process', choices=['process', 'asyncio'])
+    parser.add_argument('--sizes', type=int_list, default=[1024, 64 * 1024, 1024 * 1024])
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--fetchers', default='fetch_snic,fetch_proxy,fetch_adaptive')
+    args = parser.parse_args()
+
+    conf.snic_engine = args.engine
+    bench = Bench()
+    bench.warm_up()
+    print(f"engine: {args.engine}, {args.requests} requests per run")
+
+    fetchers = args.fetchers.split(',')
+    for name, fetch, url in bench.targets:
+        if name not in fetchers:
+            continue
+        host = url.split('//')[1].split(':')[0]
+        for size in args.sizes:
+            for concurrency in args.concurrency:
+                result = bench.run(fetch, url, size, concurrency, args.requests)
+                print(
+                    f"{name:>14} {host:<16} {size >> 10:>5} KB x{concurrency:<3}: "
+                    f"{result['rps']:7.0f} req/s, {result['mbps']:7.1f} MB/s, "
+                    f"p50 {result['p50'] * 1000:7.1f} ms, p90 {result['p90'] * 1000:7.1f} ms, p99 {result['p99'] * 1000:7.1f} ms, "
+                    f"tunnel {result['tunneled'] / 2**20:7.2f} MB, offload {result['offload'] * 100:3.0f}%"
+                )
+
+if __name__ == "__main__":
+    main()
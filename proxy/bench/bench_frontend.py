@@ -0,0 +1,102 @@
+# benchmark of the proxy front ends (frontend = "thread" vs "asyncio"):
+#   - fetch() is replaced by a stub returning a fixed response, so only client handling is measured
+#   - N keep-alive clients send plain HTTP proxy requests for a fixed duration
+#   - reports requests per second and p50 / p99 latency
+#
+#   python -m proxy.bench.bench_frontend [--clients 64] [--duration 5] [--size 1024]
+
+import argparse
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+from time import perf_counter
+
+from proxy.bench import standins
+from proxy.config import conf
+from proxy.interface import Request, Response
+import proxy.proxy as snic_proxy
+
+def stub_fetch(size: int):
+    body = b"x" * size
+    def fetch(req: Request, proxy_config: tuple[str, int]) -> Response:
+        return Response(status_code=200, url=req.url, headers={b'Content-Type': b'text/plain'}, req_id=req.req_id, body=body)
+    return fetch
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((conf.host, 0))
+        return sock.getsockname()[1]
+
+def start_frontend(frontend: str):
+    conf.port = free_port()
+    if frontend == 'asyncio':
+        server = snic_proxy.AsyncProxyServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server = snic_proxy.ProxyServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+REQUEST = b"GET http://origin.bench/ HTTP/1.1\r\nHost: origin.bench\r\nAccept: */*\r\n\r\n"
+
+async def roundtrip(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    writer.write(REQUEST)
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = next(
+        int(line.split(b":", 1)[1]) for line in head.split(b"\r\n")
+        if line.lower().startswith(b"content-length:")
+    )
+    await reader.readexactly(length)
+
+async def client(port: int, deadline: float, latencies: list[float]):
+    reader, writer = await asyncio.open_connection(conf.host, port)
+    while perf_counter() < deadline:
+        start = perf_counter()
+        await roundtrip(reader, writer)
+        latencies.append(perf_counter() - start)
+    writer.close()
+
+async def run_clients(port: int, clients: int, duration: float) -> list[float]:
+    # wait for the server to answer
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection(conf.host, port)
+            await roundtrip(reader, writer)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    latencies: list[float] = []
+    deadline = perf_counter() + duration
+    await asyncio.gather(*(client(port, deadline, latencies) for _ in range(clients)))
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_frontend')
+    parser.add_argument('--frontend', default='both', choices=['both', 'thread', 'asyncio'])
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    paths = standins.make_certs(workdir, ["origin.bench"])
+    conf.cert_file, conf.key_file = paths["ca_cert"], paths["ca_key"]
+    conf.cert_dir = os.path.join(workdir, "certs")
+    snic_proxy.fetch = stub_fetch(args.size)
+
+    frontends = ['thread', 'asyncio'] if args.frontend == 'both' else [args.frontend]
+    for frontend in frontends:
+        start_frontend(frontend)
+        latencies = sorted(asyncio.run(run_clients(conf.port, args.clients, args.duration)))
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"{frontend:>8}: {len(latencies) / args.duration:.0f} req/s, "
+            f"p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms "
+            f"({args.clients} clients, {args.size} byte responses)"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# benchmark of the SNIC QUIC loop against local stand-ins:
+#   - idle: CPU time burnt by a connected, migrated connection doing nothing
+#   - throughput: MB/s and CPU time of concurrent downloads over one connection
+#
+# CPU time is that of the quic_loop process (snic_engine = "process") or of the
+# quic-engine thread (snic_engine = "asyncio"), read from /proc.
+#
+#   python -m proxy.bench.bench_quic_loop [--engine process|asyncio]
+
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from time import time, sleep
+
+from proxy.bench import standins
+from proxy.config import conf
+from proxy.fetch_snic import new_connection
+from proxy.interface import Request
+
+req_counter = count(1)
+
+def cpu_seconds(conn) -> float:
+    """ user + system CPU time of whatever runs the connection's QUIC loop """
+    if conn.__class__.__name__ == 'SNICConnection':
+        path = f"/proc/{conn.proc.pid}/stat"
+    else:
+        engine_thread = next(t for t in threading.enumerate() if t.name == 'quic-engine')
+        path = f"/proc/self/task/{engine_thread.native_id}/stat"
+    with open(path) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def bench_idle(conn, seconds: float):
+    start = cpu_seconds(conn)
+    sleep(seconds)
+    used = cpu_seconds(conn) - start
+    print(f"idle: {used:.2f} s CPU over {seconds:.0f} s ({100 * used / seconds:.0f}% of a core)")
+
+def bench_throughput(conn, url: str, size: int, requests: int, concurrency: int):
+    def fetch_one(_):
+        req = Request(method="GET", url=f"{url}/bytes/{size}", header={}, req_id=next(req_counter))
+        res = asyncio.run(conn.fetch(req))
+        assert res is not None and len(res.body) == size
+
+    start_cpu = cpu_seconds(conn)
+    start = time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(fetch_one, range(requests)))
+    elapsed = time() - start
+    used = cpu_seconds(conn) - start_cpu
+    total = size * requests
+    print(
+        f"throughput: {requests} x {size >> 10} KB, concurrency {concurrency}: "
+        f"{total / elapsed / 2**20:.1f} MB/s, {requests / elapsed:.0f} req/s, "
+        f"{used:.2f} s CPU ({used / (total / 2**20):.3f} s/MB)"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench_quic_loop')
+    parser.add_argument('--engine', default='process', choices=['process', 'asyncio'])
+    parser.add_argument('--idle', type=float, default=5)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    paths = standins.make_certs(tempfile.mkdtemp(), ["localhost"])
+    loop = standins.LoopThread()
+    socks5 = standins.Socks5Server()
+    loop.run(socks5.start())
+    origin = standins.H3Server(paths["cert"], paths["key"])
+    loop.run(origin.start())
+
+    conf.ca_file = paths["ca_cert"]
+    conf.snic_engine = args.engine
+    conn = new_connection("localhost", ("127.0.0.1", origin.port), ("127.0.0.1", socks5.port))
+    assert asyncio.run(conn.connect(5)) and asyncio.run(conn.check_migration(5))
+    print(f"engine: {args.engine}")
+
+    bench_idle(conn, args.idle)
+    bench_throughput(conn, f"https://localhost:{origin.port}", args.size, args.requests, args.concurrency)
+    asyncio.run(conn.close())
+    loop.run(origin.stop())
+    loop.run(socks5.stop())
+    loop.stop()
+
+if __name__ == "__main__":
+    main()
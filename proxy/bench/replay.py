@@ -0,0 +1,262 @@
+# replay of recorded traffic against a running SNIC proxy:
+#   - reads the requests of a trace file (see proxy/tracing.py) or of a HAR exported by a browser;
+#     requests with other methods than SAFE_METHODS would change state on the server again, so they are skipped
+#     unless --unsafe is given (requests of a trace file are then sent with a made-up body of the recorded size,
+#     traces keep no bodies)
+#   - sends them through the proxy as a browser would (absolute-form for http, CONNECT and TLS for https,
+#     keep-alive connections per origin), at their recorded times, --speed times faster, or with --speed 0
+#     as fast as --concurrency allows
+#   - reports latency percentiles per host, and, from the traces the proxy writes meanwhile (trace_file),
+#     how many requests went through the tunnel, how many of them fell back after SNIC failed,
+#     and the bytes through the tunnel vs directly
+#
+#   python -m proxy.bench.replay page.har --config demo_config.toml [--speed 1] [--concurrency 64]
+
+import argparse
+import http.client
+import json
+import os
+import ssl
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Optional
+from urllib.parse import urlsplit
+
+from proxy import config
+from proxy.config import conf
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS', 'TRACE'}
+TRACE_SETTLE = 1        # seconds for the trace writer of the proxy to write the last traces
+SKIPPED_HEADERS = {'host', 'connection', 'keep-alive', 'proxy-connection', 'content-length', 'transfer-encoding', 'te', 'upgrade'}
+
+@dataclass
+class Entry:
+    offset: float       # seconds since the first request
+    method: str
+    url: str
+    headers: list[tuple[str, str]]
+    body: Optional[bytes]
+
+@dataclass
+class Result:
+    host: str
+    seconds: float
+    received: int
+    error: Optional[str] = None
+
+def load_trace(lines: list[str], unsafe: bool = False) -> tuple[list[tuple[float, Entry]], int]:
+    """
+    (start, entry) of every request of a trace file, and how many were skipped for their method;
+    with unsafe they are kept, with bodies made up (traces only keep their size)
+    """
+    entries = []
+    skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        trace = json.loads(line)
+        if 'url' not in trace:
+            continue
+        method = trace.get('method', 'GET')
+        if method not in SAFE_METHODS and not unsafe:
+            skipped += 1
+            continue
+        sent = sum(counts['sent'] for counts in trace.get('bytes', {}).values())
+        body = b'x' * sent if sent else None
+        entries.append((trace['start'], Entry(0, method, trace['url'], [], body)))
+    return entries, skipped
+
+def load_har(har: dict, unsafe: bool = False) -> tuple[list[tuple[float, Entry]], int]:
+    """ (start, entry) of every request of a HAR, and how many were skipped for their method unless unsafe """
+    entries = []
+    skipped = 0
+    for har_entry in har['log']['entries']:
+        request = har_entry['request']
+        if request['method'] not in SAFE_METHODS and not unsafe:
+            skipped += 1
+            continue
+        headers = [
+            (header['name'], header['value']) for header in request.get('headers', [])
+            if not header['name'].startswith(':') and header['name'].lower() not in SKIPPED_HEADERS
+        ]
+        text = request.get('postData', {}).get('text')
+        start = datetime.fromisoformat(har_entry['startedDateTime']).timestamp()
+        entries.append((start, Entry(0, request['method'], request['url'], headers, None if text is None else text.encode())))
+    return entries, skipped
+
+def load(path: str, unsafe: bool = False) -> tuple[list[Entry], int]:
+    """ requests of a trace file or a HAR in the order they were sent, and how many were skipped for their method """
+    with open(path) as f:
+        text = f.read()
+    try:
+        document = json.loads(text)
+    except json.JSONDecodeError:
+        document = None     # JSON lines
+    if isinstance(document, dict) and 'log' in document:
+        entries, skipped = load_har(document, unsafe)
+    else:
+        entries, skipped = load_trace(text.splitlines(), unsafe)
+    entries.sort(key=lambda entry: entry[0])
+    first = entries[0][0] if entries else 0
+    for start, entry in entries:
+        entry.offset = start - first
+    return [entry for _, entry in entries], skipped
+
+class Client:
+    """ keep-alive connections through the proxy, idle ones kept per origin """
+    def __init__(self, proxy: tuple[str, int], context: ssl.SSLContext, timeout: float):
+        self.proxy = proxy
+        self.context = context
+        self.timeout = timeout
+        self.idle: dict[tuple[str, str, int], list[http.client.HTTPConnection]] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _connection(self, origin: tuple[str, str, int]) -> http.client.HTTPConnection:
+        with self.lock:
+            if self.idle[origin]:
+                return self.idle[origin].pop()
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(*self.proxy, timeout=self.timeout, context=self.context)
+            conn.set_tunnel(host, port)
+            return conn
+        return http.client.HTTPConnection(*self.proxy, timeout=self.timeout)
+
+    def send(self, entry: Entry) -> Result:
+        url = urlsplit(entry.url)
+        assert url.hostname is not None
+        origin = (url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+        # requests through a tunnel are in origin-form, the others in absolute-form
+        target = (url.path or '/') + (f"?{url.query}" if url.query else '') if url.scheme == 'https' else entry.url
+        conn = self._connection(origin)
+        start = perf_counter()
+        try:
+            conn.request(entry.method, target, body=entry.body, headers=dict(entry.headers))
+            res = conn.getresponse()
+            received = len(res.read())
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            return Result(url.hostname, perf_counter() - start, 0, repr(e))
+        if res.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                self.idle[origin].append(conn)
+        return Result(url.hostname, perf_counter() - start, received)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+def replay(entries: list[Entry], client: Client, speed: float, concurrency: int) -> list[Result]:
+    """ sends entries at offset / speed (all at once if speed is 0), concurrency at most at a time """
+    results: list[Result] = []
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = []
+        for entry in entries:
+            if speed > 0 and (delay := start + entry.offset / speed - perf_counter()) > 0:
+                sleep(delay)
+            futures.append(executor.submit(client.send, entry))
+        for future in futures:
+            results.append(future.result())
+    return results
+
+def percentile(values: list[float], q: float) -> float:
+    """ q-th percentile of sorted values """
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def read_traces(path: str, offset: int) -> list[dict]:
+    """ traces written to path after offset """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return [json.loads(line) for line in f.read().decode().splitlines() if line.strip()]
+    except OSError:
+        return []
+
+def report(results: list[Result], traces: Optional[list[dict]], elapsed: float):
+    by_host: dict[str, list[Result]] = defaultdict(list)
+    for result in results:
+        by_host[result.host].append(result)
+    paths: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    for trace in traces or []:
+        host = urlsplit(trace.get('url', '')).hostname or ''
+        counts = paths[host]
+        counts['traced'] += 1
+        counts[trace.get('path', 'failed')] += 1
+        counts['fallback'] += trace.get('reason') == 'snic_failed'
+        for path, sizes in trace.get('bytes', {}).items():
+            counts[f'{path}_bytes'] += sizes['sent'] + sizes['received']
+
+    errors = sum(result.error is not None for result in results)
+    print(f"{len(results)} requests in {elapsed:.1f} s, {errors} failed, {sum(result.received for result in results) / 2**20:.2f} MB received")
+    for host, host_results in sorted(by_host.items(), key=lambda item: -len(item[1])):
+        latencies = sorted(result.seconds for result in host_results if result.error is None)
+        line = f"{host:<40} {len(host_results):4} req"
+        if latencies:
+            line += (
+                f", p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, p90 {percentile(latencies, 0.9) * 1000:7.1f} ms,"
+                f" p99 {percentile(latencies, 0.99) * 1000:7.1f} ms"
+            )
+        if failed := len(host_results) - len(latencies):
+            line += f", {failed} failed"
+        if traces is not None and (counts := paths.get(host)):
+            line += (
+                f" | tunnel {100 * counts['tunnel'] / counts['traced']:3.0f}%"
+                f" (fallback {100 * counts['fallback'] / counts['traced']:3.0f}%),"
+                f" {counts['tunnel_bytes'] / 2**10:.0f} KB tunnel, {counts['snic_bytes'] / 2**10:.0f} KB direct"
+            )
+        print(line)
+    if traces is not None:
+        traced = sum(counts['traced'] for counts in paths.values())
+        tunnel = sum(counts['tunnel'] for counts in paths.values())
+        fallback = sum(counts['fallback'] for counts in paths.values())
+        tunnel_bytes = sum(counts['tunnel_bytes'] for counts in paths.values())
+        direct_bytes = sum(counts['snic_bytes'] for counts in paths.values())
+        print(
+            f"traced {traced} requests: {tunnel} through the tunnel ({fallback} after SNIC failed), "
+            f"{tunnel_bytes / 2**20:.2f} MB tunnel vs {direct_bytes / 2**20:.2f} MB direct"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(prog='replay', description='Replays recorded requests through a running SNIC proxy')
+    parser.add_argument('log', help='trace file of the proxy (JSON lines) or HAR')
+    parser.add_argument('--config', help='config file of the proxy (.toml), for its address, root CA and trace file')
+    parser.add_argument('--speed', type=float, default=1, help='times faster than recorded, 0 to send as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight at most')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds a request may take')
+    parser.add_argument('--ca-file', help='root CA of the proxy (default: cert_file of the config)')
+    parser.add_argument('--trace-file', help='trace file the proxy writes (default: trace_file of the config)')
+    parser.add_argument('--unsafe', action='store_true', help='also replay requests that may change state on the server (POST, PUT, DELETE, ...), of a HAR with their recorded bodies and of a trace file with made-up ones')
+    args = parser.parse_args()
+
+    config.configure_from_file(args.config)
+    entries, skipped = load(args.log, args.unsafe)
+    if skipped:
+        print(f"skipped {skipped} requests with methods other than {', '.join(sorted(SAFE_METHODS))}, --unsafe replays them")
+    context = ssl.create_default_context(cafile=args.ca_file or conf.cert_file)
+    client = Client((conf.host, conf.port), context, args.timeout)
+    trace_file = args.trace_file or conf.trace_file
+    trace_offset = os.path.getsize(trace_file) if trace_file is not None and os.path.exists(trace_file) else 0
+
+    start = perf_counter()
+    results = replay(entries, client, args.speed, args.concurrency)
+    elapsed = perf_counter() - start
+    client.close()
+
+    traces = None
+    if trace_file is not None:
+        sleep(TRACE_SETTLE)
+        traces = read_traces(trace_file, trace_offset)
+    report(results, traces, elapsed)
+
+if __name__ == "__main__":
+    main()
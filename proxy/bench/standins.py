@@ -0,0 +1,480 @@
+# local stand-ins for benchmarking SNIC on a single machine:
+#   - Socks5Server: SOCKS5 with CONNECT and UDP ASSOCIATE, counting tunneled bytes
+#   - H3Server: aioquic HTTP/3 origin issuing session tickets (0-RTT allowed), optionally refusing connection migration
+#   - H11Origin: h11 HTTP/1.1 origin over TLS, optionally advertising an HTTP/3 port with Alt-Svc
+#   - DNSServer / DNSQuicServer: resolver answering A and AAAA queries from a table,
+#     over plain UDP or over QUIC (DoQ and DoH on HTTP/3 on the same port)
+#   - make_certs(): throwaway CA and origin certificate (point conf.ca_file at the CA)
+#
+# every origin serves the same paths:
+#   /bytes/<n>  n bytes of payload
+#   /echo       request body echoed back
+#   anything else returns a small HTML page
+
+import asyncio
+import datetime
+import ipaddress
+import os
+import socket
+import ssl
+import struct
+import threading
+from typing import Optional
+
+import h11
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.asyncio.server import QuicServer
+from aioquic.buffer import Buffer
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.events import DataReceived, HeadersReceived
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import StreamDataReceived
+from aioquic.quic.packet import pull_quic_header
+from aioquic.tls import SessionTicket
+
+
+def _write_pem(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def make_certs(directory: str, hostnames: list[str]) -> dict[str, str]:
+    """ writes a throwaway root CA and a leaf cert for hostnames into directory """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "snic bench CA")])
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(ca_name).issuer_name(ca_name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(ca_key, hashes.SHA256())
+    )
+    key = ec.generate_private_key(ec.SECP256R1())
+    sans = []
+    for name in hostnames:
+        try:
+            sans.append(x509.IPAddress(ipaddress.ip_address(name)))
+        except ValueError:
+            sans.append(x509.DNSName(name))
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostnames[0])]))
+        .issuer_name(ca_name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName(sans), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+    paths = {
+        "ca_cert": os.path.join(directory, "ca.crt"),
+        "ca_key": os.path.join(directory, "ca.key"),
+        "cert": os.path.join(directory, "origin.crt"),
+        "key": os.path.join(directory, "origin.key"),
+    }
+    pkcs8 = serialization.PrivateFormat.PKCS8
+    none = serialization.NoEncryption()
+    _write_pem(paths["ca_cert"], ca_cert.public_bytes(serialization.Encoding.PEM))
+    _write_pem(paths["ca_key"], ca_key.private_bytes(serialization.Encoding.PEM, pkcs8, none))
+    _write_pem(paths["cert"], cert.public_bytes(serialization.Encoding.PEM))
+    _write_pem(paths["key"], key.private_bytes(serialization.Encoding.PEM, pkcs8, none))
+    return paths
+
+
+def payload(path: str, body: bytes) -> tuple[bytes, bytes]:
+    """ returns (content type, body) served for path by every origin stand-in """
+    if path.startswith("/bytes/"):
+        return b"application/octet-stream", b"x" * int(path[len("/bytes/"):])
+    if path.startswith("/echo"):
+        return b"application/octet-stream", body
+    return b"text/html", b"<html><body>hello</body></html>"
+
+
+class LoopThread:
+    """ runs an asyncio loop in a daemon thread for stand-in servers """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class Socks5Server:
+    """
+    Minimal SOCKS5 server supporting CONNECT and UDP ASSOCIATE, no authentication.
+    Counts bytes relayed in each direction so the tunnel share of traffic can be measured.
+    """
+    def __init__(self, host: str = "127.0.0.1"):
+        self.host = host
+        self.port = 0
+        self.server = None
+        self.bytes_up = 0       # client -> remote
+        self.bytes_down = 0     # remote -> client
+        self.associations = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+
+    def reset_counters(self):
+        self.bytes_up = self.bytes_down = 0
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            ver, nmethods = await reader.readexactly(2)
+            await reader.readexactly(nmethods)
+            writer.write(b"\x05\x00")
+            _, cmd, _, atyp = await reader.readexactly(4)
+            if atyp == 1:
+                addr = socket.inet_ntoa(await reader.readexactly(4))
+            elif atyp == 3:
+                addr = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+            else:
+                addr = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+            port, = struct.unpack("!H", await reader.readexactly(2))
+            if cmd == 1:
+                await self._connect(reader, writer, addr, port)
+            elif cmd == 3:
+                await self._associate(reader, writer)
+            else:
+                writer.write(b"\x05\x07\x00\x01" + bytes(6))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _connect(self, reader, writer, addr, port):
+        try:
+            r_reader, r_writer = await asyncio.open_connection(addr, port)
+        except OSError:
+            writer.write(b"\x05\x05\x00\x01" + bytes(6))
+            return
+        writer.write(b"\x05\x00\x00\x01" + socket.inet_aton("0.0.0.0") + bytes(2))
+
+        async def pipe(src, dst, up):
+            try:
+                while data := await src.read(65536):
+                    if up:
+                        self.bytes_up += len(data)
+                    else:
+                        self.bytes_down += len(data)
+                    dst.write(data)
+                    await dst.drain()
+            except ConnectionError:
+                pass
+            finally:
+                dst.close()
+
+        await asyncio.gather(pipe(reader, r_writer, True), pipe(r_reader, writer, False))
+
+    async def _associate(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        server = self
+        client_addr = None
+
+        class Relay(asyncio.DatagramProtocol):
+            """ relays datagrams of the client; relay6 sends to and receives from IPv6 destinations """
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                nonlocal client_addr
+                if self is relay and addr[0] == writer.get_extra_info("peername")[0] and (client_addr is None or addr == client_addr):
+                    # client -> remote, strip SOCKS UDP header
+                    client_addr = addr
+                    out = relay
+                    if data[3] == 1:
+                        dst = (socket.inet_ntoa(data[4:8]), struct.unpack("!H", data[8:10])[0])
+                        data = data[10:]
+                    elif data[3] == 3:
+                        n = data[4]
+                        dst = (data[5:5 + n].decode(), struct.unpack("!H", data[5 + n:7 + n])[0])
+                        data = data[7 + n:]
+                    elif data[3] == 4:
+                        dst = (socket.inet_ntop(socket.AF_INET6, data[4:20]), struct.unpack("!H", data[20:22])[0])
+                        data = data[22:]
+                        out = relay6
+                    else:
+                        return
+                    server.bytes_up += len(data)
+                    out.transport.sendto(data, dst)
+                elif client_addr is not None:
+                    server.bytes_down += len(data)
+                    if self is relay6:
+                        header = b"\x00\x00\x00\x04" + socket.inet_pton(socket.AF_INET6, addr[0]) + struct.pack("!H", addr[1])
+                    else:
+                        header = b"\x00\x00\x00\x01" + socket.inet_aton(addr[0]) + struct.pack("!H", addr[1])
+                    relay.transport.sendto(header + data, client_addr)
+
+        transport, relay = await loop.create_datagram_endpoint(Relay, local_addr=(self.host, 0))
+        transport6, relay6 = await loop.create_datagram_endpoint(Relay, local_addr=("::1", 0))
+        self.associations += 1
+        relay_host, relay_port = transport.get_extra_info("sockname")[:2]
+        writer.write(b"\x05\x00\x00\x01" + socket.inet_aton(relay_host) + struct.pack("!H", relay_port))
+        try:
+            # association lives as long as the control connection
+            while await reader.read(4096):
+                pass
+        finally:
+            transport.close()
+            transport6.close()
+
+
+class H11Origin:
+    """ h11 HTTP/1.1 origin over TLS (keep-alive); alt_svc is sent as the Alt-Svc header of every response """
+    def __init__(self, certfile: str, keyfile: str, host: str = "127.0.0.1", alt_svc: Optional[str] = None):
+        self.host = host
+        self.port = 0
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.alt_svc = alt_svc
+        self.server = None
+
+    async def start(self):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        self.server = await asyncio.start_server(self._handle, self.host, 0, ssl=context)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn = h11.Connection(h11.SERVER)
+        try:
+            while True:
+                request, body = None, bytearray()
+                while True:
+                    event = conn.next_event()
+                    if event is h11.NEED_DATA:
+                        conn.receive_data(await reader.read(65536))
+                    elif isinstance(event, h11.Request):
+                        request = event
+                    elif isinstance(event, h11.Data):
+                        body.extend(event.data)
+                    elif isinstance(event, h11.EndOfMessage):
+                        break
+                    else:   # ConnectionClosed
+                        return
+                assert request is not None
+                content_type, data = payload(request.target.decode(), bytes(body))
+                headers = [(b"content-type", content_type), (b"content-length", str(len(data)).encode())]
+                if self.alt_svc is not None:
+                    headers.append((b"alt-svc", self.alt_svc.encode()))
+                writer.write(conn.send(h11.Response(status_code=200, headers=headers)))
+                for i in range(0, len(data), 65536):
+                    writer.write(conn.send(h11.Data(data=data[i:i + 65536])))
+                    await writer.drain()
+                writer.write(conn.send(h11.EndOfMessage()))
+                await writer.drain()
+                if conn.our_state is h11.MUST_CLOSE:
+                    return
+                conn.start_next_cycle()
+        except (ConnectionError, ssl.SSLError, h11.RemoteProtocolError):
+            pass
+        finally:
+            writer.close()
+
+
+class _H3OriginProtocol(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._h3 = H3Connection(self._quic)
+        self._requests: dict[int, tuple[dict[bytes, bytes], bytearray]] = {}
+
+    def quic_event_received(self, event):
+        for evt in self._h3.handle_event(event):
+            if isinstance(evt, HeadersReceived):
+                self._requests[evt.stream_id] = ({k: v for k, v in evt.headers}, bytearray())
+            elif isinstance(evt, DataReceived):
+                self._requests[evt.stream_id][1].extend(evt.data)
+            else:
+                continue
+            if evt.stream_ended:
+                self._respond(evt.stream_id, *self._requests.pop(evt.stream_id))
+
+    def _respond(self, stream_id: int, headers: dict[bytes, bytes], body: bytearray):
+        content_type, data = payload(headers[b":path"].decode(), bytes(body))
+        self._h3.send_headers(stream_id, [
+            (b":status", b"200"),
+            (b"content-type", content_type),
+            (b"content-length", str(len(data)).encode()),
+        ])
+        self._h3.send_data(stream_id, data, end_stream=True)
+        self.transmit()
+
+
+class _H3Server(QuicServer):
+    def __init__(self, *args, allow_migration: bool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_migration = allow_migration
+
+    def datagram_received(self, data, addr):
+        if not self.allow_migration:
+            # drop packets of an existing connection arriving from a new address
+            try:
+                header = pull_quic_header(Buffer(data=data), host_cid_length=self._configuration.connection_id_length)
+            except ValueError:
+                return
+            protocol = self._protocols.get(header.destination_cid)
+            if protocol is not None and protocol._quic._network_paths[0].addr != addr:
+                return
+        super().datagram_received(data, addr)
+
+
+class H3Server:
+    """ aioquic HTTP/3 origin; with allow_migration=False it ignores migrated paths """
+    def __init__(self, certfile: str, keyfile: str, host: str = "127.0.0.1", allow_migration: bool = True):
+        self.host = host
+        self.port = 0
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.allow_migration = allow_migration
+        self.transport = None
+        self.tickets: dict[bytes, SessionTicket] = {}   # each is used once, as 0-RTT anti-replay requires
+
+    async def start(self):
+        configuration = QuicConfiguration(alpn_protocols=H3_ALPN, is_client=False)
+        configuration.load_cert_chain(self.certfile, self.keyfile)
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            lambda: _H3Server(
+                configuration=configuration,
+                create_protocol=_H3OriginProtocol,
+                allow_migration=self.allow_migration,
+                session_ticket_fetcher=lambda label: self.tickets.pop(label, None),
+                session_ticket_handler=lambda ticket: self.tickets.__setitem__(ticket.ticket, ticket),
+            ),
+            local_addr=(self.host, 0),
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+
+    async def stop(self):
+        self.protocol.close()
+
+
+def dns_answer(query: bytes, records: dict[str, list[str]], ttl: int = 60) -> bytes:
+    """ answer to a single-question query: records of the asked family, NXDOMAIN for unknown names """
+    query_id, = struct.unpack_from("!H", query)
+    offset, labels = 12, []
+    while query[offset]:
+        labels.append(query[offset + 1:offset + 1 + query[offset]].decode())
+        offset += 1 + query[offset]
+    qtype, = struct.unpack_from("!H", query, offset + 1)
+    question = query[12:offset + 5]
+    ips = records.get(".".join(labels))
+    if ips is None:
+        return struct.pack("!HHHHHH", query_id, 0x8183, 1, 0, 0, 0) + question
+    family, rtype = (socket.AF_INET6, 28) if qtype == 28 else (socket.AF_INET, 1)
+    answers = [
+        struct.pack("!HHHIH", 0xc00c, rtype, 1, ttl, 16 if rtype == 28 else 4) + socket.inet_pton(family, ip)
+        for ip in ips if (":" in ip) == (rtype == 28)
+    ]
+    return struct.pack("!HHHHHH", query_id, 0x8180, 1, len(answers), 0, 0) + question + b"".join(answers)
+
+
+class DNSServer:
+    """ plain UDP resolver answering from records (key: hostname, value: IPv4 and IPv6 addresses) """
+    def __init__(self, records: dict[str, list[str]], ttl: int = 60, host: str = "127.0.0.1"):
+        self.records = records
+        self.ttl = ttl
+        self.host = host
+        self.port = 0
+        self.queries = 0
+        self.transport = None
+
+    async def start(self):
+        server = self
+
+        class Responder(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                server.queries += 1
+                self.transport.sendto(dns_answer(data, server.records, server.ttl), addr)
+
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(Responder, local_addr=(self.host, 0))
+        self.port = self.transport.get_extra_info("sockname")[1]
+
+    async def stop(self):
+        self.transport.close()
+
+
+class _DNSQuicProtocol(QuicConnectionProtocol):
+    """ answers DoQ streams, or DoH requests once HTTP/3 is negotiated """
+    def __init__(self, *args, server: "DNSQuicServer", **kwargs):
+        super().__init__(*args, **kwargs)
+        self._server = server
+        self._h3 = None
+        self._buffers: dict[int, bytearray] = {}
+
+    def quic_event_received(self, event):
+        if self._quic.tls.alpn_negotiated in H3_ALPN:
+            if self._h3 is None:
+                self._h3 = H3Connection(self._quic)
+            for evt in self._h3.handle_event(event):
+                if isinstance(evt, DataReceived):
+                    self._buffers.setdefault(evt.stream_id, bytearray()).extend(evt.data)
+                if isinstance(evt, (HeadersReceived, DataReceived)) and evt.stream_ended:
+                    self._server.queries += 1
+                    answer = dns_answer(bytes(self._buffers.pop(evt.stream_id, b"")), self._server.records, self._server.ttl)
+                    self._h3.send_headers(evt.stream_id, [
+                        (b":status", b"200"),
+                        (b"content-type", b"application/dns-message"),
+                        (b"content-length", str(len(answer)).encode()),
+                    ])
+                    self._h3.send_data(evt.stream_id, answer, end_stream=True)
+        elif isinstance(event, StreamDataReceived):
+            self._buffers.setdefault(event.stream_id, bytearray()).extend(event.data)
+            if event.end_stream:
+                self._server.queries += 1
+                answer = dns_answer(bytes(self._buffers.pop(event.stream_id)[2:]), self._server.records, self._server.ttl)
+                self._quic.send_stream_data(event.stream_id, struct.pack("!H", len(answer)) + answer, end_stream=True)
+        self.transmit()
+
+
+class DNSQuicServer:
+    """ DoQ and DoH (HTTP/3) resolver answering from records, see DNSServer """
+    def __init__(self, certfile: str, keyfile: str, records: dict[str, list[str]], ttl: int = 60, host: str = "127.0.0.1"):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.records = records
+        self.ttl = ttl
+        self.host = host
+        self.port = 0
+        self.queries = 0
+        self.transport = None
+
+    async def start(self):
+        configuration = QuicConfiguration(alpn_protocols=["doq"] + H3_ALPN, is_client=False)
+        configuration.load_cert_chain(self.certfile, self.keyfile)
+        self.transport, self.protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: QuicServer(
+                configuration=configuration,
+                create_protocol=lambda *args, **kwargs: _DNSQuicProtocol(*args, server=self, **kwargs),
+            ),
+            local_addr=(self.host, 0),
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+
+    async def stop(self):
+        self.protocol.close()
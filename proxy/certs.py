@@ -1,56 +1,254 @@
+import datetime
+import fcntl
+import ipaddress
+import logging
+import multiprocessing
 import os
-import subprocess
-from string import Template
+import queue
+import re
+import ssl
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Optional
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
 
 from proxy.config import conf
 
-def generate_cert(domain):
-    # Configs
-    key_path = f"proxy/certs/{domain}.key"
-    crt_path = f"proxy/certs/{domain}.crt"
-    csr_path = f"proxy/certs/{domain}.csr"
-    config_path = f"proxy/certs/{domain}.cnf"
-    if os.path.exists(crt_path):
-        return key_path, crt_path
-    os.makedirs("proxy/certs", exist_ok=True)
-
-    # Generate config file
-    template = Template("""
-[req]
-default_bits = 2048
-prompt = no
-default_md = sha256
-distinguished_name = dn
-req_extensions = req_ext
-
-[dn]
-CN = $domain
-
-[req_ext]
-subjectAltName = @alt_names
-
-[alt_names]
-DNS.1 = $domain
-""")
-    with open(config_path, "w") as f:
-        f.write(template.substitute(domain=domain))
-
-    # Generate private key
-    subprocess.run(["openssl", "genrsa", "-out", key_path, "2048"], check=True)
-
-    # Generate CSR including SAN
-    subprocess.run([
-        "openssl", "req", "-new", "-key", key_path, "-out", csr_path,
-        "-config", config_path
-    ], check=True)
-
-    # Certificate
-    subprocess.run([
-        "openssl", "x509", "-req", "-in", csr_path,
-        "-CA", conf.cert_file, "-CAkey", conf.key_file,
-        "-CAcreateserial", "-out", crt_path,
-        "-days", "365", "-sha256",
-        "-extfile", config_path, "-extensions", "req_ext"
-    ], check=True)
-
-    return key_path, crt_path
+logger = logging.getLogger(__name__)
+
+RENEW_BEFORE = 24 * 60 * 60     # seconds before expiry at which a cert is minted again
+PRUNE_INTERVAL = 60 * 60
+DOMAIN_RE = re.compile(r"[A-Za-z0-9_.:-]+")   # host names and IP addresses, nothing that walks out of cert_dir
+
+@lru_cache
+def load_ca(cert_file: str, key_file: str):
+    """ reads the root CA once instead of for every signed cert """
+    with open(cert_file, "rb") as f:
+        ca_cert = x509.load_pem_x509_certificate(f.read())
+    with open(key_file, "rb") as f:
+        ca_key = serialization.load_pem_private_key(f.read(), password=None)
+    return ca_cert, ca_key
+
+def generate_key(key_type: str):
+    # P-256 keygen takes well under a millisecond, 2048-bit RSA tens to hundreds of them
+    if key_type == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return ec.generate_private_key(ec.SECP256R1())
+
+def sign_cert(domain: str, key) -> x509.Certificate:
+    ca_cert, ca_key = load_ca(conf.cert_file, conf.key_file)
+    try:
+        san = x509.IPAddress(ipaddress.ip_address(domain))
+    except ValueError:
+        san = x509.DNSName(domain)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)]))
+        .issuer_name(ca_cert.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.SubjectAlternativeName([san]), critical=False)
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_key.public_key()), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+
+def fill_keys(key_type: str, keys: multiprocessing.Queue):
+    """ key pool process: keygen holds the GIL (up to ~100 ms for RSA), so it must not run in the proxy process """
+    os.nice(19)     # and it only uses CPU time the proxy leaves idle
+    parent = os.getppid()
+    while True:
+        key = generate_key(key_type)
+        der = key.private_bytes(
+            serialization.Encoding.DER,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        while True:
+            try:
+                keys.put(der, timeout=1)    # blocks while the pool is full
+                break
+            except queue.Full:
+                # a killed proxy process (e.g. a worker) cannot stop its pool, which must not outlive it
+                if os.getppid() != parent:
+                    return
+
+def _write_atomic(path: str, data: bytes):
+    # write to a temporary file first so that readers never see a partial file, readable by this user only (it holds a key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def _file_lock(path: str):
+    # held while minting, so that processes sharing cert_dir (workers of the proxy) mint each cert once
+    with open(path, "ab") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class CertStore:
+    """
+    Per-domain certs for intercepting CONNECTs.
+
+    Certs are minted on a worker thread, and concurrent requests for one domain share a mint.
+    Each cert and its key are kept in one file under conf.cert_dir until the cert nears expiry,
+    which is the index every process using cert_dir shares.
+    Ready SSLContexts are cached in memory (LRU), and a background pool keeps keys pre-generated.
+    """
+    def __init__(self):
+        self.contexts: OrderedDict[str, tuple[ssl.SSLContext, float]] = OrderedDict()  # value: (context, expiry timestamp)
+        self.minting: dict[str, Future] = {}    # key: domain, value: mint in flight
+        self.lock = Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.keys: Optional[multiprocessing.Queue] = None
+
+    def _start(self):
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cert')
+        if conf.cert_key_pool > 0:
+            self.keys = multiprocessing.Queue(maxsize=conf.cert_key_pool)
+            multiprocessing.Process(target=fill_keys, args=(conf.cert_key_type, self.keys), daemon=True).start()
+        Thread(target=self._prune_periodically, name='cert-prune', daemon=True).start()
+
+    def future(self, domain: str) -> Future:
+        """ SSLContext presenting the cert of domain, minted in the background if needed """
+        with self.lock:
+            if self.executor is None:
+                self._start()
+            assert self.executor is not None
+            if (entry := self.contexts.get(domain)) is not None and entry[1] - RENEW_BEFORE > time():
+                self.contexts.move_to_end(domain)
+                done: Future = Future()
+                done.set_result(entry[0])
+                return done
+            if (minting := self.minting.get(domain)) is None:
+                minting = self.executor.submit(self._load_or_mint, domain)
+                self.minting[domain] = minting
+            return minting
+
+    def get(self, domain: str) -> ssl.SSLContext:
+        return self.future(domain).result()
+
+    def path(self, domain: str) -> str:
+        if not DOMAIN_RE.fullmatch(domain) or domain.startswith("."):
+            raise ValueError(f"invalid domain for a certificate: {domain!r}")
+        return os.path.join(conf.cert_dir, f"{domain}.pem")
+
+    def _load_or_mint(self, domain: str) -> ssl.SSLContext:
+        try:
+            path = self.path(domain)
+            if (cert := self._load(path)) is not None:
+                os.utime(path)      # mtime tells prune() which certs were used recently
+            else:
+                os.makedirs(conf.cert_dir, exist_ok=True)
+                with _file_lock(f"{path}.lock"):
+                    # another process may have minted it while this one waited for the lock
+                    if (cert := self._load(path)) is None:
+                        cert = self._mint(domain, path)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile=path)
+            with self.lock:
+                self.contexts[domain] = (context, cert.not_valid_after_utc.timestamp())
+                self.contexts.move_to_end(domain)
+                while len(self.contexts) > conf.cert_cache_size:
+                    self.contexts.popitem(last=False)
+            return context
+        finally:
+            with self.lock:
+                del self.minting[domain]
+
+    def _load(self, path: str) -> Optional[x509.Certificate]:
+        """ cert stored at path, unless it is missing, nearly expired or signed by another CA """
+        try:
+            with open(path, "rb") as f:
+                cert = x509.load_pem_x509_certificate(f.read())
+        except (OSError, ValueError):
+            return None
+        if cert.not_valid_after_utc.timestamp() - RENEW_BEFORE < time():
+            return None
+        ca_cert, _ = load_ca(conf.cert_file, conf.key_file)
+        try:
+            cert.verify_directly_issued_by(ca_cert)
+        except (ValueError, TypeError, InvalidSignature):
+            return None
+        return cert
+
+    def _take_key(self):
+        if self.keys is not None:
+            try:
+                # generated by fill_keys, no need to check it again
+                der = self.keys.get_nowait()
+                return serialization.load_der_private_key(der, password=None, unsafe_skip_rsa_key_validation=True)
+            except queue.Empty:
+                pass
+        return generate_key(conf.cert_key_type)
+
+    def _mint(self, domain: str, path: str) -> x509.Certificate:
+        key = self._take_key()
+        cert = sign_cert(domain, key)
+        logger.log(logging.DEBUG, f"[cert] minted {domain}")
+
+        # cert and key share one file, so they are always replaced together
+        _write_atomic(path, cert.public_bytes(serialization.Encoding.PEM) + key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+        return cert
+
+    def _prune_periodically(self):
+        while True:
+            try:
+                self.prune()
+            except OSError as e:
+                logger.log(logging.WARN, f"[cert] failed to prune {conf.cert_dir}: {e}")
+            sleep(PRUNE_INTERVAL)
+
+    def prune(self):
+        """ removes expired certs, then the least recently used ones beyond conf.cert_store_max """
+        if not os.path.isdir(conf.cert_dir):
+            return
+        used = []
+        for name in os.listdir(conf.cert_dir):
+            if not name.endswith(".pem"):
+                continue
+            path = os.path.join(conf.cert_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    cert = x509.load_pem_x509_certificate(f.read())
+                mtime = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue
+            if cert.not_valid_after_utc.timestamp() < time():
+                self._remove(path)
+            else:
+                used.append((mtime, path))
+        used.sort(reverse=True)
+        for _, path in used[conf.cert_store_max:]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str):
+        # a process minting the cert right now at worst mints it twice
+        for name in (path, f"{path}.lock"):
+            with suppress(FileNotFoundError):
+                os.remove(name)
+
+store = CertStore()
@@ -1,5 +1,6 @@
 import logging
 import tomllib
+from typing import Optional
 from dataclasses import dataclass, field
 
 logger = logging.getLogger(__name__)
@@ -8,16 +9,60 @@ logger = logging.getLogger(__name__)
 class Config:
     host: str = '127.0.0.1'
     port: int = 11556
+    frontend: str = 'thread'
+    backlog: int = 128
+    workers: int = 1
+    fetch_workers: int = 64
+    stream_responses: bool = False
+    stream_window: int = 1024 * 1024
     cert_file: str = './proxy/rootCA.crt'
     key_file: str = './proxy/rootCA.key'
+    cert_key_type: str = 'ec'
+    cert_dir: str = './proxy/certs'
+    cert_cache_size: int = 1024
+    cert_store_max: int = 4096
+    cert_key_pool: int = 8
+    ca_file: Optional[str] = None
     dns_server_addr: str = '1.1.1.1'
     dns_server_port: int = 53
+    dns_backend: str = 'udp'
+    dns_server_name: Optional[str] = None
+    dns_doh_path: str = '/dns-query'
+    dns_timeout: float = 3
+    dns_cache_size: int = 1024
+    dns_min_ttl: int = 10
+    dns_max_ttl: int = 3600
+    dns_negative_ttl: int = 10
+    happy_eyeballs_delay: float = 0.25
     proxy_addr: str = '127.0.0.1'
     proxy_port: int = 10808
+    proxy_pool_idle_timeout: float = 30
+    proxy_pool_max_per_host: int = 6
+    proxy_http2: bool = True
+    proxy_tls_session_cache_size: int = 1024
     fetch_adaptive_snic_timeout: int = 3
     fetch_adaptive_snic_works_override: dict[str, bool] = field(default_factory=dict)
+    fetch_adaptive_verdict_db: Optional[str] = './proxy/snic_verdicts.sqlite3'
+    fetch_adaptive_verdict_ttl: float = 24 * 60 * 60
+    fetch_adaptive_verdict_failure_ttl: float = 10 * 60
+    fetch_adaptive_race: bool = False
+    fetch_adaptive_race_delay: float = 0.3
+    snic_engine: str = 'process'
+    snic_pool_idle_timeout: float = 30
+    snic_pool_max_age: float = 300
+    snic_pool_max_streams: int = 100
+    snic_ticket_file: Optional[str] = None
+    prefetch: bool = False
+    prefetch_concurrency: int = 4
+    prefetch_max_hosts: int = 8
+    trace_file: Optional[str] = None
+    trace_sample_rate: float = 1.0
+    metrics_host: str = '127.0.0.1'
+    metrics_port: Optional[int] = None
+    metrics_max_hosts: int = 256
     dns_override: dict[str, str] = field(default_factory=dict)
 
+# filled in by configure_from_file after the modules are imported, so modules read it when used, not at import
 conf = Config()
 
 def configure_from_file(path: str):
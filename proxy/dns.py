@@ -1,74 +1,347 @@
 import logging
 import asyncio
+import random
 import socket
 import socks
-from scapy.layers.dns import DNS, DNSQR
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+from typing import Coroutine, NamedTuple, Optional, Union
 
-from proxy import stat
+from proxy import stat, tracing
 from proxy.config import conf
+from proxy.shared_cache import cache as shared_cache
 
 
 logger = logging.getLogger(__name__)
 
-cache: dict[str, str] = {}
+DNS_ATTEMPTS = 2        # queries sent per lookup, answers over UDP may get lost
+QTYPES = {"A": 1, "AAAA": 28}
+RESOLUTION_DELAY = 0.05 # how long a usable answer waits for the other address family (RFC 8305)
+
+class DNSCache:
+    """
+    LRU of resolved address lists and failures, each kept for the TTL of the answer.
+    Lookups of a hostname that is already being resolved share that resolution.
+    Address lists are also shared with the other workers of the proxy, if there are any.
+    """
+    def __init__(self):
+        self.entries: OrderedDict[str, tuple[float, Union[list[str], Exception]]] = OrderedDict()  # value: (expiry, ips or error)
+        self.resolving: dict[str, Future] = {}      # key: hostname, value: resolution in flight
+        self.lock = threading.Lock()
+
+    def lookup(self, hostname: str) -> tuple[Optional[Union[list[str], Exception]], Optional[Future], bool]:
+        """
+        returns (cached ips or error, None, False) on a hit, otherwise (None, future, leader):
+        the leader resolves the hostname and completes the future others wait on
+        """
+        with self.lock:
+            if (entry := self.entries.get(hostname)) is not None:
+                if entry[0] > time():
+                    self.entries.move_to_end(hostname)
+                    return entry[1], None, False
+                del self.entries[hostname]
+            if (future := self.resolving.get(hostname)) is not None:
+                return None, future, False
+            if (shared := shared_cache.get('dns', hostname)) is not None:
+                # resolved by another worker
+                ips, expiry = shared
+                self._put(hostname, ips, expiry)
+                return ips, None, False
+            future = self.resolving[hostname] = Future()
+            return None, future, True
+
+    def put(self, hostname: str, result: Union[list[str], Exception], ttl: float):
+        with self.lock:
+            self._put(hostname, result, time() + ttl)
+        # failures are kept by each worker only, they are remembered for a short time anyway
+        if not isinstance(result, Exception):
+            shared_cache.put('dns', hostname, result, ttl, conf.dns_cache_size)
+
+    def _put(self, hostname: str, result: Union[list[str], Exception], expiry: float):
+        self.entries[hostname] = (expiry, result)
+        self.entries.move_to_end(hostname)
+        while len(self.entries) > conf.dns_cache_size:
+            self.entries.popitem(last=False)
+
+    def done(self, hostname: str):
+        with self.lock:
+            del self.resolving[hostname]
+
+cache = DNSCache()
+
+class DNSAnswer(NamedTuple):
+    id: int
+    rcode: int
+    records: list[tuple[int, str, int]]     # (type, ip, ttl) of every A and AAAA record
+
+def encode_query(query_id: int, hostname: str, qtype: str) -> bytes:
+    """ query for one name, with recursion desired """
+    qname = b""
+    for label in hostname.rstrip(".").encode().split(b"."):
+        if not 0 < len(label) < 64:
+            raise socket.gaierror(socket.EAI_NONAME, f"{hostname}: invalid hostname")
+        qname += bytes((len(label),)) + label
+    return struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0) + qname + b"\x00" + struct.pack("!HH", QTYPES[qtype], 1)
+
+def _skip_name(pkt: bytes, offset: int) -> int:
+    while (length := pkt[offset]) != 0:
+        if length >= 0xc0:
+            return offset + 2   # compression pointer ends the name
+        offset += 1 + length
+    return offset + 1
+
+def decode_answer(pkt: bytes) -> DNSAnswer:
+    """ reads the header and the A / AAAA records of an answer, raising ValueError if it is malformed """
+    try:
+        query_id, flags, qdcount, ancount, _, _ = struct.unpack_from("!HHHHHH", pkt)
+        offset = 12
+        for _ in range(qdcount):
+            offset = _skip_name(pkt, offset) + 4
+        records = []
+        for _ in range(ancount):
+            offset = _skip_name(pkt, offset)
+            rtype, _, ttl, length = struct.unpack_from("!HHIH", pkt, offset)
+            offset += 10
+            if rtype == QTYPES["A"] and length == 4:
+                records.append((rtype, socket.inet_ntop(socket.AF_INET, pkt[offset:offset + 4]), ttl))
+            elif rtype == QTYPES["AAAA"] and length == 16:
+                records.append((rtype, socket.inet_ntop(socket.AF_INET6, pkt[offset:offset + 16]), ttl))
+            offset += length
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"malformed DNS packet: {e}") from None
+    return DNSAnswer(query_id, flags & 0xf, records)
 
 class DNSClientProtocol(asyncio.DatagramProtocol):
-    def __init__(self, hostname: str, dns_server: tuple[str, int], answer_future: asyncio.Future):
-        self.hostname = hostname
-        self.dns_server = dns_server
-        self.answer_future = answer_future
+    """ one SOCKS5 UDP association, hands every answer to the channel """
+    def __init__(self, channel: "ResolverChannel"):
+        self.channel = channel
         self.transport = None
-        self.total_sent = 0
-        self.total_received = 0
+        self.control: Optional[socket.socket] = None   # TCP connection the association lives on
+        self.closed = asyncio.get_running_loop().create_future()
+        self.last_received = 0.0
 
     def connection_made(self, transport):
         self.transport = transport
 
+    def send_query(self, query_id: int, hostname: str, qtype: str, dns_server: tuple[str, int]):
         # send DNS query packet
-        query_pkt = DNS(rd=1, qd=DNSQR(qname=self.hostname, qtype="A"))
-        self.total_sent += len(bytes(query_pkt))
-        transport.sendto(bytes(query_pkt), self.dns_server)
+        query_pkt = encode_query(query_id, hostname, qtype)
+        stat.increase_total_sent_proxy(len(query_pkt))
+        self.transport.sendto(query_pkt, dns_server)
 
     def datagram_received(self, data, addr):
-        assert addr == self.dns_server
-        answer_pkt = DNS(data)
-        self.total_received += len(data)
-        ip = [a for a in answer_pkt.an if a.type == 1][0].rdata
-        self.answer_future.set_result(ip)
+        self.last_received = time()
+        stat.increase_total_received_proxy(len(data))
+        try:
+            self.channel.answer_received(decode_answer(data), addr)
+        except ValueError as e:
+            logger.log(logging.DEBUG, f"ignoring DNS answer from {addr}: {e}")
+
+    def error_received(self, exc):
+        logger.log(logging.DEBUG, f"DNS datagram error: {exc}")
+
+class ResolverChannel:
+    """
+    Keeps one SOCKS5 UDP association open for every lookup instead of one per lookup.
+    Queries from all threads are pipelined over it on a loop thread of its own and matched to answers by transaction ID.
+    The association is opened again once its TCP control connection closes or it stops answering.
+    """
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+        self.protocol: Optional[DNSClientProtocol] = None
+        self.proxy_config: Optional[tuple[str, int]] = None
+        self.connecting: Optional[asyncio.Lock] = None
+        self.answers: dict[int, tuple[tuple[str, int], asyncio.Future]] = {}  # key: transaction ID, value: (dns server, answer packet)
+
+    def submit(self, coro: Coroutine) -> Future:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="dns", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def connect(self, proxy_config: tuple[str, int]) -> DNSClientProtocol:
+        """ the current association, opening a new one if there is none """
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.protocol is not None and self.proxy_config == proxy_config:
+                return self.protocol
+            self.reset()
 
-async def resolve(hostname: str, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> str:
+            # binding performs the blocking UDP ASSOCIATE handshake
+            sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.set_proxy(
+                proxy_type=socks.SOCKS5,
+                addr=proxy_config[0],
+                port=proxy_config[1]
+            )
+            await asyncio.to_thread(sock.bind, ('', 0))
+            sock.setblocking(False)
+
+            loop = asyncio.get_running_loop()
+            _, protocol = await loop.create_datagram_endpoint(lambda: DNSClientProtocol(self), sock=sock)
+            # the association lasts as long as its control connection, which carries nothing after the handshake
+            protocol.control = sock._proxyconn
+            loop.add_reader(protocol.control.fileno(), self.reset, protocol)
+            self.protocol, self.proxy_config = protocol, proxy_config
+            stat.increase_dns_associations(1)
+            logger.log(logging.DEBUG, f"opened DNS UDP association through {proxy_config}")
+            return protocol
+
+    def reset(self, protocol: Optional[DNSClientProtocol] = None):
+        """ closes the association (only if it is still protocol, when given) """
+        if self.protocol is None or (protocol is not None and protocol is not self.protocol):
+            return
+        logger.log(logging.DEBUG, f"closing DNS UDP association through {self.proxy_config}")
+        asyncio.get_running_loop().remove_reader(self.protocol.control.fileno())
+        self.protocol.transport.close()
+        self.protocol.closed.set_result(None)
+        self.protocol = None
+
+    def answer_received(self, answer_pkt: DNSAnswer, addr):
+        if (entry := self.answers.get(answer_pkt.id)) is None:
+            return
+        dns_server, answer_future = entry
+        if addr == dns_server and not answer_future.done():
+            answer_future.set_result(answer_pkt)
+
+    async def query(self, hostname: str, qtype: str, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> DNSAnswer:
+        query_id = random.randrange(1 << 16)
+        while query_id in self.answers:
+            query_id = random.randrange(1 << 16)
+        answer_future = asyncio.get_running_loop().create_future()
+        self.answers[query_id] = (dns_server, answer_future)
+        try:
+            for _ in range(DNS_ATTEMPTS):
+                protocol = await self.connect(proxy_config)
+                sent = time()
+                protocol.send_query(query_id, hostname, qtype, dns_server)
+                # a closed association gets the query sent again on a new one right away
+                await asyncio.wait(
+                    (answer_future, protocol.closed),
+                    timeout=conf.dns_timeout / DNS_ATTEMPTS,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if answer_future.done():
+                    return answer_future.result()
+                if protocol.last_received < sent:
+                    # nothing at all came back, the relay may have dropped the association silently
+                    self.reset(protocol)
+            raise TimeoutError(f"{hostname}: DNS lookup ({qtype}) timed out")
+        finally:
+            del self.answers[query_id]
+
+channel = ResolverChannel()
+
+def get_channel():
+    """ channel of conf.dns_backend: plain UDP, or DoH / DoQ over one QUIC connection """
+    if conf.dns_backend in ('doh', 'doq'):
+        from proxy.dns_quic import channel as quic_channel  # imports this module
+        return quic_channel
+    return channel
+
+def parse_answer(hostname: str, answer_pkt: DNSAnswer, qtype: str) -> list[tuple[str, int]]:
+    """ returns (ip, ttl) of every record of qtype, raising socket.gaierror for failed lookups """
+    if answer_pkt.rcode != 0:
+        raise socket.gaierror(socket.EAI_NONAME, f"{hostname}: DNS lookup failed (rcode {answer_pkt.rcode})")
+    return [(ip, ttl) for rtype, ip, ttl in answer_pkt.records if rtype == QTYPES[qtype]]
+
+def _has_addresses(task: asyncio.Task) -> bool:
+    if task.exception() is not None:
+        return False
+    answer_pkt = task.result()
+    return answer_pkt.rcode == 0 and len(answer_pkt.records) > 0
+
+async def query(resolver, hostname: str, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> tuple[list[str], int]:
+    """ asks for A and AAAA records at once, returns (ips, ttl); runs on the loop of resolver """
+    tasks = {qtype: asyncio.ensure_future(resolver.query(hostname, qtype, dns_server, proxy_config)) for qtype in QTYPES}
+    try:
+        # once one family has addresses, the other one gets RESOLUTION_DELAY more
+        pending = set(tasks.values())
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(_has_addresses(task) for task in done):
+                if pending:
+                    await asyncio.wait(pending, timeout=RESOLUTION_DELAY)
+                break
+
+        records: list[tuple[str, int]] = []
+        errors: list[BaseException] = []
+        for qtype, task in tasks.items():
+            if not task.done():
+                continue
+            if (e := task.exception()) is not None:
+                errors.append(e)
+                continue
+            try:
+                records += parse_answer(hostname, task.result(), qtype)
+            except socket.gaierror as e:
+                errors.append(e)
+        if records:
+            return [ip for ip, _ in records], min(ttl for _, ttl in records)
+        if errors and all(isinstance(e, TimeoutError) for e in errors):
+            raise errors[0]
+        raise next((e for e in errors if isinstance(e, socket.gaierror)), socket.gaierror(socket.EAI_NONAME, f"{hostname}: no A or AAAA record"))
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+def _cached_result(result: Union[list[str], Exception]) -> list[str]:
+    if isinstance(result, Exception):
+        # a fresh exception, re-raising the cached one would keep growing its traceback
+        raise type(result)(*result.args)
+    return result
+
+async def resolve(hostname: str, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> list[str]:
+    """ returns every IPv4 and IPv6 address of hostname """
     if hostname in conf.dns_override:
         ip = conf.dns_override[hostname]
         logger.log(logging.DEBUG, f"resolved {hostname} to {ip} (overrided)")
-        return ip
-    
+        tracing.note(dns_cache='override')
+        return [ip]
+
     # lookup cache before making request
-    if hostname in cache:
-        ip = cache[hostname]
-        logger.log(logging.DEBUG, f"resolved {hostname} to {ip} (cached)")
-        return ip
-    
-    # create proxy socket for lookup
-    sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.set_proxy(
-        proxy_type=socks.SOCKS5, 
-        addr=proxy_config[0], 
-        port=proxy_config[1]
-    )
-
-    loop = asyncio.get_running_loop()
-    answer_future = loop.create_future()
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: DNSClientProtocol(hostname=hostname, dns_server=dns_server, answer_future=answer_future),
-        sock=sock
-    )
+    result, future, leader = cache.lookup(hostname)
+    if result is not None:
+        stat.increase_dns_cache_hits(1)
+        tracing.note(dns_cache='hit')
+        logger.log(logging.DEBUG, f"resolved {hostname} to {result} (cached)")
+        return _cached_result(result)
+    assert future is not None
+    if not leader:
+        # same hostname is being resolved by another request
+        stat.increase_dns_coalesced(1)
+        tracing.note(dns_cache='coalesced')
+        start = time()
+        try:
+            return _cached_result(await asyncio.wrap_future(future))
+        finally:
+            tracing.phase('dns', time() - start)
 
+    stat.increase_dns_cache_misses(1)
+    tracing.note(dns_cache='miss')
     try:
-        ip = await answer_future
-        cache[hostname] = ip
-        logger.log(logging.DEBUG, f"resolved {hostname} to {ip}")
+        start = time()
+        resolver = get_channel()
+        ips, ttl = await asyncio.wrap_future(resolver.submit(query(resolver, hostname, dns_server, proxy_config)))
+        stat.record_dns(time() - start)
+        tracing.phase('dns', time() - start)
+        cache.put(hostname, ips, min(max(ttl, conf.dns_min_ttl), conf.dns_max_ttl))
+        future.set_result(ips)
+        logger.log(logging.DEBUG, f"resolved {hostname} to {ips} (ttl {ttl})")
+        return ips
+    except (socket.gaierror, TimeoutError) as e:
+        # remember failures for a short time instead of asking again for every request
+        cache.put(hostname, e, conf.dns_negative_ttl)
+        future.set_result(e)
+        raise
+    except BaseException as e:
+        future.set_result(e)
+        raise
     finally:
-        transport.close()
-        stat.increase_total_sent_proxy(protocol.total_sent)
-        stat.increase_total_received_proxy(protocol.total_received)
-    return ip
+        cache.done(hostname)
@@ -0,0 +1,224 @@
+# encrypted DNS over one QUIC connection (conf.dns_backend):
+#   - "doq": DNS over QUIC (RFC 9250)
+#   - "doh": DNS over HTTPS (RFC 8484) on HTTP/3 rather than HTTP/2, so that it shares the connection handling
+#     with "doq", and a lost packet only stalls its own query instead of every query behind it on one TCP stream
+#   - the connection goes through the SOCKS5 UDP tunnel and is shared by every lookup,
+#     each query on a stream of its own, so concurrent lookups are multiplexed without blocking each other
+#   - it is opened again once the resolver closes it (e.g. after idling) or the association drops
+
+import asyncio
+import logging
+import socket
+import socks
+import struct
+import threading
+from time import time
+from concurrent.futures import Future
+from typing import Coroutine, Optional
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+import aioquic.h3.events
+import aioquic.quic.events
+
+from proxy import stat
+from proxy.config import conf
+from proxy.dns import DNS_ATTEMPTS, DNSAnswer, decode_answer, encode_query
+
+logger = logging.getLogger(__name__)
+
+DOQ_ALPN = ["doq"]
+
+class _CountingTransport:
+    """ counts datagrams sent through the tunnel """
+    def __init__(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def sendto(self, data: bytes, addr=None):
+        stat.increase_total_sent_proxy(len(data))
+        self.transport.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+class DNSQuicProtocol(QuicConnectionProtocol):
+    """ one QUIC connection to the resolver, answering each query on its stream """
+    def __init__(self, *args, server_name: str, doh: bool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server_name = server_name
+        self.h3 = H3Connection(self._quic) if doh else None
+        self.control: Optional[socket.socket] = None   # TCP connection the SOCKS5 association lives on
+        self.answers: dict[int, asyncio.Future] = {}    # key: stream ID, value: answer packet
+        self.buffers: dict[int, bytearray] = {}
+        self.terminated = False
+        self.last_received = 0.0
+
+    def connection_made(self, transport):
+        super().connection_made(_CountingTransport(transport))
+
+    def datagram_received(self, data, addr):
+        self.last_received = time()
+        stat.increase_total_received_proxy(len(data))
+        super().datagram_received(data, addr)
+
+    def quic_event_received(self, event: aioquic.quic.events.QuicEvent):
+        if isinstance(event, aioquic.quic.events.ConnectionTerminated):
+            self.terminated = True
+            for answer_future in self.answers.values():
+                if not answer_future.done():
+                    answer_future.set_exception(ConnectionError(f"DNS connection closed: {event.reason_phrase}"))
+        elif isinstance(event, aioquic.quic.events.StreamReset):
+            self._fail(event.stream_id, ConnectionError(f"DNS stream reset (error {event.error_code})"))
+
+        if self.h3 is not None:
+            for evt in self.h3.handle_event(event):
+                if isinstance(evt, aioquic.h3.events.HeadersReceived):
+                    status = dict(evt.headers).get(b":status")
+                    if status != b"200":
+                        self._fail(evt.stream_id, socket.gaierror(socket.EAI_FAIL, f"DoH request failed (status {status!r})"))
+                elif isinstance(evt, aioquic.h3.events.DataReceived):
+                    self.buffers.setdefault(evt.stream_id, bytearray()).extend(evt.data)
+                if getattr(evt, "stream_ended", False):
+                    self._answer(evt.stream_id, self.buffers.pop(evt.stream_id, b""))
+        elif isinstance(event, aioquic.quic.events.StreamDataReceived):
+            self.buffers.setdefault(event.stream_id, bytearray()).extend(event.data)
+            if event.end_stream:
+                # DoQ prefixes the message with its length, like DNS over TCP
+                data = self.buffers.pop(event.stream_id)
+                self._answer(event.stream_id, data[2:2 + int.from_bytes(data[:2], "big")])
+
+    def _answer(self, stream_id: int, data: bytes):
+        if (answer_future := self.answers.get(stream_id)) is None or answer_future.done():
+            return
+        try:
+            answer_future.set_result(decode_answer(bytes(data)))
+        except ValueError as e:
+            answer_future.set_exception(socket.gaierror(socket.EAI_FAIL, f"invalid DNS answer: {e}"))
+
+    def _fail(self, stream_id: int, error: Exception):
+        if (answer_future := self.answers.get(stream_id)) is not None and not answer_future.done():
+            answer_future.set_exception(error)
+
+    async def query(self, hostname: str, qtype: str) -> DNSAnswer:
+        # queries are told apart by stream, so their ID is 0 as RFC 9250 requires
+        message = encode_query(0, hostname, qtype)
+        stream_id = self._quic.get_next_available_stream_id()
+        answer_future = asyncio.get_running_loop().create_future()
+        self.answers[stream_id] = answer_future
+        if self.h3 is not None:
+            self.h3.send_headers(stream_id, [
+                (b":method", b"POST"),
+                (b":scheme", b"https"),
+                (b":authority", self.server_name.encode()),
+                (b":path", conf.dns_doh_path.encode()),
+                (b"content-type", b"application/dns-message"),
+                (b"accept", b"application/dns-message"),
+                (b"content-length", str(len(message)).encode()),
+            ])
+            self.h3.send_data(stream_id, message, end_stream=True)
+        else:
+            self._quic.send_stream_data(stream_id, struct.pack("!H", len(message)) + message, end_stream=True)
+        self.transmit()
+        try:
+            return await answer_future
+        finally:
+            del self.answers[stream_id]
+
+class QuicResolverChannel:
+    """
+    Same interface as dns.ResolverChannel, with a QUIC connection to the resolver instead of plain UDP.
+    Runs on a loop thread of its own; QUIC retransmits lost packets, so queries are not sent again.
+    """
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+        self.protocol: Optional[DNSQuicProtocol] = None
+        self.key: Optional[tuple] = None    # (backend, dns server, proxy) the connection was made for
+        self.connecting: Optional[asyncio.Lock] = None
+
+    def submit(self, coro: Coroutine) -> Future:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="dns-quic", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def connect(self, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> DNSQuicProtocol:
+        """ the current connection, opening a new one if there is none """
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            key = (conf.dns_backend, dns_server, proxy_config)
+            if self.protocol is not None and not self.protocol.terminated and self.key == key:
+                return self.protocol
+            self.reset()
+
+            # binding performs the blocking UDP ASSOCIATE handshake
+            sock = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.set_proxy(
+                proxy_type=socks.SOCKS5,
+                addr=proxy_config[0],
+                port=proxy_config[1]
+            )
+            await asyncio.to_thread(sock.bind, ('', 0))
+            sock.setblocking(False)
+
+            doh = conf.dns_backend == 'doh'
+            server_name = conf.dns_server_name or dns_server[0]
+            quic_config = QuicConfiguration(
+                alpn_protocols=H3_ALPN if doh else DOQ_ALPN,
+                is_client=True,
+                server_name=server_name,
+            )
+            if conf.ca_file is not None:
+                quic_config.load_verify_locations(conf.ca_file)
+
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: DNSQuicProtocol(QuicConnection(configuration=quic_config), server_name=server_name, doh=doh),
+                sock=sock,
+            )
+            protocol.connect(dns_server)
+            try:
+                await asyncio.wait_for(protocol.wait_connected(), conf.dns_timeout)
+            except BaseException:
+                transport.close()
+                raise
+            # the association lasts as long as its control connection, which carries nothing after the handshake
+            protocol.control = sock._proxyconn
+            loop.add_reader(protocol.control.fileno(), self.reset, protocol)
+            self.protocol, self.key = protocol, key
+            stat.increase_dns_associations(1)
+            logger.log(logging.DEBUG, f"opened {conf.dns_backend} connection to {server_name} {dns_server}")
+            return protocol
+
+    def reset(self, protocol: Optional[DNSQuicProtocol] = None):
+        """ closes the connection (only if it is still protocol, when given) """
+        if self.protocol is None or (protocol is not None and protocol is not self.protocol):
+            return
+        logger.log(logging.DEBUG, f"closing DNS connection to {self.key}")
+        asyncio.get_running_loop().remove_reader(self.protocol.control.fileno())
+        self.protocol.close()
+        self.protocol._transport.close()
+        self.protocol = None
+
+    async def query(self, hostname: str, qtype: str, dns_server: tuple[str, int], proxy_config: tuple[str, int]) -> DNSAnswer:
+        error: Optional[ConnectionError] = None
+        for _ in range(DNS_ATTEMPTS):
+            protocol = await self.connect(dns_server, proxy_config)
+            sent = time()
+            try:
+                return await asyncio.wait_for(protocol.query(hostname, qtype), conf.dns_timeout)
+            except ConnectionError as e:
+                # the connection closed under the query, which gets another one
+                error = e
+                self.reset(protocol)
+            except TimeoutError:
+                if protocol.last_received < sent:
+                    self.reset(protocol)
+                raise TimeoutError(f"{hostname}: DNS lookup ({qtype}) timed out")
+        assert error is not None
+        raise error
+
+channel = QuicResolverChannel()
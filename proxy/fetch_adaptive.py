@@ -1,75 +1,297 @@
 # adaptive fetching:
 #   - try SNIC, falling back to fetch_proxy() if it times out
-#   - record hosts that fetch_snic() works with
+#     (or, with conf.fetch_adaptive_race, race both and take whichever responds first)
+#   - record hosts that fetch_snic() works with (see proxy/verdicts.py), checking stale verdicts again in the background
+#   - learn from Alt-Svc headers of proxied responses which hosts speak HTTP/3 and on which port:
+#     hosts without it go straight to the proxy, hosts advertising it are tried with SNIC on that port
+#   - with conf.prefetch, warm the hosts referenced by HTML pages (see proxy/prefetch.py)
+#   - time every request by the path it took (see proxy/stat.py), and trace it if it is traced (see proxy/tracing.py)
 
 import asyncio
+import contextvars
 import logging
-from typing import Optional
-from urllib.parse import urlparse
-from threading import Lock
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from time import time
+from typing import Generator, Optional
+from urllib.parse import urlparse
+from threading import Event, Lock, Thread
 
-from proxy import dns
+from proxy import dns, stat, tracing
+from proxy.prefetch import Prefetcher, header_value
 from proxy.config import conf
 from proxy.interface import Request, Response
 from proxy.fetch_proxy import fetch as fetch_proxy
-from proxy.fetch_snic import fetch as fetch_snic, SNICConnection
+from proxy.fetch_snic import SNICConnection, fetch as fetch_snic, connect_fastest as connect_snic, pool as snic_pool
+from proxy.verdicts import NO_H3, store as verdicts
 
 logger = logging.getLogger(__name__)
 
-snic_works: dict[str, bool] = dict()
-lock_snic_works = Lock()
+verifying: set[str] = set()     # hosts being checked again in the background
+lock_verifying = Lock()
+verify_executor: Optional[ThreadPoolExecutor] = None
 
 def record_snic_works(host: str, result: bool):
-    with lock_snic_works:
-        if host not in snic_works:
-            snic_works[host] = result
+    verdicts.record(host, result)
 
-def check_snic_works(host: str) -> Optional[bool]:
+def check_snic_works(host: str, proxy_config: Optional[tuple[str, int]] = None) -> Optional[bool]:
+    """
+    verdict of host; a stale one is still returned, but checked again in the background if proxy_config is given
+    (unless host does not advertise HTTP/3)
+    """
     # check override in config
     if host in conf.fetch_adaptive_snic_works_override:
         return conf.fetch_adaptive_snic_works_override[host]
-    if host in snic_works:
-        return snic_works[host]
-    return None
+    if (verdict := verdicts.get(host)) is None:
+        return None
+    works, stale = verdict
+    if stale and proxy_config is not None and verdicts.h3_port(host) != NO_H3:
+        verify_later(host, proxy_config)
+    return works
+
+def h3_port(host: str) -> Optional[int]:
+    """ port host advertised HTTP/3 on, if any """
+    port = verdicts.h3_port(host)
+    return None if port == NO_H3 else port
+
+def parse_alt_svc(value: str) -> tuple[int, float]:
+    """ (port, max age) of the first HTTP/3 alternative on the same host, (NO_H3, 0) if there is none """
+    for alternative in value.split(','):
+        protocol, _, rest = alternative.strip().partition('=')
+        authority, *params = rest.split(';')
+        if protocol.strip() != 'h3':
+            continue
+        host, _, port = authority.strip().strip('"').rpartition(':')
+        if host or not port.isdigit():
+            continue    # alternatives on other hosts are not this host's SNIC
+        max_age = 24 * 60 * 60
+        for param in params:
+            name, _, param_value = param.strip().partition('=')
+            if name == 'ma' and param_value.strip().isdigit():
+                max_age = int(param_value)
+        return int(port), max_age
+    return NO_H3, 0
+
+def note_alt_svc(host: str, headers: dict[bytes, bytes], proxy_config: tuple[str, int]):
+    previous = verdicts.h3_port(host)
+    if value := header_value(headers, b'alt-svc'):
+        port, max_age = parse_alt_svc(value.decode('latin-1'))
+    elif previous in (None, NO_H3):
+        port, max_age = NO_H3, 0
+    else:
+        return      # advertisements stay valid until they expire, even if later responses leave them out
+    if port == NO_H3 and check_snic_works(host) is True:
+        return      # it speaks HTTP/3 whatever a response through the tunnel leaves out
+    verdicts.record_alt_svc(host, port, max_age if port != NO_H3 else conf.fetch_adaptive_verdict_ttl)
+    if port != NO_H3 and port != previous and check_snic_works(host) is False:
+        # SNIC failed before, but maybe not on this port
+        verify_later(host, proxy_config)
+
+def fetch_tunnel(req: Request, proxy_config: tuple[str, int]) -> Response:
+    """ fetch_proxy(), noting the HTTP/3 port the host advertises """
+    res = fetch_proxy(req, proxy_config)
+    url = urlparse(req.url)
+    assert url.hostname is not None
+    note_alt_svc(url.hostname, res.headers, proxy_config)
+    return res
+
+def check_snic(hostname: str, ips: list[str], proxy_config: tuple[str, int]) -> Optional[SNICConnection]:
+    """ connects and migrates to hostname and records whether it worked, leaving the connection idle in the pool """
+    port = h3_port(hostname) or 443
+    conn = asyncio.run(connect_snic(hostname, ips, port, proxy_config, conf.fetch_adaptive_snic_timeout, migrate=True))
+    record_snic_works(hostname, conn is not None)
+    if conn is not None:
+        snic_pool.put(conn, idle=True)
+    return conn
+
+def verify_later(host: str, proxy_config: tuple[str, int]):
+    global verify_executor
+    with lock_verifying:
+        if host in verifying:
+            return
+        verifying.add(host)
+        if verify_executor is None:
+            verify_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='snic-verify')
+    verify_executor.submit(_verify, host, proxy_config)
+
+def _verify(host: str, proxy_config: tuple[str, int]):
+    try:
+        if verdicts.h3_port(host) == NO_H3:
+            return      # learned meanwhile that there is nothing to check
+        dns_server_config = (conf.dns_server_addr, conf.dns_server_port)
+        ips = asyncio.run(dns.resolve(host, dns_server_config, proxy_config))
+        works = check_snic(host, ips, proxy_config) is not None
+        logger.log(logging.INFO, f"{host}: checked again, SNIC {'works' if works else 'failed'}")
+    except Exception as e:
+        logger.log(logging.DEBUG, f"{host}: checking again failed: {e}")
+    finally:
+        with lock_verifying:
+            verifying.discard(host)
+
+def warm(hostname: str, connect: bool, proxy_config: tuple[str, int]):
+    """ resolves hostname and, with connect, leaves a migrated SNIC connection to it in the pool """
+    dns_server_config = (conf.dns_server_addr, conf.dns_server_port)
+    ips = asyncio.run(dns.resolve(hostname, dns_server_config, proxy_config))
+    if not connect or (works := check_snic_works(hostname, proxy_config)) is False:
+        return
+    if works is None and verdicts.h3_port(hostname) == NO_H3:
+        return      # not checked, and the host tells us it does not speak HTTP/3
+    if any(snic_pool.has((hostname, ip, h3_port(hostname) or 443)) for ip in ips):
+        return
+
+    # same check as an unchecked host gets in fetch(), so the verdict is ready as well
+    if check_snic(hostname, ips, proxy_config) is not None:
+        logger.log(logging.DEBUG, f"{hostname}: prefetched SNIC connection")
+
+prefetcher = Prefetcher(warm)
+
+RACE_METHODS = ('GET', 'HEAD', 'OPTIONS')   # safe to send twice, and nothing to upload
+PATHS = {'SNIC': 'snic', 'proxy': 'tunnel'}  # path label of the metrics, key: method of race()
+
+def race(req: Request, hostname: str, ips: list[str], proxy_config: tuple[str, int]) -> tuple[str, Response]:
+    """
+    Races SNIC (check, then fetch) against fetch_proxy(), started conf.fetch_adaptive_race_delay later
+    or as soon as SNIC fails. The first response to arrive wins, the other one is closed.
+    The SNIC check always runs to the end, so the verdict is recorded whichever wins.
+    """
+    results: queue.Queue = queue.Queue()
+    decided = Event()
+    streamed = replace(req, stream=True)    # a loser is cancelled by closing its body stream
+
+    def via_snic():
+        try:
+            if check_snic(hostname, ips, proxy_config) is None or decided.is_set():
+                results.put(('SNIC', None))
+            else:
+                results.put(('SNIC', fetch_snic(streamed, proxy_config, h3_port(hostname))))
+        except Exception as e:
+            results.put(('SNIC', e))
+
+    def via_proxy():
+        try:
+            results.put(('proxy', None if decided.is_set() else fetch_tunnel(streamed, proxy_config)))
+        except Exception as e:
+            results.put(('proxy', e))
+
+    starts = [via_snic, via_proxy]
+    running = 0
+    error: Optional[Exception] = None
+    while starts or running:
+        if starts:
+            # both sides record into the trace of the request
+            Thread(target=contextvars.copy_context().run, args=(starts.pop(0),), daemon=True).start()
+            running += 1
+        try:
+            method, result = results.get(timeout=conf.fetch_adaptive_race_delay if starts else None)
+        except queue.Empty:
+            continue    # head start of SNIC is over, start the proxy alongside
+        running -= 1
+        if isinstance(result, Exception):
+            logger.log(logging.DEBUG, f"{hostname}: {method} lost the race: {result}")
+            error = result
+        if not isinstance(result, Response):
+            continue
+
+        decided.set()
+        if running:
+            Thread(target=_close_late, args=(results, running), daemon=True).start()
+        logger.log(logging.INFO, f"{hostname}: {method} responded first")
+        tracing.note(path=PATHS[method], reason='race_won')
+        if not req.stream:
+            assert result.body_stream is not None
+            result.body, result.body_stream = b"".join(result.body_stream), None
+        return PATHS[method], result
+
+    raise error if error is not None else ConnectionError(f"{hostname}: both SNIC and proxy failed")
+
+def _close_late(results: queue.Queue, running: int):
+    # responses that lost the race may still arrive, closing their body stream cancels them
+    # (a SNIC request resets its stream and goes back to the pool), but a generator closed
+    # before it started runs none of its cleanup, so it is started with the first chunk
+    for _ in range(running):
+        _, result = results.get()
+        if isinstance(result, Response) and result.body_stream is not None:
+            try:
+                next(result.body_stream, None)
+            except Exception:
+                pass    # it failed and cleaned up already
+            result.body_stream.close()
 
 def fetch(req: Request, proxy_config: tuple[str, int]) -> Response:
     url = urlparse(req.url)
     assert url.hostname is not None
+    start = time()
+    trace = req.trace
+    token = tracing.current.set(trace)
+    try:
+        if trace is not None and req.body_stream is not None:
+            req = replace(req, body_stream=trace.counted('sent', req.body_stream))
+        path, res = _fetch(req, proxy_config)
+    except Exception:
+        stat.record_failure(url.hostname)
+        raise
+    finally:
+        tracing.current.reset(token)
+    stat.record_ttfb(path, time() - start)
+    if trace is not None:
+        trace.mark('first_byte')
+        if req.body is not None:
+            trace.count(path, 'sent', len(req.body))
+    if res.body_stream is None:
+        stat.record_request(url.hostname, path, time() - start)
+        if trace is not None and res.body is not None:
+            trace.count(path, 'received', len(res.body))
+    else:
+        if trace is not None:
+            res.body_stream = trace.counted('received', res.body_stream)
+        res.body_stream = _timed(res.body_stream, url.hostname, path, start)
+    if conf.prefetch:
+        res = prefetcher.scan(res, proxy_config)
+    return res
+
+def _timed(body_stream: Generator[bytes, None, None], hostname: str, path: str, start: float) -> Generator[bytes, None, None]:
+    try:
+        yield from body_stream
+    finally:
+        stat.record_request(hostname, path, time() - start)
+
+def _fetch(req: Request, proxy_config: tuple[str, int]) -> tuple[str, Response]:
+    """ (path, response), the path being 'snic' or 'tunnel' """
+    url = urlparse(req.url)
+    assert url.hostname is not None
 
     # check if host is already checked
-    if (use_snic := check_snic_works(url.hostname)) is not None:
+    if (use_snic := check_snic_works(url.hostname, proxy_config)) is not None:
         if use_snic:
             logger.log(logging.INFO, f"{url.hostname}: using SNIC (already checked)")
-            return fetch_snic(req, proxy_config)
+            tracing.note(path='snic', reason='checked_works')
+            return 'snic', fetch_snic(req, proxy_config, h3_port(url.hostname))
         else:
             logger.log(logging.INFO, f"{url.hostname}: using proxy (already checked)")
-            return fetch_proxy(req, proxy_config)
-    
-    # try SNIC
-    timeout = conf.fetch_adaptive_snic_timeout
-    assert url.hostname is not None
+            tracing.note(path='tunnel', reason='checked_fails')
+            return 'tunnel', fetch_tunnel(req, proxy_config)
+
+    # no need to try SNIC if the host told us it does not speak HTTP/3
+    # (a failed verdict is not checked again meanwhile either, see check_snic_works)
+    if verdicts.h3_port(url.hostname) == NO_H3:
+        logger.log(logging.INFO, f"{url.hostname}: using proxy (no HTTP/3 advertised)")
+        tracing.note(path='tunnel', reason='no_h3_advertised')
+        return 'tunnel', fetch_tunnel(req, proxy_config)
+
+    # try SNIC, racing every address of the host
     dns_server_config = (conf.dns_server_addr, conf.dns_server_port)
-    ip = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
-    conn = SNICConnection(url.hostname, (ip, 443), proxy_config)
-    start = time()
-    if asyncio.run(conn.connect(timeout)):
-        timeout -= time() - start
-        if asyncio.run(conn.check_migration(timeout)):
-            # use SNIC to fetch result
-            logger.log(logging.INFO, f"{url.hostname}: path migration successful, using SNIC")
-            record_snic_works(url.hostname, True)
-            res = asyncio.run(conn.fetch(req))
-            assert isinstance(res, Response)
-            asyncio.run(conn.close())
-            return res
-        else:
-            logger.log(logging.WARN, f"{url.hostname}: path migration failed, falling back to proxy")
-    else:
-        logger.log(logging.WARN, f"{url.hostname}: QUIC connection failed, falling back to proxy")
-    asyncio.run(conn.close())
-        
+    ips = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
+    if conf.fetch_adaptive_race and req.method in RACE_METHODS and req.body is None and req.body_stream is None:
+        return race(req, url.hostname, ips, proxy_config)
+    if check_snic(url.hostname, ips, proxy_config) is not None:
+        # use SNIC to fetch result, over the migrated connection kept in the pool
+        logger.log(logging.INFO, f"{url.hostname}: path migration successful, using SNIC")
+        tracing.note(path='snic', reason='migrated')
+        return 'snic', fetch_snic(req, proxy_config, h3_port(url.hostname))
+    logger.log(logging.WARN, f"{url.hostname}: QUIC connection or path migration failed on every address, falling back to proxy")
+
     # use fetch_proxy as fallback method
-    record_snic_works(url.hostname, False)
-    return fetch_proxy(req, proxy_config)
+    tracing.note(path='tunnel', reason='snic_failed')
+    return 'tunnel', fetch_tunnel(req, proxy_config)
 
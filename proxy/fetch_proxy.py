@@ -1,36 +1,214 @@
+# fetch through the SOCKS5 proxy, HTTP/1.1 over TLS over a TCP tunnel:
+#   - connections are kept alive and pooled per (hostname, ip, port) once a response is read to the end,
+#     at most conf.proxy_pool_max_per_host per host, closed after conf.proxy_pool_idle_timeout unused
+#   - a pooled connection is checked before reuse, and idempotent requests are sent again on a new connection
+#     when the server closed the pooled one meanwhile
+#   - hosts that negotiate HTTP/2 get one multiplexed connection instead (see proxy/fetch_proxy_h2.py)
+#   - new connections resume the TLS session of the previous one to the host (see proxy/tls_sessions.py)
+
 import asyncio
+import atexit
+import logging
+import select
 import ssl
-import socks
+import threading
 import h11
-from typing import cast
+from inspect import getgeneratorstate, GEN_CREATED
+from time import time, sleep
+from typing import Generator, Optional
 from urllib.parse import urlparse
 
-from proxy import dns, stat
+from proxy import dns, fetch_proxy_h2, happy_eyeballs, stat, tracing
+from proxy.tls_sessions import cache as tls_sessions
 from proxy.config import conf
 from proxy.interface import Request, Response
 
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'}
+
+class TunnelConnection:
+    """ TLS connection to (hostname, ip, port) through the proxy, with the h11 state of its current request """
+    def __init__(self, key: tuple[str, str, int], sock: ssl.SSLSocket):
+        self.key = key
+        self.sock = sock
+        self.conn = h11.Connection(our_role=h11.CLIENT)
+        self.last_used = time()
+        self.requests = 0
+
+    def is_alive(self) -> bool:
+        # an idle connection has nothing to read, unless the server closed it (or sent something it should not have)
+        if self.sock.fileno() == -1 or self.sock.pending():
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        self.sock.close()
+
+class TunnelPool:
+    """
+    Keeps idle TunnelConnections so that requests to the same (hostname, ip, port)
+    skip the tunnel setup and TLS handshake.
+    """
+    def __init__(self):
+        self.conns: dict[tuple[str, str, int], list[TunnelConnection]] = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def acquire(self, key: tuple[str, str, int]) -> Optional[TunnelConnection]:
+        dead = []
+        conn = None
+        with self.lock:
+            conns = self.conns.get(key, [])
+            while conns:
+                # most recently used first, the one least likely to be closed by the server
+                candidate = conns.pop()
+                if candidate.is_alive():
+                    conn = candidate
+                    break
+                dead.append(candidate)
+            if not conns:
+                self.conns.pop(key, None)
+        for candidate in dead:
+            candidate.close()
+        return conn
+
+    def release(self, conn: TunnelConnection):
+        """ keeps conn for the next request if its response was read to the end and neither side closes it """
+        if conn.conn.our_state is h11.DONE and conn.conn.their_state is h11.DONE:
+            conn.conn.start_next_cycle()
+            conn.last_used = time()
+            with self.lock:
+                hostname = conn.key[0]
+                kept = sum(len(conns) for key, conns in self.conns.items() if key[0] == hostname)
+                if kept < conf.proxy_pool_max_per_host:
+                    self.conns.setdefault(conn.key, []).append(conn)
+                    if self.reaper is None:
+                        self.reaper = threading.Thread(target=self._reap, daemon=True)
+                        self.reaper.start()
+                    return
+        conn.close()
+
+    def _evict(self, now: float) -> list[TunnelConnection]:
+        evicted = []
+        with self.lock:
+            for key, conns in list(self.conns.items()):
+                remaining = []
+                for conn in conns:
+                    if now - conn.last_used > conf.proxy_pool_idle_timeout or not conn.is_alive():
+                        evicted.append(conn)
+                    else:
+                        remaining.append(conn)
+                if remaining:
+                    self.conns[key] = remaining
+                else:
+                    del self.conns[key]
+        return evicted
+
+    def _reap(self):
+        while True:
+            sleep(1)
+            for conn in self._evict(time()):
+                logger.log(logging.DEBUG, f"{conn.key[0]}: evicting pooled proxy connection ({conn.requests} requests)")
+                conn.close()
+
+    def close_all(self):
+        with self.lock:
+            conns = [conn for conns in self.conns.values() for conn in conns]
+            self.conns.clear()
+        for conn in conns:
+            conn.close()
+
+pool = TunnelPool()
+atexit.register(pool.close_all)
+
+def connect(hostname: str, ips: list[str], port: int, proxy_config: tuple[str, int]) -> tuple[tuple[str, str, int], ssl.SSLSocket]:
+    """ new TLS connection to whichever of ips answers first, offering HTTP/2 if enabled """
+    start = time()
+    sock = happy_eyeballs.create_connection(hostname, ips, port, proxy_config)
+    # the tunnel's destination, which TLS wrapping hides
+    ip = sock.getpeername()[0]
+    try:
+        tls_sock = tls_sessions.wrap(sock, hostname, port)
+    except BaseException:
+        sock.close()
+        raise
+    stat.record_connect('tunnel', time() - start)
+    tracing.phase('tunnel_connect', time() - start)
+    return (hostname, ip, port), tls_sock
+
+def replayable(req: Request) -> bool:
+    """ whether the body of req can be sent again """
+    return req.body_stream is None or getgeneratorstate(req.body_stream) == GEN_CREATED
 
 def fetch(req: Request, proxy_config: tuple[str, int]) -> Response:
-    total_sent = 0
-    total_received = 0
-    
-    # resolve hostname into ip
+    # resolve hostname into ips
     url = urlparse(req.url)
     assert url.hostname is not None
     dns_server_config = (conf.dns_server_addr, conf.dns_server_port)
-    ip = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
+    ips = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
     port = 443 if url.port is None else url.port
-    
-    # prepare socket and connection
-    ctx = ssl.create_default_context()
-    sock = socks.create_connection(
-        (ip, port), 
-        proxy_type=socks.SOCKS5, 
-        proxy_addr=proxy_config[0], 
-        proxy_port=proxy_config[1]
-    )
-    sock = ctx.wrap_socket(sock, server_hostname=url.hostname)
-    conn = h11.Connection(our_role=h11.CLIENT)
+
+    # multiplex over the HTTP/2 connection of the host, waiting for it if another request is opening it
+    opening = False
+    if conf.proxy_http2:
+        h2_conn, opening = fetch_proxy_h2.pool.acquire((url.hostname, port))
+        if h2_conn is not None:
+            try:
+                return h2_conn.fetch(req)
+            except ConnectionRefusedError as e:
+                # the server did not process the request, which is safe to send again whatever its method
+                if not replayable(req):
+                    raise
+                logger.log(logging.DEBUG, f"{e}, reconnecting")
+                h2_conn, opening = fetch_proxy_h2.pool.acquire((url.hostname, port))
+                if h2_conn is not None:
+                    return h2_conn.fetch(req)
+
+    # reuse pooled connection to any of the addresses if possible
+    conn = None if opening else next((conn for ip in ips if (conn := pool.acquire((url.hostname, ip, port))) is not None), None)
+    if conn is not None:
+        try:
+            return exchange(conn, req)
+        except (OSError, h11.ProtocolError) as e:
+            conn.close()
+            # the server may have closed the connection just before the request, which is only safe to repeat if idempotent
+            if req.method not in IDEMPOTENT_METHODS or not replayable(req):
+                raise
+            logger.log(logging.DEBUG, f"{url.hostname}: pooled proxy connection failed ({e!r}), reconnecting")
+
+    # prepare socket and connection, racing the addresses
+    try:
+        key, sock = connect(url.hostname, ips, port, proxy_config)
+    except BaseException:
+        if opening:
+            fetch_proxy_h2.pool.opened((url.hostname, port), None)
+        raise
+    if sock.selected_alpn_protocol() == 'h2':
+        h2_conn = fetch_proxy_h2.H2TunnelConnection(key, sock)
+        if opening:
+            fetch_proxy_h2.pool.opened((url.hostname, port), h2_conn)
+        return h2_conn.fetch(req)
+    if opening:
+        fetch_proxy_h2.pool.opened((url.hostname, port), None, http1=True)
+    conn = TunnelConnection(key, sock)
+    try:
+        return exchange(conn, req)
+    except BaseException:
+        conn.close()
+        raise
+
+def exchange(conn: TunnelConnection, req: Request) -> Response:
+    """ sends req on conn and receives the response headers, the body as it is read """
+    total_sent = 0
+    total_received = 0
+    url = urlparse(req.url)
+    assert url.hostname is not None
+    conn.requests += 1
 
     # send request
     headers = {
@@ -47,50 +225,66 @@ def fetch(req: Request, proxy_config: tuple[str, int]) -> Response:
         headers=list(headers.items()),
         target=target
     )
-    data = conn.send(request)
-    sock.sendall(data)
+    data = conn.conn.send(request)
+    conn.sock.sendall(data)
     total_sent += len(data)
-    
-    # send request body if exists
+
+    # send request body if exists, streamed bodies chunk by chunk as the client sends them
     if req.body is not None:
         body = h11.Data(req.body)
-        data = conn.send(body)
-        sock.sendall(data)
+        data = conn.conn.send(body)
+        conn.sock.sendall(data)
         total_sent += len(data)
-    
+    elif req.body_stream is not None:
+        for chunk in req.body_stream:
+            data = conn.conn.send(h11.Data(chunk))
+            conn.sock.sendall(data)
+            total_sent += len(data)
+
     # end of request
-    data = conn.send(h11.EndOfMessage())
-    sock.sendall(data)
+    data = conn.conn.send(h11.EndOfMessage())
+    conn.sock.sendall(data)
     total_sent += len(data)
 
     # receive response
     response = None
-    body_parts = []
-    while True:
-        event = conn.next_event()
+    while response is None:
+        event = conn.conn.next_event()
         if event is h11.NEED_DATA:
-            data = sock.recv(65535)
+            data = conn.sock.recv(65535)
             total_received += len(data)
-            conn.receive_data(data)
+            conn.conn.receive_data(data)
         elif isinstance(event, h11.Response):
             response = event
-        elif isinstance(event, h11.Data):
-            body_parts.append(event.data)
-        elif isinstance(event, h11.EndOfMessage):
-            break
-    response = cast(h11.Response, response)
-
-    # close socket
-    sock.close()
+    stat.increase_total_sent_proxy(total_sent)
+    stat.increase_total_received_proxy(total_received)
+
     res = Response(
         status_code=response.status_code,
         url=req.url,
         headers={k: v for k, v in response.headers},
         req_id=req.req_id,
-        body=bytes().join(body_parts)
     )
-
-    stat.increase_total_received_proxy(total_received)
-    stat.increase_total_sent_proxy(total_sent)
+    if req.stream:
+        res.body_stream = body_stream(conn)
+    else:
+        res.body = bytes().join(body_stream(conn))
     return res
 
+def body_stream(conn: TunnelConnection) -> Generator[bytes, None, None]:
+    """ yields response body as h11 Data events arrive, returning conn to the pool (or closing it) at the end """
+    try:
+        while True:
+            event = conn.conn.next_event()
+            if event is h11.NEED_DATA:
+                data = conn.sock.recv(65535)
+                stat.increase_total_received_proxy(len(data))
+                conn.conn.receive_data(data)
+            elif isinstance(event, h11.Data):
+                yield bytes(event.data)
+            elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                break
+    finally:
+        # TLS 1.3 tickets arrive along with the response
+        tls_sessions.put((conn.key[0], conn.key[2]), conn.sock)
+        pool.release(conn)
@@ -0,0 +1,345 @@
+# HTTP/2 through the SOCKS5 proxy (conf.proxy_http2):
+#   - negotiated with ALPN when fetch_proxy opens a TLS connection, hosts without it keep using HTTP/1.1
+#   - one connection per host carries every request to it at the same time, each on a stream of its own,
+#     with HPACK compressing the headers they repeat
+#   - a thread per connection owns the TLS socket: it sends whatever the h2 state machine has queued
+#     and hands received frames to the requests waiting for them
+#   - response bodies get window back as they are consumed, request bodies wait for the server's window
+
+import atexit
+import logging
+import queue
+import selectors
+import socket
+import ssl
+import threading
+from concurrent.futures import Future
+from time import time
+from typing import Generator, Optional
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+import h2.settings
+
+from proxy import stat
+from proxy.config import conf
+from proxy.fetch_snic import h3_request_headers
+from proxy.interface import Request, Response
+from proxy.tls_sessions import cache as tls_sessions
+
+logger = logging.getLogger(__name__)
+
+CONNECTION_WINDOW = 16 * 1024 * 1024    # shared by every stream, so that a slow reader does not stall the others
+CONNECTION_HEADERS = {b'keep-alive', b'proxy-connection', b'upgrade', b'te'}    # not allowed in HTTP/2
+
+def h2_request_headers(req: Request) -> list[tuple[bytes, bytes]]:
+    return [(k, v) for k, v in h3_request_headers(req) if k not in CONNECTION_HEADERS]
+
+class H2TunnelConnection:
+    """ HTTP/2 connection to a host through the proxy, shared by the threads fetching from it """
+    def __init__(self, key: tuple[str, str, int], sock: ssl.SSLSocket):
+        self.key = key
+        self.sock = sock
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self.h2.local_settings = h2.settings.Settings(client=True, initial_values={
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: conf.stream_window,
+        })
+        self.h2.initiate_connection()
+        self.h2.increment_flow_control_window(CONNECTION_WINDOW - self.h2.inbound_flow_control_window)
+
+        self.lock = threading.Lock()    # guards self.h2, shared by the loop thread and every request
+        self.changed = threading.Condition(self.lock)   # windows opened or streams closed
+        self.streams: dict[int, queue.Queue] = {}   # key: stream ID, value: events of the stream's response
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_w.setblocking(False)
+        self.closed = False
+        self.goaway = False     # the server takes no new streams
+        self.error: Optional[Exception] = None
+        self.last_used = time()
+        self.requests = 0
+
+        self.thread = threading.Thread(target=self._loop, name=f"h2-{key[0]}", daemon=True)
+        self.thread.start()
+
+    def is_alive(self) -> bool:
+        return not self.closed and not self.goaway and self.thread.is_alive()
+
+    def _wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass    # a wakeup is pending already, or the loop is gone
+
+    def _loop(self):
+        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(self.wake_r, selectors.EVENT_READ)
+        outgoing = b''
+        session_kept = False
+        try:
+            while not self.closed:
+                # send what the requests and received frames have queued, as far as the socket takes it
+                with self.lock:
+                    outgoing += self.h2.data_to_send()
+                while outgoing:
+                    try:
+                        sent = self.sock.send(outgoing[:65536])
+                    except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                        break
+                    stat.increase_total_sent_proxy(sent)
+                    outgoing = outgoing[sent:]
+                selector.modify(self.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if outgoing else 0))
+
+                # close connections nobody used for a while, or the server wants no more of
+                with self.lock:
+                    idle = not self.streams
+                if idle and self.goaway:
+                    break
+                timeout = max(0, self.last_used + conf.proxy_pool_idle_timeout - time()) if idle else None
+                events = selector.select(timeout)
+                if not events and idle:
+                    with self.lock:
+                        # a request may have come in meanwhile
+                        if self.streams or time() - self.last_used < conf.proxy_pool_idle_timeout:
+                            continue
+                        self.h2.close_connection()
+                        self.closed = True
+                        data = self.h2.data_to_send()
+                    logger.log(logging.DEBUG, f"{self.key[0]}: closing idle HTTP/2 connection ({self.requests} requests)")
+                    try:
+                        self.sock.send(outgoing + data)
+                    except OSError:
+                        pass
+                    break
+                for key, _ in events:
+                    if key.fileobj is self.wake_r:
+                        self.wake_r.recv(4096)
+
+                # receive everything TLS has decrypted so far
+                while True:
+                    try:
+                        data = self.sock.recv(65535)
+                    except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                        break
+                    if not data:
+                        raise ConnectionError(f"{self.key[0]}: HTTP/2 connection closed by server")
+                    stat.increase_total_received_proxy(len(data))
+                    with self.lock:
+                        self._dispatch(self.h2.receive_data(data))
+                # TLS 1.3 tickets arrive after the handshake
+                if not session_kept:
+                    session_kept = tls_sessions.put((self.key[0], self.key[2]), self.sock)
+        except Exception as e:
+            if not self.closed:
+                logger.log(logging.DEBUG, f"{self.key[0]}: HTTP/2 connection failed: {e!r}")
+            self._terminate(e if isinstance(e, ConnectionError) else ConnectionError(f"{self.key[0]}: HTTP/2 connection failed: {e!r}"))
+        finally:
+            selector.close()
+            self._terminate(ConnectionError(f"{self.key[0]}: HTTP/2 connection closed"))
+            self.sock.close()
+            self.wake_r.close()
+            self.wake_w.close()
+
+    def _dispatch(self, events: list):
+        # called with self.lock held
+        for event in events:
+            if isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+                self.changed.notify_all()
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                # GOAWAY: streams above last_stream_id were never processed and may be sent again elsewhere
+                self.goaway = True
+                for stream_id, events_q in self.streams.items():
+                    if event.last_stream_id is None or stream_id > event.last_stream_id:
+                        events_q.put(('error', ConnectionRefusedError(f"{self.key[0]}: HTTP/2 stream refused (GOAWAY)")))
+                self.changed.notify_all()
+            elif isinstance(event, (h2.events.ResponseReceived, h2.events.DataReceived, h2.events.StreamEnded, h2.events.StreamReset)):
+                events_q = self.streams.get(event.stream_id)
+                if events_q is None:
+                    # the request is gone, so is whoever would have consumed the data
+                    if isinstance(event, h2.events.DataReceived):
+                        self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    continue
+                if isinstance(event, h2.events.ResponseReceived):
+                    events_q.put(('headers', event.headers))
+                elif isinstance(event, h2.events.DataReceived):
+                    events_q.put(('data', event.data, event.flow_controlled_length))
+                elif isinstance(event, h2.events.StreamEnded):
+                    events_q.put(('end',))
+                    self.changed.notify_all()
+                else:
+                    error = ConnectionRefusedError if event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM else ConnectionError
+                    events_q.put(('error', error(f"{self.key[0]}: HTTP/2 stream reset (error {event.error_code})")))
+                    self.changed.notify_all()
+
+    def _terminate(self, error: Exception):
+        with self.lock:
+            self.closed = True
+            if self.error is None:
+                self.error = error
+            for events_q in self.streams.values():
+                events_q.put(('error', error))
+            self.changed.notify_all()
+
+    def fetch(self, req: Request) -> Response:
+        """ sends req on a new stream; raises ConnectionRefusedError if the server did not process it """
+        end_stream = req.body is None and req.body_stream is None
+        with self.changed:
+            # wait for a free stream if the server limits them
+            while not self.closed and not self.goaway and self.h2.open_outbound_streams >= self.h2.remote_settings.max_concurrent_streams:
+                self.changed.wait()
+            if self.closed or self.goaway:
+                raise ConnectionRefusedError(f"{self.key[0]}: HTTP/2 connection closed")
+            stream_id = self.h2.get_next_available_stream_id()
+            events_q = self.streams[stream_id] = queue.Queue()
+            self.h2.send_headers(stream_id, h2_request_headers(req), end_stream=end_stream)
+            self.requests += 1
+            self.last_used = time()
+        self._wake()
+
+        try:
+            # send request body if exists, streamed bodies chunk by chunk as the client sends them
+            if req.body is not None:
+                self._send_data(stream_id, req.body, end_stream=True)
+            elif req.body_stream is not None:
+                for chunk in req.body_stream:
+                    if not self._send_data(stream_id, chunk, end_stream=False):
+                        break
+                else:
+                    self._send_data(stream_id, b'', end_stream=True)
+
+            # receive response
+            event = events_q.get()
+            if event[0] == 'error':
+                raise event[1]
+            headers = {k: v for k, v in event[1] if not k.startswith(b':')}
+            res = Response(
+                status_code=int(dict(event[1])[b':status']),
+                url=req.url,
+                headers=headers,
+                req_id=req.req_id,
+            )
+        except BaseException:
+            self._forget(stream_id, events_q)
+            raise
+        if req.stream:
+            res.body_stream = self._body_stream(stream_id, events_q)
+        else:
+            res.body = bytes().join(self._body_stream(stream_id, events_q))
+        return res
+
+    def _send_data(self, stream_id: int, data: bytes, end_stream: bool) -> bool:
+        """ sends data as the server's window allows, False if the server no longer wants the body """
+        while True:
+            with self.changed:
+                try:
+                    while not self.closed and data and self.h2.local_flow_control_window(stream_id) <= 0:
+                        self.changed.wait()
+                    if self.closed:
+                        raise self.error or ConnectionError(f"{self.key[0]}: HTTP/2 connection closed")
+                    size = min(len(data), self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+                    self.h2.send_data(stream_id, data[:size], end_stream=end_stream and size == len(data))
+                except h2.exceptions.StreamClosedError:
+                    return False    # the response is complete before the request body, drop the rest
+            self._wake()
+            data = data[size:]
+            if not data:
+                return True
+
+    def _body_stream(self, stream_id: int, events_q: queue.Queue) -> Generator[bytes, None, None]:
+        """ yields response body as DATA frames arrive, giving the window back as the consumer asks for more """
+        try:
+            while True:
+                event = events_q.get()
+                if event[0] == 'data':
+                    if event[1]:
+                        yield event[1]
+                    with self.lock:
+                        self.h2.acknowledge_received_data(event[2], stream_id)
+                    self._wake()
+                elif event[0] == 'end':
+                    return
+                else:
+                    raise event[1]
+        finally:
+            self._forget(stream_id, events_q)
+
+    def _forget(self, stream_id: int, events_q: queue.Queue):
+        """ stops stream_id, cancelling it if the response was not complete """
+        with self.changed:
+            del self.streams[stream_id]
+            self.last_used = time()
+            unread = 0
+            while not events_q.empty():
+                event = events_q.get_nowait()
+                if event[0] == 'data':
+                    unread += event[2]
+            if not self.closed:
+                try:
+                    self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                except h2.exceptions.ProtocolError:
+                    pass    # complete already
+                if unread:
+                    self.h2.acknowledge_received_data(unread, stream_id)
+            self.changed.notify_all()
+        self._wake()
+
+    def close(self):
+        with self.lock:
+            if not self.closed and not self.goaway:
+                self.h2.close_connection()
+                self.goaway = True
+        self._wake()
+
+class H2TunnelPool:
+    """
+    Keeps the HTTP/2 connection of each (hostname, port).
+    While one is being opened, other requests to the host wait for it instead of opening their own.
+    """
+    def __init__(self):
+        self.conns: dict[tuple[str, int], H2TunnelConnection] = {}
+        self.opening: dict[tuple[str, int], Future] = {}
+        self.http1: set[tuple[str, int]] = set()    # hosts that did not negotiate HTTP/2
+        self.lock = threading.Lock()
+
+    def acquire(self, key: tuple[str, int]) -> tuple[Optional[H2TunnelConnection], bool]:
+        """
+        (connection of key, False) if there is one, (None, True) if the caller is to open it and tell opened(),
+        (None, False) if the host speaks HTTP/1.1 only
+        """
+        while True:
+            with self.lock:
+                conn = self.conns.get(key)
+                if conn is not None and conn.is_alive():
+                    return conn, False
+                if key in self.http1:
+                    return None, False
+                opening = self.opening.get(key)
+                if opening is None:
+                    self.opening[key] = Future()
+                    return None, True
+            if opening.result() is None:
+                return None, False
+
+    def opened(self, key: tuple[str, int], conn: Optional[H2TunnelConnection], http1: bool = False):
+        """ ends opening a connection for key, None if it failed or (http1) the host does not speak HTTP/2 """
+        with self.lock:
+            if conn is not None:
+                self.conns[key] = conn
+            if http1:
+                self.http1.add(key)
+            opening = self.opening.pop(key)
+        opening.set_result(conn)
+
+    def close_all(self):
+        with self.lock:
+            conns = list(self.conns.values())
+            self.conns.clear()
+        for conn in conns:
+            conn.close()
+
+pool = H2TunnelPool()
+atexit.register(pool.close_all)
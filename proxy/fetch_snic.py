@@ -1,26 +1,173 @@
+import atexit
 import logging
 import asyncio
 import multiprocessing
+import os
+import queue
+import selectors
 import socket
 import socks
-from time import time
+import threading
+from dataclasses import replace
+from inspect import getgeneratorstate, GEN_CREATED
+from time import time, sleep
 from urllib.parse import urlparse
 from aioquic.quic.configuration import QuicConfiguration
 from aioquic.quic.connection import QuicConnection
-from aioquic.h3.connection import H3Connection
+from aioquic.h3.connection import H3Connection, ErrorCode
+from aioquic.tls import SessionTicket
 import aioquic.quic.events
 import aioquic.h3.events
-import queue
-from typing import Optional, cast
+from typing import Generator, NamedTuple, Optional, TextIO, Union
 
-from proxy import dns, stat
+from proxy import dns, happy_eyeballs, quic_tickets, stat, tracing
 from proxy.config import conf
 from proxy.interface import Request, Response
 
 logger = logging.getLogger(__name__)
 
-def quic_loop(
-    req_q: multiprocessing.Queue, 
+class BodyChunk(NamedTuple):
+    """ part of a streamed body: a response body after its Response, or a request body after its Request """
+    req_id: int
+    data: bytes
+    end: bool
+
+class BodyAck(NamedTuple):
+    """
+    flow control of streamed bodies: bytes of a response body the client has consumed (to the QUIC loop),
+    or bytes of a request body the connection can take more (to the uploader, 0 meaning stop uploading)
+    """
+    req_id: int
+    size: int
+
+class Cancel(NamedTuple):
+    """
+    request whose response is no longer read (to the QUIC loop, which stops its stream),
+    sent back as the last message of the request so that what is still queued for it can be dropped
+    """
+    req_id: int
+
+class NewTicket(NamedTuple):
+    """ session ticket received by quic_loop, for the ticket store of the proxy process """
+    ticket: SessionTicket
+
+EARLY_DATA_METHODS = {'GET', 'HEAD'}
+RESULT_POLL_INTERVAL = 1    # seconds between checks that a quic_loop process is alive while waiting for it
+
+def early_safe(req: Request) -> bool:
+    """ whether req may be sent as 0-RTT early data, which the network could replay """
+    return req.method in EARLY_DATA_METHODS and req.body is None and req.body_stream is None
+
+def early_data_allowed(ticket: Optional[SessionTicket]) -> bool:
+    return ticket is not None and ticket.max_early_data_size is not None
+
+def record_handshake(resumed: bool):
+    if resumed:
+        stat.increase_snic_resumed(1)
+    else:
+        stat.increase_snic_full_handshakes(1)
+
+def record_early_data(hostname: str, early_sent: float, early_accepted: bool):
+    """ reports, once the connection is established, what a request sent as 0-RTT early data at early_sent saved """
+    if early_accepted:
+        # without early data, the request would have waited until now
+        saved = time() - early_sent
+        stat.increase_snic_early_data(1)
+        stat.increase_snic_early_saved_seconds(saved)
+        logger.log(logging.INFO, f"{hostname}: 0-RTT request accepted, time to first byte {saved * 1000:.0f} ms shorter")
+    else:
+        logger.log(logging.INFO, f"{hostname}: 0-RTT request rejected, sent again after the handshake")
+
+class SNICQuicConnection(QuicConnection):
+    """
+    QuicConnection whose receive window follows the consumer of streamed responses.
+
+    aioquic raises MAX_STREAM_DATA as soon as data arrives, so a slow client would make
+    us buffer the whole body. Here the window of a streamed response is only raised
+    while less than conf.stream_window bytes are delivered but not yet consumed.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unconsumed: dict[int, int] = {}    # key: stream ID, value: bytes not yet consumed
+
+    def delivered(self, stream_id: int, size: int):
+        self.unconsumed[stream_id] = self.unconsumed.get(stream_id, 0) + size
+
+    def consumed(self, stream_id: int, size: int):
+        if stream_id in self.unconsumed:
+            self.unconsumed[stream_id] -= size
+
+    def finished(self, stream_id: int):
+        self.unconsumed.pop(stream_id, None)
+
+    def cancel(self, stream_id: int, uploading: bool):
+        """ asks the peer to stop sending the response of a stream, resetting the request body still being uploaded """
+        self.finished(stream_id)
+        if stream_id in self._streams:
+            self.stop_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+        if uploading:
+            self.reset_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+
+    def unsent(self, stream_id: int) -> int:
+        """ bytes written to a stream that the peer has not acknowledged yet """
+        if (stream := self._streams.get(stream_id)) is None:
+            return 0
+        return stream.sender._buffer_stop - stream.sender._buffer_start
+
+    def _write_stream_limits(self, builder, space, stream):
+        if self.unconsumed.get(stream.stream_id, 0) > conf.stream_window:
+            return
+        super()._write_stream_limits(builder, space, stream)
+
+def secrets_log_file() -> Optional[TextIO]:
+    """ file the TLS secrets of a QUIC connection are appended to for Wireshark, if SSLKEYLOGFILE is set """
+    path = os.environ.get('SSLKEYLOGFILE')
+    # line buffered, so that the lines of concurrent connections do not interleave
+    return open(path, 'a', buffering=1) if path else None
+
+def h3_request_headers(req: Request) -> list[tuple[bytes, bytes]]:
+    url = urlparse(req.url)
+    assert url.hostname is not None
+    if len(url.query) > 0:
+        path = url.path + '?' + url.query
+    else:
+        path = url.path
+    headers = {
+        b':method': req.method.encode(),
+        b':scheme': b'https',
+        b':authority': url.hostname.encode(),
+        b':path': path.encode(),
+        b'user-agent': b'snic/0.1',
+        b'accept': b'*/*',
+        **req.header
+    }
+    headers = {k.lower(): v for k, v in headers.items()}    # normalize
+    if b'connection' in headers:
+        del headers[b'connection']
+    if b'host' in headers:
+        del headers[b'host']
+    if b'transfer-encoding' in headers:
+        del headers[b'transfer-encoding']     # HTTP/3 frames the body itself
+    return list(headers.items())
+
+def quic_loop(req_pipe, res_q: multiprocessing.Queue, evt_connected, evt_migrated, evt_terminate, hostname: str, *args):
+    """ runs a SNIC connection in its own process, see _quic_loop for the arguments """
+    try:
+        _quic_loop(req_pipe, res_q, evt_connected, evt_migrated, evt_terminate, hostname, *args)
+    except OSError as e:
+        # the sockets could not be set up, e.g. the proxy refused the UDP association
+        logger.debug(f"{hostname}: QUIC loop failed: {e}")
+    finally:
+        # however the loop ended, wake up requests still waiting for a response,
+        # and connect() / check_migration() still waiting (evt_terminate tells them it failed)
+        res_q.put(None)
+        evt_terminate.set()
+        evt_connected.set()
+        evt_migrated.set()
+        logging.debug(f"{hostname}: QUIC loop terminated")
+
+def _quic_loop(
+    req_pipe,
     res_q: multiprocessing.Queue,
     evt_connected,
     evt_migrated,
@@ -29,6 +176,7 @@ def quic_loop(
     dst_addr: tuple[str, int], 
     proxy_addr: str, 
     proxy_port: int,
+    session_ticket: Optional[SessionTicket] = None,
 ):
     # create socks UDP socket
     sock_proxy = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -36,7 +184,8 @@ def quic_loop(
     sock_proxy.setblocking(False)
 
     # create underlying UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    family = socket.AF_INET6 if happy_eyeballs.is_ipv6(dst_addr[0]) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
     sock.bind(('', 0))
     sock.setblocking(False)
 
@@ -45,45 +194,137 @@ def quic_loop(
         alpn_protocols=["h3"], 
         is_client=True,
         server_name=hostname,
-        secrets_log_file=open("keylog", "w")
+        secrets_log_file=secrets_log_file(),
+        session_ticket=session_ticket,
     )
-    quic_conn = QuicConnection(configuration=quic_config)
+    if conf.ca_file is not None:
+        quic_config.load_verify_locations(conf.ca_file)
+    quic_conn = SNICQuicConnection(configuration=quic_config, session_ticket_handler=lambda ticket: res_q.put(NewTicket(ticket)))
     h3_conn = H3Connection(quic_conn)
+    early_data = early_data_allowed(session_ticket)
+    early_sent: Optional[float] = None
+    early_accepted = False
 
     # initiate QUIC connection
     quic_conn.connect(dst_addr, now=time())
 
+    # block on sockets and request pipe instead of polling
+    selector = selectors.DefaultSelector()
+    selector.register(sock_proxy, selectors.EVENT_READ)
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(req_pipe, selectors.EVENT_READ)
+
     # main QUIC loop
-    timer = None
     connected = False
     terminated = False
     migrated = False
     resp_map: dict[int, Response] = {}  # key: stream ID, value: response
     req_map: dict[int, Request] = {}    # key: stream ID, value: request
+    body_map: dict[int, list[bytes]] = {}   # key: stream ID, value: body parts of buffered responses
+    stream_map: dict[int, int] = {}     # key: request ID, value: stream ID of streamed responses
+    pending: list[Request] = []         # requests received before connection is established
+    uploads: dict[int, int] = {}        # key: request ID, value: stream ID of requests whose body is being uploaded
+    upload_held: dict[int, int] = {}    # key: request ID, value: uploaded bytes not yet granted back to the uploader
     total_sent_proxy = 0
     total_received_proxy = 0
     total_sent_without_proxy = 0
     total_received_without_proxy = 0
+
+    def flush_stats():
+        # connections may be pooled for a long time, so report traffic as responses complete
+        nonlocal total_sent_proxy, total_received_proxy, total_sent_without_proxy, total_received_without_proxy
+        stat.increase_total_sent_proxy(total_sent_proxy)
+        stat.increase_total_received_proxy(total_received_proxy)
+        stat.increase_total_sent_snic(total_sent_without_proxy)
+        stat.increase_total_received_snic(total_received_without_proxy)
+        total_sent_proxy = total_received_proxy = 0
+        total_sent_without_proxy = total_received_without_proxy = 0
+
+    def stop_upload(req_id: int, cancel: bool):
+        # the response is complete or the peer stopped reading, the uploader drops the rest of the body
+        stream_id = uploads.pop(req_id)
+        del upload_held[req_id]
+        if cancel:
+            quic_conn.reset_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+        res_q.put(BodyAck(req_id, 0))
+
+    def cancel(req_id: int):
+        # the request is no longer wanted, what arrives for its stream from now on is dropped
+        pending[:] = [req for req in pending if req.req_id != req_id]
+        stream_id = next((stream_id for stream_id, req in req_map.items() if req.req_id == req_id), None)
+        if stream_id is not None:
+            del req_map[stream_id]
+            stream_map.pop(req_id, None)
+            resp_map.pop(stream_id, None)
+            body_map.pop(stream_id, None)
+            quic_conn.cancel(stream_id, uploading=req_id in uploads)
+        if req_id in uploads:
+            del uploads[req_id], upload_held[req_id]
+        res_q.put(Cancel(req_id))
+
     while not terminated:
         # transmit data
-        for data, addr in quic_conn.datagrams_to_send(now=time()):
-            if migrated:
-                sock.sendto(data, addr)
-                total_sent_without_proxy += len(data)
-            else:
-                sock_proxy.sendto(data, addr)
-                total_sent_proxy += len(data)
+        try:
+            for data, addr in quic_conn.datagrams_to_send(now=time()):
+                if migrated:
+                    sock.sendto(data, addr)
+                    total_sent_without_proxy += len(data)
+                else:
+                    sock_proxy.sendto(data, addr)
+                    total_sent_proxy += len(data)
+        except OSError as e:
+            # e.g. ENETUNREACH on a direct path this host has no route for
+            logger.debug(f"{hostname}: sending failed: {e}")
+            break
+
+        # let uploaders send more once the peer has taken what they sent
+        for req_id, stream_id in uploads.items():
+            if upload_held[req_id] and quic_conn.unsent(stream_id) < conf.stream_window:
+                res_q.put(BodyAck(req_id, upload_held[req_id]))
+                upload_held[req_id] = 0
+
+        # wait for datagrams, a request or the next QUIC timer
+        timer = quic_conn.get_timer()
+        timeout = None if timer is None else max(0, timer - time())
+        for key, _ in selector.select(timeout):
+            if key.fileobj is req_pipe:
+                # None only wakes the loop up, e.g. to terminate
+                while req_pipe.poll():
+                    msg = req_pipe.recv()
+                    if isinstance(msg, Request):
+                        pending.append(msg)
+                    elif isinstance(msg, BodyAck) and msg.req_id in stream_map:
+                        quic_conn.consumed(stream_map[msg.req_id], msg.size)
+                    elif isinstance(msg, Cancel):
+                        cancel(msg.req_id)
+                    elif isinstance(msg, BodyChunk) and msg.req_id in uploads:
+                        h3_conn.send_data(uploads[msg.req_id], msg.data, end_stream=msg.end)
+                        if msg.end:
+                            del uploads[msg.req_id], upload_held[msg.req_id]
+                        else:
+                            upload_held[msg.req_id] += len(msg.data)
+                continue
 
-        # re-arm timer
-        t = quic_conn.get_timer()
-        if timer is not None and timer != t:
-            timer = None
-        if timer is None and t is not None:
-            timer = t
+            # drain every queued datagram before sending anything
+            while True:
+                try:
+                    data, addr = key.fileobj.recvfrom(65535)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    logger.debug(f"{hostname}: receiving failed: {e}")
+                    terminated = True
+                    break
+                if not data:
+                    continue
+                if key.fileobj is sock_proxy:
+                    total_received_proxy += len(data)
+                else:
+                    total_received_without_proxy += len(data)
+                quic_conn.receive_datagram(data, addr[:2], now=time())     # IPv6 sockets add flow info and scope ID
 
         # handle timer
         if timer is not None and time() >= timer:
-            timer = None
             quic_conn.handle_timer(now=time())
 
         # process events
@@ -97,6 +338,8 @@ def quic_loop(
                 terminated = True
             elif isinstance(evt, aioquic.quic.events.HandshakeCompleted):
                 logger.debug(f"[event] handshake completed, negotiated protocols: {evt.alpn_protocol}")
+                early_accepted = evt.early_data_accepted
+                record_handshake(evt.session_resumed)
                 quic_conn.send_ping(41)
             elif isinstance(evt, aioquic.quic.events.PingAcknowledged):
                 logger.debug(f"[event] ping acked, uid={evt.uid}")
@@ -105,10 +348,22 @@ def quic_loop(
                 elif evt.uid == 41:
                     evt_connected.set()
                     connected = True
+                    if early_sent is not None:
+                        record_early_data(hostname, early_sent, early_accepted)
             elif isinstance(evt, aioquic.quic.events.StopSendingReceived):
-                logger.debug(f"[event] stop sending received")
+                logger.debug("[event] stop sending received")
+                if (req := req_map.get(evt.stream_id)) is not None and req.req_id in uploads:
+                    stop_upload(req.req_id, cancel=False)
             elif isinstance(evt, aioquic.quic.events.StreamDataReceived):
                 for evt in h3_conn.handle_event(evt):
+                    if isinstance(evt, (aioquic.h3.events.HeadersReceived, aioquic.h3.events.DataReceived)) and evt.stream_id not in req_map:
+                        continue    # cancelled, what was in flight still arrives
+
+                    if isinstance(evt, (aioquic.h3.events.HeadersReceived, aioquic.h3.events.DataReceived)) and evt.stream_ended:
+                        # response complete before the request body, cancel the rest of the upload
+                        if (req_id := req_map[evt.stream_id].req_id) in uploads:
+                            stop_upload(req_id, cancel=True)
+
                     if isinstance(evt, aioquic.h3.events.HeadersReceived):
                         # create new response object
                         headers = {k: v for k, v in evt.headers}
@@ -120,81 +375,61 @@ def quic_loop(
                             req_id=req.req_id,
                             body=None
                         )
-                        resp_map[evt.stream_id] = resp
-
-                        if evt.stream_ended:
+                        if req.stream:
+                            # forward headers right away, body follows as BodyChunks
                             res_q.put(resp)
+                            if evt.stream_ended:
+                                res_q.put(BodyChunk(req.req_id, b'', True))
+                        else:
+                            resp_map[evt.stream_id] = resp
+                            body_map[evt.stream_id] = []
                     elif isinstance(evt, aioquic.h3.events.DataReceived):
-                        res = resp_map[evt.stream_id]
-                        if res.body is None:
-                            res.body = evt.data
+                        req = req_map[evt.stream_id]
+                        if req.stream:
+                            quic_conn.delivered(evt.stream_id, len(evt.data))
+                            res_q.put(BodyChunk(req.req_id, evt.data, evt.stream_ended))
                         else:
-                            res.body += evt.data
-
-                        if evt.stream_ended:
-                            res_q.put(res)
+                            body_map[evt.stream_id].append(evt.data)
                     else:
                         logging.debug(f"unknown H3 event: {evt}")
+                        continue
+
+                    if evt.stream_ended:
+                        req = req_map.pop(evt.stream_id)
+                        if req.stream:
+                            del stream_map[req.req_id]
+                            quic_conn.finished(evt.stream_id)
+                        else:
+                            resp = resp_map.pop(evt.stream_id)
+                            if (body := body_map.pop(evt.stream_id)):
+                                resp.body = b''.join(body)
+                            res_q.put(resp)
+                        flush_stats()
             else:
                 logging.debug(f"unknown QUIC event: {evt}")
 
-        # receive data from proxy socket
-        try:
-            data, addr = sock_proxy.recvfrom(65535)
-
-            if data:
-                total_received_proxy += len(data)
-                quic_conn.receive_datagram(data, addr, now=time())
-        except BlockingIOError:
-            pass
+        # send HTTP/3 requests once connection is established, safe ones right away as 0-RTT early data if resuming
+        for req in [req for req in pending if connected or (early_data and early_safe(req))]:
+            pending.remove(req)
+            if not connected and early_sent is None:
+                early_sent = time()
 
-        # receive data from socket
-        try:
-            data, addr = sock.recvfrom(65535)
+            # create new bidi stream
+            stream_id = quic_conn.get_next_available_stream_id(is_unidirectional=False)
+            req_map[stream_id] = req
+            if req.stream:
+                stream_map[req.req_id] = stream_id
             
-            if data:
-                total_received_without_proxy += len(data)
-                quic_conn.receive_datagram(data, addr, now=time())
-        except BlockingIOError:
-            pass
-                    
-        # send HTTP/3 GET request once connection is established
-        if connected:
-            try:
-                # create new bidi stream
-                req = cast(Request, req_q.get_nowait())
-                stream_id = quic_conn.get_next_available_stream_id(is_unidirectional=False)
-                url = urlparse(req.url)
-                req_map[stream_id] = req
-                
-                # prepare request header
-                assert url.hostname is not None
-                if len(url.query) > 0:
-                    path = url.path + '?' + url.query
-                else:
-                    path = url.path
-                headers = {
-                    b':method': req.method.encode(),
-                    b':scheme': b'https',
-                    b':authority': url.hostname.encode(),
-                    b':path': path.encode(),
-                    b'user-agent': b'snic/0.1',
-                    b'accept': b'*/*',
-                    **req.header
-                }
-                headers = {k.lower(): v for k, v in headers.items()}    # normalize
-                if b'connection' in headers:
-                    del headers[b'connection']
-                if b'host' in headers:
-                    del headers[b'host']
-                
-                # send GET request using stream
-                h3_conn.send_headers(stream_id, list(headers.items()), end_stream=(req.body is None))
-                if req.body is not None:
-                    h3_conn.send_data(stream_id, req.body, end_stream=True)
-                logging.debug(f"{req.method} {req.url} (stream id: {stream_id})")
-            except queue.Empty:
-                pass
+            # send GET request using stream
+            h3_conn.send_headers(stream_id, h3_request_headers(req), end_stream=(req.body is None and req.body_stream is None))
+            if req.body is not None:
+                h3_conn.send_data(stream_id, req.body, end_stream=True)
+            elif req.body_stream is not None:
+                # body follows as BodyChunks, the uploader may start with a full window
+                uploads[req.req_id] = stream_id
+                upload_held[req.req_id] = 0
+                res_q.put(BodyAck(req.req_id, conf.stream_window))
+            logging.debug(f"{req.method} {req.url} (stream id: {stream_id})")
 
         # trigger migration once connection is established
         if connected and not migrated:
@@ -207,15 +442,19 @@ def quic_loop(
             quic_conn.close()
             terminated = True
 
-    logging.debug(f"{hostname}: QUIC loop terminated")
-    stat.increase_total_sent_proxy(total_sent_proxy)
-    stat.increase_total_received_proxy(total_received_proxy)
-    stat.increase_total_sent_snic(total_sent_without_proxy)
-    stat.increase_total_received_snic(total_received_without_proxy)
+    # flush CONNECTION_CLOSE
+    try:
+        for data, addr in quic_conn.datagrams_to_send(now=time()):
+            (sock if migrated else sock_proxy).sendto(data, addr)
+    except OSError:
+        pass    # the path failed, the peer times out instead
+    selector.close()
+    flush_stats()
 
 class SNICConnection:
     def __init__(self, hostname: str, dst_addr: tuple[str, int], proxy_addr: tuple[str, int]):
-        self.req_q = multiprocessing.Queue()
+        self.req_r, self.req_w = multiprocessing.Pipe(duplex=False)
+        self.req_lock = threading.Lock()
         self.res_q = multiprocessing.Queue()
         self.evt_connected = multiprocessing.Event()
         self.evt_migrated = multiprocessing.Event()
@@ -224,11 +463,31 @@ class SNICConnection:
         self.dst_addr = dst_addr
         self.proxy_addr = proxy_addr
         self.proc = None
-        self.responses: dict[int, Response] = {}    # key: request ID, value: response
+        self.messages: dict[int, list] = {}     # key: request ID, value: responses / body chunks not yet consumed
+        self.res_cond = threading.Condition()
+        self.res_reading = False    # whether a thread is blocked on res_q
+        self.terminated = False
+        self.cancelled: set[int] = set()    # request IDs cancelled, until quic_loop confirms
+        self.early: Optional[int] = None    # request ID of the request sent as 0-RTT early data, until fetched
+
+        # bookkeeping for SNICConnectionPool
+        self.created = time()
+        self.last_used = self.created
+        self.streams = 0
+        self.in_flight = 0
+
+    @property
+    def key(self) -> tuple[str, str, int]:
+        return (self.hostname, self.dst_addr[0], self.dst_addr[1])
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.is_alive() and not self.terminated
     
-    async def connect(self, timeout: Optional[float] = None) -> bool:        
+    async def connect(self, timeout: Optional[float] = None, early: Optional[Request] = None) -> bool:
+        """ early is sent right away as 0-RTT early data if the connection resumes a session that allows it """
+        ticket = quic_tickets.store.take(self.hostname)
         self.proc = multiprocessing.Process(target=quic_loop, args=(
-            self.req_q,
+            self.req_r,
             self.res_q,
             self.evt_connected,
             self.evt_migrated,
@@ -237,48 +496,378 @@ class SNICConnection:
             self.dst_addr,
             self.proxy_addr[0],
             self.proxy_addr[1],
+            ticket,
         ))
         self.proc.start()
-        return await asyncio.to_thread(lambda: self.evt_connected.wait(timeout))
+        if early is not None and early_data_allowed(ticket) and early_safe(early):
+            self._send_request(early)
+            self.early = early.req_id
+        connected = await asyncio.to_thread(lambda: self.evt_connected.wait(timeout))
+        return connected and not self.evt_terminate.is_set()
 
-    async def check_migration(self, timeout: float) -> bool:
-        return await asyncio.to_thread(lambda: self.evt_migrated.wait(timeout))
+    async def check_migration(self, timeout: Optional[float] = None) -> bool:
+        migrated = await asyncio.to_thread(lambda: self.evt_migrated.wait(timeout))
+        return migrated and not self.evt_terminate.is_set()
 
-    async def fetch(self, req: Request):
-        self.req_q.put(req)
-        return await asyncio.to_thread(self._recv_response, req)
+    async def fetch(self, req: Request) -> Optional[Response]:
+        if self.early == req.req_id:
+            self.early = None   # sent already by connect()
+        elif req.body_stream is None:
+            self._send_request(req)
+        else:
+            # generators don't pickle, an empty body_stream tells quic_loop that BodyChunks follow
+            self._send_request(replace(req, body_stream=()))
+            try:
+                await asyncio.to_thread(self._upload, req.req_id, req.body_stream)
+            except BaseException:
+                # the request body broke off (the client disconnected, a bad chunk size), so does the request
+                self.cancel(req.req_id)
+                raise
+        res = await asyncio.to_thread(self._recv_message, req.req_id)
+        if res is not None and req.stream:
+            res.body_stream = self._body_stream(req.req_id)
+        else:
+            self._forget(req.req_id)
+        return res
 
-    def _recv_response(self, req: Request):
-        if req.req_id in self.responses:
-            return self.responses[req.req_id]
-        
-        while (res := self.res_q.get()):
-            self.responses[res.req_id] = res
-            if res.req_id == req.req_id:
-                return res
+    def _upload(self, req_id: int, body_stream: Generator[bytes, None, None]):
+        """ sends a request body as BodyChunks, never more than the QUIC loop has granted """
+        # the first grant comes once the request stream is open
+        ack = self._recv_message(req_id, BodyAck)
+        if ack is None or ack.size == 0:
+            return
+        credit = ack.size
+        for data in body_stream:
+            credit -= len(data)
+            while credit < 0:
+                ack = self._recv_message(req_id, BodyAck)
+                if ack is None or ack.size == 0:
+                    return
+                credit += ack.size
+            self._send_request(BodyChunk(req_id, data, False))
+        self._send_request(BodyChunk(req_id, b'', True))
 
-    async def close(self):
+    def _body_stream(self, req_id: int) -> Generator[bytes, None, None]:
+        unacked = 0
+        finished = False    # the whole body arrived, or the connection terminated
+        try:
+            while (chunk := self._recv_message(req_id)) is not None:
+                if chunk.data:
+                    yield chunk.data
+                if chunk.end:
+                    finished = True
+                    return
+
+                # consumer asked for more, give the QUIC loop its window back in batches
+                unacked += len(chunk.data)
+                if unacked >= conf.stream_window // 4:
+                    self._send_request(BodyAck(req_id, unacked))
+                    unacked = 0
+            finished = True
+            raise ConnectionError(f"{self.hostname}: QUIC connection terminated while streaming response")
+        finally:
+            # closed by the consumer before the end, e.g. the client went away or the response lost a race
+            if finished:
+                self._forget(req_id)
+            else:
+                self.cancel(req_id)
+
+    def _recv_message(self, req_id: int, kind: Union[type, tuple[type, ...]] = (Response, BodyChunk)):
+        # several threads may share this connection; only one of them reads res_q
+        # at a time and hands messages for other requests over through self.messages
+        with self.res_cond:
+            while (msg := self._take_message(req_id, kind)) is None:
+                if self.terminated:
+                    return None
+                if self.res_reading:
+                    self.res_cond.wait()
+                    continue
+
+                self.res_reading = True
+                self.res_cond.release()
+                try:
+                    msg = self._get_result()
+                finally:
+                    self.res_cond.acquire()
+                    self.res_reading = False
+
+                if msg is None:
+                    self.terminated = True
+                elif isinstance(msg, NewTicket):
+                    quic_tickets.store.add(msg.ticket)
+                elif isinstance(msg, Cancel):
+                    self.cancelled.discard(msg.req_id)     # nothing more comes for the request
+                elif msg.req_id not in self.cancelled:
+                    self.messages.setdefault(msg.req_id, []).append(msg)
+                self.res_cond.notify_all()
+            return msg
+
+    def _get_result(self):
+        """ next message of quic_loop, None once it is gone, even if it died without saying so (e.g. killed) """
+        while True:
+            try:
+                return self.res_q.get(timeout=RESULT_POLL_INTERVAL)
+            except queue.Empty:
+                if self.proc is not None and self.proc.is_alive():
+                    continue
+            # what it sent before exiting is still in the queue
+            try:
+                return self.res_q.get_nowait()
+            except queue.Empty:
+                return None
+
+    def _take_message(self, req_id: int, kind: Union[type, tuple[type, ...]]):
+        msgs = self.messages.get(req_id, [])
+        for i, msg in enumerate(msgs):
+            if isinstance(msg, kind):
+                del msgs[i]
+                if not msgs:
+                    del self.messages[req_id]
+                return msg
+        return None
+
+    def _forget(self, req_id: int):
+        """ drops upload grants left over once a response is complete """
+        with self.res_cond:
+            self.messages.pop(req_id, None)
+
+    def cancel(self, req_id: int):
+        """ stops the stream of a request whose response is no longer read """
+        with self.res_cond:
+            self.messages.pop(req_id, None)
+            if self.terminated:
+                return
+            self.cancelled.add(req_id)
+        self._send_request(Cancel(req_id))
+
+    def terminate(self):
+        """ asks the connection to close without waiting for it """
         self.evt_terminate.set()
+        self._send_request(None)
+
+    def _send_request(self, msg: Union[Request, BodyChunk, BodyAck, Cancel, None]):
+        # pickled requests may exceed PIPE_BUF, so writers must not interleave
+        with self.req_lock:
+            self.req_w.send(msg)
+
+    async def close(self):
+        self.terminate()
         await asyncio.to_thread(self._wait_join)
 
     def _wait_join(self):
         assert self.proc is not None
         self.proc.join()
 
-def fetch(req: Request, proxy_config: tuple[str, int]) -> Response:
-    # resolve hostname into ip
+def new_connection(hostname: str, dst_addr: tuple[str, int], proxy_addr: tuple[str, int]):
+    """ creates a SNICConnection, or its QuicEngine counterpart if conf.snic_engine is 'asyncio' """
+    if conf.snic_engine == 'asyncio':
+        from proxy.quic_engine import EngineSNICConnection  # imports this module
+        return EngineSNICConnection(hostname, dst_addr, proxy_addr)
+    return SNICConnection(hostname, dst_addr, proxy_addr)
+
+async def connect_fastest(
+    hostname: str,
+    ips: list[str],
+    port: int,
+    proxy_addr: tuple[str, int],
+    timeout: Optional[float] = None,
+    migrate: bool = False,
+    early: Optional[Request] = None,
+):
+    """
+    Happy Eyeballs over SNIC: starts a connection per address, conf.happy_eyeballs_delay apart.
+    The first one to connect (and migrate, with migrate set) is returned, the others are closed.
+    Returns None if every address fails.
+    The first attempt sends early as 0-RTT early data when it can, fetch() it on the returned connection.
+    """
+    start = time()
+
+    def remaining() -> Optional[float]:
+        return None if timeout is None else max(0, timeout - (time() - start))
+
+    async def attempt(conn, early: Optional[Request]) -> bool:
+        if not await conn.connect(remaining(), early):
+            return False
+        timings[conn] = [time()]
+        if migrate and not await conn.check_migration(remaining()):
+            return False
+        timings[conn].append(time())
+        return True
+
+    attempts: dict[asyncio.Future, SNICConnection] = {}
+    timings: dict[SNICConnection, list[float]] = {}     # value: when the handshake completed, then when migrated
+    pending: set[asyncio.Future] = set()
+    # the connection moves off the proxy, so only addresses this host can reach directly are worth a try
+    addrs = [ip for ip in happy_eyeballs.order(hostname, ips) if happy_eyeballs.routable(ip)]
+    if len(addrs) < len(ips):
+        logger.log(logging.DEBUG, f"{hostname}: skipping addresses without a route: {[ip for ip in ips if ip not in addrs]}")
+    winner = None
+    while winner is None and (addrs or pending):
+        if addrs:
+            conn = new_connection(hostname, (addrs.pop(0), port), proxy_addr)
+            task = asyncio.ensure_future(attempt(conn, None if attempts else early))
+            attempts[task] = conn
+            pending.add(task)
+        done, pending = await asyncio.wait(
+            pending,
+            timeout=conf.happy_eyeballs_delay if addrs else None,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in done:
+            if task.exception() is None and task.result() and winner is None:
+                winner = attempts[task]
+
+    # close the attempts that lost, which also ends those still pending
+    await asyncio.gather(*(conn.close() for conn in attempts.values() if conn is not winner))
+    await asyncio.gather(*pending, return_exceptions=True)
+    if winner is not None:
+        connected, migrated = timings[winner]
+        stat.record_connect('snic', connected - start)
+        tracing.phase('quic_handshake', connected - start)
+        if migrate:
+            # until the ping sent over the new path is acknowledged
+            stat.record_migration(migrated - connected)
+            tracing.phase('migration', migrated - connected)
+        happy_eyeballs.record_winner(hostname, winner.dst_addr[0])
+        logger.log(logging.DEBUG, f"{hostname}: {winner.dst_addr[0]} won out of {len(attempts)} attempt(s)")
+    return winner
+
+class SNICConnectionPool:
+    """
+    Keeps migrated SNICConnections open so that requests to the same (hostname, ip, port)
+    share a connection instead of paying for a handshake and migration every time.
+    Connections are evicted once idle for too long, too old, or out of streams.
+    """
+    def __init__(self):
+        self.conns: dict[tuple[str, str, int], list[SNICConnection]] = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def _usable(self, conn: SNICConnection, now: float) -> bool:
+        return (
+            conn.is_alive()
+            and conn.streams < conf.snic_pool_max_streams
+            and now - conn.created < conf.snic_pool_max_age
+        )
+
+    def acquire(self, key: tuple[str, str, int]) -> Optional[SNICConnection]:
+        now = time()
+        with self.lock:
+            for conn in self.conns.get(key, []):
+                if self._usable(conn, now):
+                    conn.streams += 1
+                    conn.in_flight += 1
+                    conn.last_used = now
+                    return conn
+        return None
+
+    def put(self, conn: SNICConnection, idle: bool = False):
+        """ adds a connected connection to the pool, acquired for one request unless idle """
+        with self.lock:
+            if not idle:
+                conn.streams += 1
+                conn.in_flight += 1
+            conn.last_used = time()
+            self.conns.setdefault(conn.key, []).append(conn)
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap, daemon=True)
+                self.reaper.start()
+
+    def has(self, key: tuple[str, str, int]) -> bool:
+        now = time()
+        with self.lock:
+            return any(self._usable(conn, now) for conn in self.conns.get(key, []))
+
+    def release(self, conn: SNICConnection):
+        with self.lock:
+            conn.in_flight -= 1
+            conn.last_used = time()
+
+    def fetch(self, conn: SNICConnection, req: Request) -> Optional[Response]:
+        """ fetches req on conn acquired for it, released once the response is consumed (right away if the fetch fails) """
+        try:
+            res = asyncio.run(conn.fetch(req))
+        except BaseException:
+            # e.g. the client's request body broke off while uploading
+            self.release(conn)
+            raise
+        if res is None or res.body_stream is None:
+            self.release(conn)
+        else:
+            res.body_stream = self._release_when_done(conn, res.body_stream)
+        return res
+
+    def _release_when_done(self, conn: SNICConnection, body_stream: Generator[bytes, None, None]) -> Generator[bytes, None, None]:
+        try:
+            yield from body_stream
+        finally:
+            self.release(conn)
+
+    def _evict(self, now: float) -> list[SNICConnection]:
+        evicted = []
+        with self.lock:
+            for key, conns in list(self.conns.items()):
+                for conn in conns:
+                    if not conn.is_alive():
+                        evicted.append(conn)
+                    elif conn.in_flight == 0 and (
+                        now - conn.last_used > conf.snic_pool_idle_timeout
+                        or not self._usable(conn, now)
+                    ):
+                        evicted.append(conn)
+                remaining = [conn for conn in conns if conn not in evicted]
+                if remaining:
+                    self.conns[key] = remaining
+                else:
+                    del self.conns[key]
+        return evicted
+
+    def _reap(self):
+        while True:
+            sleep(1)
+            for conn in self._evict(time()):
+                logger.log(logging.DEBUG, f"{conn.hostname}: evicting pooled SNIC connection ({conn.streams} streams)")
+                asyncio.run(conn.close())
+
+    def close_all(self):
+        with self.lock:
+            conns = [conn for conns in self.conns.values() for conn in conns]
+            self.conns.clear()
+        # runs at interpreter exit, where asyncio.to_thread is no longer available
+        for conn in conns:
+            conn.terminate()
+        for conn in conns:
+            conn._wait_join()
+
+pool = SNICConnectionPool()
+atexit.register(pool.close_all)
+
+def fetch(req: Request, proxy_config: tuple[str, int], port: Optional[int] = None) -> Response:
+    """ port overrides the one of the URL, for HTTP/3 advertised elsewhere with Alt-Svc """
+    # resolve hostname into ips
     url = urlparse(req.url)
     assert url.hostname is not None
     dns_server_config = (conf.dns_server_addr, conf.dns_server_port)
-    ip = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
-    port = 443 if url.port is None else url.port
+    ips = asyncio.run(dns.resolve(url.hostname, dns_server_config, proxy_config))
+    if port is None:
+        port = 443 if url.port is None else url.port
 
-    # fetch resource using SNIC
-    assert url.hostname is not None
-    conn = SNICConnection(url.hostname, (ip, port), proxy_config)
-    asyncio.run(conn.connect())
-    res = asyncio.run(conn.fetch(req))
+    # reuse pooled connection to any of the addresses if possible
+    conn = next((conn for ip in ips if (conn := pool.acquire((url.hostname, ip, port))) is not None), None)
+    if conn is not None:
+        res = pool.fetch(conn, req)
+        if res is not None:
+            return res
+        if req.body_stream is not None and getgeneratorstate(req.body_stream) != GEN_CREATED:
+            raise ConnectionError(f"{url.hostname}: pooled SNIC connection terminated while uploading request body")
+        logger.log(logging.DEBUG, f"{url.hostname}: pooled SNIC connection terminated, reconnecting")
+
+    # fetch resource using new SNIC connection to the fastest address
+    conn = asyncio.run(connect_fastest(url.hostname, ips, port, proxy_config, early=req))
+    if conn is None:
+        raise ConnectionError(f"{url.hostname}: QUIC connection failed")
+    pool.put(conn)
+    res = pool.fetch(conn, req)
     assert isinstance(res, Response)
-    asyncio.run(conn.close())
 
     return res
@@ -0,0 +1,98 @@
+# happy eyeballs (RFC 8305):
+#   - order the addresses of a host: the one that won last time first, then alternating address families,
+#     IPv6 first unless this host has no route for it
+#   - race connection attempts over them, each started conf.happy_eyeballs_delay after the previous one
+#     (or right away when the previous one fails)
+#   - record the winner per host
+
+import logging
+import queue
+import socket
+import socks
+import threading
+from typing import Optional
+
+from proxy.config import conf
+
+logger = logging.getLogger(__name__)
+
+winners: dict[str, str] = dict()    # key: hostname, value: address that won the last race
+lock_winners = threading.Lock()
+
+def record_winner(hostname: str, ip: str):
+    with lock_winners:
+        winners[hostname] = ip
+
+def is_ipv6(ip: str) -> bool:
+    return ':' in ip
+
+def routable(ip: str) -> bool:
+    """ whether this host has a route to ip; connecting a UDP socket looks the route up without sending anything """
+    try:
+        with socket.socket(socket.AF_INET6 if is_ipv6(ip) else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((ip, 443))
+    except OSError:
+        return False
+    return True
+
+def order(hostname: str, ips: list[str]) -> list[str]:
+    """ last winner first, then alternating families starting with the winner's (without one, IPv6 if it is routable) """
+    with lock_winners:
+        winner = winners.get(hostname)
+    v6 = [ip for ip in ips if is_ipv6(ip) and ip != winner]
+    v4 = [ip for ip in ips if not is_ipv6(ip) and ip != winner]
+    v6_first = is_ipv6(winner) if winner is not None else bool(v6) and routable(v6[0])
+    first, second = (v6, v4) if v6_first else (v4, v6)
+    ordered = [winner] if winner in ips else []
+    for i in range(max(len(first), len(second))):
+        ordered += first[i:i + 1] + second[i:i + 1]
+    return ordered
+
+def create_connection(hostname: str, ips: list[str], port: int, proxy_config: tuple[str, int]) -> socket.socket:
+    """ TCP connection through the SOCKS5 proxy to whichever of ips answers first """
+    results: queue.Queue = queue.Queue()
+
+    def attempt(ip: str):
+        try:
+            sock = socks.create_connection(
+                (ip, port),
+                proxy_type=socks.SOCKS5,
+                proxy_addr=proxy_config[0],
+                proxy_port=proxy_config[1]
+            )
+        except OSError as e:
+            results.put((ip, None, e))
+        else:
+            results.put((ip, sock, None))
+
+    remaining = order(hostname, ips)
+    running = 0
+    error: Optional[OSError] = None
+    while remaining or running:
+        if remaining:
+            threading.Thread(target=attempt, args=(remaining.pop(0),), daemon=True).start()
+            running += 1
+        try:
+            ip, sock, e = results.get(timeout=conf.happy_eyeballs_delay if remaining else None)
+        except queue.Empty:
+            continue    # too slow, start the next attempt alongside
+        running -= 1
+        if sock is None:
+            logger.log(logging.DEBUG, f"{hostname}: connecting to {ip} failed: {e}")
+            error = e
+            continue
+
+        record_winner(hostname, ip)
+        if running:
+            threading.Thread(target=_close_late, args=(results, running), daemon=True).start()
+        return sock
+
+    assert error is not None
+    raise error
+
+def _close_late(results: queue.Queue, running: int):
+    # attempts that lost the race may still connect
+    for _ in range(running):
+        _, sock, _ = results.get()
+        if sock is not None:
+            sock.close()
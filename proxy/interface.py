@@ -1,6 +1,8 @@
-from typing import Optional
+from typing import Generator, Optional
 from dataclasses import dataclass
 
+from proxy.tracing import Trace
+
 @dataclass
 class Request:
     method: str
@@ -8,6 +10,9 @@ class Request:
     header: dict[bytes, bytes]
     req_id: int
     body: Optional[bytes] = None
+    stream: bool = False    # return as soon as headers arrive, with the body in Response.body_stream
+    body_stream: Optional[Generator[bytes, None, None]] = None    # body sent upstream as it is read, instead of body
+    trace: Optional[Trace] = None   # timings of this request, if it is traced (see proxy/tracing.py)
 
 @dataclass
 class Response:
@@ -16,3 +21,4 @@ class Response:
     headers: dict[bytes, bytes]
     req_id: int
     body: Optional[bytes] = None
+    body_stream: Optional[Generator[bytes, None, None]] = None
@@ -0,0 +1,256 @@
+# metrics of the proxy (defined in proxy/stat.py), served in Prometheus text format on conf.metrics_port:
+#   - every thread adds to its own shard of a metric without taking a lock, shards are summed when read,
+#     shards of threads that ended are folded into the metric once
+#   - processes forked for SNIC connections add to a shared-memory total of each unlabeled counter instead,
+#     one per proxy process, which is part of its sum as well (labeled metrics and histograms are only kept
+#     by proxy processes)
+#   - workers of a multi-worker proxy publish their sums to the shared cache (see proxy/shared_cache.py)
+#     every PUBLISH_INTERVAL, metrics read in one process include the latest sums of the others
+
+import bisect
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Value
+from time import sleep, time
+from typing import Optional
+
+from proxy.config import conf
+from proxy.shared_cache import cache as shared_cache
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_INTERVAL = 1    # seconds between the sums a worker publishes
+MAX_PUBLISHED = 1024    # sums of workers kept, those of the oldest workers that exited go first
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)   # seconds
+
+registry: list["Metric"] = []
+forked = False      # in a process forked from the one that owns the shards, e.g. a SNIC connection
+worker_key: Optional[str] = None    # key of the sums this worker publishes
+server: Optional[ThreadingHTTPServer] = None
+
+def _after_fork():
+    global forked
+    forked = True
+
+os.register_at_fork(after_in_child=_after_fork)
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.shards: list[tuple[threading.Thread, dict]] = []
+        self.retired: dict = {}     # sums of the shards of threads that ended
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self._fold()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold(self):
+        # a thread that ended writes no more, its shard can be merged without racing it
+        for thread, shard in [entry for entry in self.shards if not entry[0].is_alive()]:
+            self.shards.remove((thread, shard))
+            self._merge(self.retired, shard)
+
+    def _merge(self, into: dict, values: dict):
+        raise NotImplementedError
+
+    def collect(self) -> dict:
+        """ sum of the shards of this process, key: label values """
+        total: dict = {}
+        with self.lock:
+            self._fold()
+            self._merge(total, self.retired)
+            shards = [dict(shard) for _, shard in self.shards]
+        for shard in shards:
+            self._merge(total, shard)
+        return total
+
+    def reset(self):
+        """ forgets the shards inherited from the parent process """
+        with self.lock:
+            self.local = threading.local()
+            self.shards = []
+            self.retired = {}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        # made at import, before any process is forked
+        self.shared = Value('d', 0, lock=True) if not labels else None
+
+    def inc(self, by: float = 1, *label_values: str):
+        if forked:
+            if self.shared is not None:
+                with self.shared.get_lock():
+                    self.shared.value += by
+            return
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + by
+
+    @property
+    def value(self) -> float:
+        """ total of an unlabeled counter in every process """
+        return collect([self])[self.name].get((), 0)
+
+    @property
+    def local_value(self) -> float:
+        """ total of an unlabeled counter in this process and the ones forked for its SNIC connections """
+        return local_totals(self).get((), 0)
+
+    def reset(self):
+        super().reset()
+        if self.shared is not None:
+            # the one made at import is inherited by every worker
+            self.shared = Value('d', 0, lock=True)
+
+    def _merge(self, into: dict, values: dict):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values: str):
+        if forked:
+            return
+        shard = self._shard()
+        if (counts := shard.get(label_values)) is None:
+            # count per bucket (the last one is +Inf), then sum
+            counts = shard[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, into: dict, values: dict):
+        for key, counts in values.items():
+            if (total := into.get(key)) is None:
+                into[key] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+def local_totals(metric: Metric) -> dict:
+    """ sums of this process and the ones forked for its SNIC connections, key: label values """
+    totals = metric.collect()
+    if isinstance(metric, Counter) and metric.shared is not None and metric.shared.value:
+        totals[()] = totals.get((), 0) + metric.shared.value
+    return totals
+
+def snapshot() -> dict[str, dict[str, object]]:
+    """ sums of this process and its SNIC connections, JSON-serializable (label values as a JSON list) """
+    return {metric.name: {json.dumps(key): value for key, value in local_totals(metric).items()} for metric in registry}
+
+def collect(metrics_to_collect: Optional[list[Metric]] = None) -> dict[str, dict[tuple, object]]:
+    """ sums of every process: this one, the ones forked for SNIC connections, and the other workers """
+    metrics = {metric.name: metric for metric in metrics_to_collect or registry}
+    totals = {name: local_totals(metric) for name, metric in metrics.items()}
+    for published_key, published in shared_cache.items('metrics'):
+        if published_key == worker_key:
+            continue    # already summed, and more recent
+        for name, values in published.items():
+            if name in metrics:
+                metrics[name]._merge(totals[name], {tuple(json.loads(key)): value for key, value in values.items()})
+    return totals
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _label_text(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render() -> str:
+    """ every metric in Prometheus text exposition format """
+    totals = collect()
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        values = totals[metric.name]
+        if isinstance(metric, Histogram):
+            for key, counts in sorted(values.items()):
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, float('inf')), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f"{metric.name}_bucket{_label_text(metric.labels, key, le)} {cumulative}")
+                lines.append(f"{metric.name}_sum{_label_text(metric.labels, key)} {_number(counts[-1])}")
+                lines.append(f"{metric.name}_count{_label_text(metric.labels, key)} {cumulative}")
+        else:
+            if not values and not metric.labels:
+                values = {(): 0}
+            for key, value in sorted(values.items()):
+                lines.append(f"{metric.name}{_label_text(metric.labels, key)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+def publish():
+    # kept after the worker exits, counters of a restarted worker must not go back
+    assert worker_key is not None
+    shared_cache.put('metrics', worker_key, snapshot(), float('inf'), MAX_PUBLISHED)
+
+def _publish_periodically():
+    while True:
+        sleep(PUBLISH_INTERVAL)
+        publish()
+
+def start_worker():
+    """ called by each worker after the fork, which makes it the owner of new shards """
+    global forked, worker_key
+    forked = False
+    worker_key = f"{os.getpid()}.{time()}"     # pids get reused
+    for metric in registry:
+        metric.reset()
+    if server is not None:
+        # inherited by a worker restarted after the parent started serving
+        server.socket.close()
+    threading.Thread(target=_publish_periodically, name='metrics-publish', daemon=True).start()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.log(logging.DEBUG, f"[metrics] {format % args}")
+
+def serve() -> Optional[ThreadingHTTPServer]:
+    """ serves /metrics on conf.metrics_host:conf.metrics_port in the background, if the port is set """
+    global server
+    if conf.metrics_port is None:
+        return None
+    server = ThreadingHTTPServer((conf.metrics_host, conf.metrics_port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Metrics served on http://{conf.metrics_host}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,178 @@
+# speculative prefetch (conf.prefetch):
+#   - scan text/html responses for hosts of subresources (src, <link href>), preconnect and dns-prefetch hints
+#   - warm those hosts in the background before the browser asks for them:
+#     preconnect and subresource hosts get a connection, dns-prefetch and <a href> hosts only a DNS lookup
+#   - scanning never delays the response, and warming is limited by conf.prefetch_concurrency
+#     and conf.prefetch_max_hosts per page
+
+import codecs
+import logging
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Callable, Generator, Optional
+from urllib.parse import urljoin, urlparse
+
+from proxy.config import conf
+from proxy.interface import Response
+
+logger = logging.getLogger(__name__)
+
+SCAN_LIMIT = 256 * 1024     # bytes of a page scanned, hints and most subresources come early
+MAX_PENDING = 64            # hosts waiting to be warmed, more are dropped instead of warmed late
+
+def header_value(headers: dict[bytes, bytes], name: bytes) -> bytes:
+    return next((v for k, v in headers.items() if k.lower() == name), b'')
+
+class _LinkParser(HTMLParser):
+    """ reports (hostname, connect) for every URL of another host found in a page """
+    def __init__(self, page_url: str, found: Callable[[str, bool], None]):
+        super().__init__(convert_charrefs=True)
+        self.page_url = page_url
+        self.page_host = urlparse(page_url).hostname
+        self.found = found
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v for k, v in attrs if v is not None}
+        if tag == 'link':
+            rel = attrs.get('rel', '').lower().split()
+            self.url(attrs.get('href'), connect='dns-prefetch' not in rel)
+        elif tag == 'a':
+            self.url(attrs.get('href'), connect=False)
+        self.url(attrs.get('src'), connect=True)
+
+    def url(self, value: Optional[str], connect: bool):
+        if not value:
+            return
+        try:
+            url = urlparse(urljoin(self.page_url, value.strip()))
+            port = url.port
+        except ValueError:
+            return
+        if url.scheme not in ('http', 'https') or url.hostname is None or url.hostname == self.page_host:
+            return
+        # SNIC connections are only made to https on the default port
+        self.found(url.hostname, connect and url.scheme == 'https' and port in (None, 443))
+
+class PageScan:
+    """ feeds one page to a _LinkParser on the scan thread, in order and up to SCAN_LIMIT bytes """
+    def __init__(self, prefetcher: "Prefetcher", page_url: str, content_encoding: bytes, proxy_config: tuple[str, int]):
+        self.prefetcher = prefetcher
+        self.proxy_config = proxy_config
+        self.parser = _LinkParser(page_url, self.found)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # gzip or zlib (wbits 47 detects which), raw bytes otherwise
+        self.decompressor = zlib.decompressobj(47) if content_encoding in (b'gzip', b'deflate') else None
+        self.hosts: dict[str, bool] = {}    # key: hostname, value: connect
+        self.chunks: deque[bytes] = deque()
+        self.scanned = 0
+        self.draining = False
+        self.lock = threading.Lock()
+
+    def feed(self, chunk: bytes):
+        with self.lock:
+            if self.scanned >= SCAN_LIMIT:
+                return
+            self.scanned += len(chunk)
+            self.chunks.append(chunk)
+            if self.draining:
+                return
+            self.draining = True
+        self.prefetcher.scan_executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.chunks:
+                    self.draining = False
+                    return
+                chunk = self.chunks.popleft()
+            try:
+                if self.decompressor is not None:
+                    chunk = self.decompressor.decompress(chunk, SCAN_LIMIT)
+                self.parser.feed(self.decoder.decode(chunk))
+            except Exception as e:
+                # nothing depends on the scan, a page it cannot read is simply not prefetched
+                logger.log(logging.DEBUG, f"[prefetch] stopped scanning {self.parser.page_url}: {e}")
+                with self.lock:
+                    self.chunks.clear()
+                    self.scanned = SCAN_LIMIT
+                    self.draining = False
+                return
+
+    def found(self, hostname: str, connect: bool):
+        # a host counts once towards the cap, but one found for DNS only may still get a connection
+        if hostname in self.hosts:
+            if not connect or self.hosts[hostname]:
+                return
+        elif len(self.hosts) >= conf.prefetch_max_hosts:
+            return
+        self.hosts[hostname] = connect
+        self.prefetcher.schedule(hostname, connect, self.proxy_config)
+
+class Prefetcher:
+    """
+    Scans HTML responses on a thread of its own and warms the hosts they reference
+    with warm(hostname, connect, proxy_config) on conf.prefetch_concurrency worker threads.
+    """
+    def __init__(self, warm: Callable[[str, bool, tuple[str, int]], None]):
+        self.warm = warm
+        self.pending: dict[str, bool] = {}  # key: hostname, value: connect
+        self.lock = threading.Lock()
+        self.scan_executor: Optional[ThreadPoolExecutor] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def _start(self):
+        self.scan_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch-scan')
+        self.executor = ThreadPoolExecutor(max_workers=conf.prefetch_concurrency, thread_name_prefix='prefetch')
+
+    def scan(self, res: Response, proxy_config: tuple[str, int]) -> Response:
+        """ starts scanning res if it is an HTML page, returning it unchanged otherwise """
+        content_type = header_value(res.headers, b'content-type').split(b';')[0].strip().lower()
+        if res.status_code != 200 or content_type != b'text/html':
+            return res
+        content_encoding = header_value(res.headers, b'content-encoding').strip().lower()
+        if content_encoding not in (b'', b'identity', b'gzip', b'deflate'):
+            return res
+        with self.lock:
+            if self.scan_executor is None:
+                self._start()
+
+        page = PageScan(self, res.url, content_encoding, proxy_config)
+        if res.body_stream is not None:
+            res.body_stream = self._scan_stream(page, res.body_stream)
+        elif res.body:
+            page.feed(res.body[:SCAN_LIMIT])
+        return res
+
+    def _scan_stream(self, page: PageScan, body_stream: Generator[bytes, None, None]) -> Generator[bytes, None, None]:
+        try:
+            for chunk in body_stream:
+                page.feed(chunk)
+                yield chunk
+        finally:
+            body_stream.close()     # releases a pooled connection when the client stops early
+
+    def schedule(self, hostname: str, connect: bool, proxy_config: tuple[str, int]):
+        with self.lock:
+            if hostname in self.pending:
+                if not connect or self.pending[hostname]:
+                    return
+            elif len(self.pending) >= MAX_PENDING:
+                return
+            self.pending[hostname] = connect
+        assert self.executor is not None
+        self.executor.submit(self._warm, hostname, connect, proxy_config)
+
+    def _warm(self, hostname: str, connect: bool, proxy_config: tuple[str, int]):
+        with self.lock:
+            # an upgrade to connect may have been scheduled while this one was waiting
+            if self.pending.get(hostname) is None or self.pending[hostname] != connect:
+                return
+            del self.pending[hostname]
+        try:
+            self.warm(hostname, connect, proxy_config)
+        except Exception as e:
+            logger.log(logging.DEBUG, f"[prefetch] warming {hostname} failed: {e}")
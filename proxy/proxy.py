@@ -2,34 +2,176 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
 import socket
-import ssl
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 from http import HTTPStatus
-from urllib.parse import urlparse
-from proxy import config, stat
+from time import sleep, time
+from typing import Callable, Generator, Optional
+from proxy import config, metrics, stat, tracing
 from proxy.config import conf
-from proxy.certs import generate_cert
+from proxy.certs import store as cert_store
+from proxy.shared_cache import cache as shared_cache
 from proxy.interface import Request as Request_t, Response as Response_t
 from proxy.fetch_adaptive import fetch
 
 logger = logging.getLogger(__name__)
 
+req_counter = count(1)
+WORKER_MIN_UPTIME = 1       # 초, 이보다 빨리 종료된 워커(예: bind 실패)는 다시 띄우지 않음
+WORKER_POLL_INTERVAL = 0.5  # 초, 부모가 워커 종료를 확인하는 간격
+
+def build_request(
+    method: str,
+    path: str,
+    headers: dict[str, str],
+    is_tls: bool,
+    body_stream: Optional[Generator[bytes, None, None]],
+    trace: Optional[tracing.Trace] = None,
+) -> Request_t:
+    """ 파싱된 요청으로 Request_t 구성 """
+    # 전체 URL 구성
+    url = path
+    if not url.lower().startswith('http'):
+        scheme = 'https' if is_tls else 'http'
+        host = headers.get('Host', '')
+        url = f"{scheme}://{host}{path}"
+
+    req_id = next(req_counter)
+    header = {k.encode(): v.encode() for k, v in headers.items()}
+    if trace is not None:
+        trace.note(req_id=req_id, method=method, url=url)
+    return Request_t(method=method, url=url, header=header, req_id=req_id, stream=conf.stream_responses, body_stream=body_stream, trace=trace)
+
+def start_trace(started: float, cert_seconds: Optional[float]) -> Optional[tracing.Trace]:
+    """
+    요청 추적 시작 (샘플링되지 않으면 None). started는 요청 줄이 도착한 시각,
+    cert_seconds는 이 연결의 CONNECT에서 인증서를 조회한 시간 (연결의 첫 요청에만 기록).
+    """
+    trace = tracing.start(started)
+    if trace is not None:
+        trace.phase('parse', time() - started)
+        if cert_seconds is not None:
+            trace.phase('cert', cert_seconds)
+    return trace
+
+def response_head(response: Response_t, http_version: str, framing: Optional[str] = None) -> bytes:
+    """ Response_t의 status line과 헤더를 직렬화 """
+    # transfer-encoding 헤더가 설정되어 있을 경우 브라우저에서 오류 발생
+    response.headers = {k: v for k, v in response.headers.items() if k.lower() != b'transfer-encoding'}
+
+    status_text = HTTPStatus(response.status_code).phrase
+    status_line = f"{http_version} {response.status_code} {status_text}\r\n"
+    headers = {k.decode(): v.decode() for k, v in response.headers.items()}
+    if response.body and 'content-length' not in (k.lower() for k in headers):
+        headers['Content-Length'] = str(len(response.body))
+    if framing == 'chunked':
+        headers['Transfer-Encoding'] = 'chunked'
+    elif framing == 'close':
+        headers['Connection'] = 'close'
+    header_lines = ''.join(f"{k}: {v}\r\n" for k, v in headers.items())
+    return (status_line + header_lines + "\r\n").encode('utf-8')
+
+def body_framing(response: Response_t, method: str, http_version: str) -> Optional[str]:
+    """
+    스트리밍 응답 바디의 전송 방식 결정.
+    'length': Content-Length 그대로 전달, 'chunked': chunked 인코딩, 'close': 연결 종료로 끝 표시, None: 바디 없음
+    """
+    if method.upper() == 'HEAD' or response.status_code in (204, 304) or response.status_code < 200:
+        return None
+    if any(k.lower() == b'content-length' for k in response.headers):
+        return 'length'
+    if http_version == 'HTTP/1.1':
+        return 'chunked'
+    return 'close'
+
+def encode_chunk(data: bytes, framing: Optional[str]) -> bytes:
+    """ chunked 인코딩이면 chunk 하나로 감쌈 (빈 data는 마지막 chunk) """
+    if framing != 'chunked':
+        return data
+    return f"{len(data):x}\r\n".encode() + data + b"\r\n"
+
+def keep_alive(http_version: str, headers: dict[str, str]) -> bool:
+    """ 연결 유지 여부 판단 (Connection 헤더) """
+    connection_header = headers.get('Connection', '').lower()
+    if http_version == 'HTTP/1.0' and connection_header != 'keep-alive':
+        return False
+    if http_version == 'HTTP/1.1' and connection_header == 'close':
+        return False
+    return True
+
+def header_value(headers: dict[str, str], name: str) -> str:
+    """ 대소문자 구분 없이 헤더 값 조회 (없으면 빈 문자열) """
+    return next((v for k, v in headers.items() if k.lower() == name.lower()), '')
+
+def request_body(
+    headers: dict[str, str],
+    readline: Callable[[], bytes],
+    read: Callable[[int], bytes],
+    send_continue: Callable[[], None],
+) -> Optional[Generator[bytes, None, None]]:
+    """
+    요청 바디를 도착하는 대로 내보내는 제너레이터 (Content-Length 또는 chunked), 바디가 없으면 None.
+    readline / read는 클라이언트 연결에서 블로킹으로 읽고, send_continue는 100 Continue를 보냄.
+    """
+    chunked = 'chunked' in header_value(headers, 'Transfer-Encoding').lower()
+    length = int(header_value(headers, 'Content-Length') or 0)
+    if not chunked and length <= 0:
+        return None
+    expect_continue = header_value(headers, 'Expect').lower() == '100-continue'
+    return _read_body(chunked, length, readline, read, send_continue if expect_continue else None)
+
+def _read_body(chunked: bool, length: int, readline, read, send_continue) -> Generator[bytes, None, None]:
+    # 100 Continue는 fetch가 바디를 처음 읽을 때 (업스트림에 보낼 수 있을 때) 전송
+    if send_continue is not None:
+        send_continue()
+    if not chunked:
+        yield from _read_exactly(read, length)
+        return
+
+    # chunked: 크기 줄 -> 데이터 -> CRLF 반복, 크기 0이면 trailer 후 종료
+    while True:
+        line = readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("client closed connection while sending request body")
+        size = int(line.split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        yield from _read_exactly(read, size)
+        readline()
+    # trailer는 전달하지 않음
+    while (line := readline()).endswith(b'\r\n') and line != b'\r\n':
+        pass
+
+def _read_exactly(read, size: int) -> Generator[bytes, None, None]:
+    while size > 0:
+        data = read(min(65536, size))
+        if not data:
+            raise ConnectionError("client closed connection while sending request body")
+        size -= len(data)
+        yield data
+
+def discard(body_stream: Generator[bytes, None, None]):
+    """ 업스트림이 다 읽지 않은 요청 바디를 읽고 버림 (다음 요청을 파싱하기 위해) """
+    for _ in body_stream:
+        pass
+
 class ProxyHandler(threading.Thread):
     """
     클라이언트 연결 처리: HTTP 요청 파싱 -> fetch 호출 -> 응답 전송.
     HTTPS의 경우 CONNECT 처리 후 TLS 구성.
     """
-    req_counter = count(1)
 
-    def __init__(self, client_socket: socket.socket, address, certfile: str, keyfile: str):
+    def __init__(self, client_socket: socket.socket, address):
         super().__init__()
         self.client_socket = client_socket
         self.address = address
-        self.certfile = certfile
-        self.keyfile = keyfile
         self.daemon = True
         self.is_tls = False     # TLS 상태 확인
         self.current_host = None
@@ -44,10 +186,12 @@ class ProxyHandler(threading.Thread):
 
     def handle_client(self):
         conn = self.client_socket
+        cert_seconds = None
         while True:
             data = self._recv_line(conn)
             if not data:
                 break
+            started = time()
             request_line = data.decode('utf-8').strip()
             parts = request_line.split()
             if len(parts) != 3:
@@ -72,9 +216,10 @@ class ProxyHandler(threading.Thread):
                 port = int(host_port[1]) if len(host_port) > 1 else 443
                 self.current_host = host
                 conn.sendall(f"{version} 200 Connection Established\r\n\r\n".encode('utf-8'))
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-                logger.log(logging.DEBUG, f"[TLS] Setting up TLS for {host}:{port} with cert {self.certfile} and key {self.keyfile}")
-                context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+                logger.log(logging.DEBUG, f"[TLS] Setting up TLS for {host}:{port}")
+                cert_started = time()
+                context = cert_store.get(host)
+                cert_seconds = time() - cert_started
                 try:
                     tls_conn = context.wrap_socket(conn, server_side=True)
                 except Exception as e:
@@ -84,45 +229,39 @@ class ProxyHandler(threading.Thread):
                 self.is_tls = True
                 continue
 
-            # 바디 읽기 (Content-Length 기반)
-            content_length = int(headers.get('Content-Length', 0))
-            body = b''
-            if content_length > 0:
-                remaining = content_length
-                while remaining > 0:
-                    chunk = conn.recv(min(4096, remaining))
-                    if not chunk:
-                        return
-                    body += chunk
-                    remaining -= len(chunk)
-
-            # 전체 URL 구성
-            url = path
-            if not url.lower().startswith('http'):
-                scheme = 'https' if self.is_tls else 'http'
-                host = headers.get('Host', '')
-                url = f"{scheme}://{host}{path}"
-
-            req_id = next(ProxyHandler.req_counter)
-            headers = {k.encode(): v.encode() for k, v in headers.items()}
-            request = Request_t(method=method, url=url, header=headers, req_id=req_id, body=body)
-
-            logger.log(logging.INFO, f"> {request.method} {request.url}")
-            response = fetch(request, (conf.proxy_addr, conf.proxy_port))
-            logger.log(logging.INFO, f"< {response.status_code} {response.url}")
-
-            # response 후처리
-            # transfer-encoding 헤더가 설정되어 있을 경우 브라우저에서 오류 발생
-            response.headers = {k: v for k, v in response.headers.items() if k.lower() != b'transfer-encoding'}
-
-            # 응답 전송
-            self._send_response(conn, response, version)
-
-            # 연결 유지 여부 판단 (Connection 헤더)
-            connection_header = headers.get('Connection', '').lower()
-            if version == 'HTTP/1.0' and connection_header != 'keep-alive':
+            # 바디는 메모리에 모으지 않고 fetch가 업스트림으로 보내면서 읽음
+            body_stream = request_body(
+                headers,
+                lambda conn=conn: self._recv_line(conn),
+                lambda size, conn=conn: conn.recv(size),
+                lambda conn=conn: conn.sendall(f"{version} 100 Continue\r\n\r\n".encode('utf-8')),
+            )
+            trace = start_trace(started, cert_seconds)
+            cert_seconds = None
+            request = build_request(method, path, headers, self.is_tls, body_stream, trace)
+
+            try:
+                logger.log(logging.INFO, f"> {request.method} {request.url}")
+                response = fetch(request, (conf.proxy_addr, conf.proxy_port))
+                logger.log(logging.INFO, f"< {response.status_code} {response.url}")
+
+                # 응답 전에 남은 바디를 비워야 클라이언트가 쓰기에서 막히지 않음
+                if body_stream is not None:
+                    discard(body_stream)
+
+                # 응답 전송
+                kept = self._send_response(conn, response, version, method)
+            except Exception as e:
+                if trace is not None:
+                    trace.finish(error=repr(e))
+                raise
+            if trace is not None:
+                trace.mark('last_byte')
+                trace.finish(status=response.status_code)
+            if not kept:
                 break
-            if version == 'HTTP/1.1' and connection_header == 'close':
+
+            if not keep_alive(version, headers):
                 break
 
             stat.log_stats()
@@ -140,17 +279,26 @@ class ProxyHandler(threading.Thread):
             line += chunk
         return line
 
-    def _send_response(self, conn: socket.socket, response: Response_t, http_version: str):
-        """ Response_t를 기반으로 HTTP 응답 전송 """
-        status_text = HTTPStatus(response.status_code).phrase
-        status_line = f"{http_version} {response.status_code} {status_text}\r\n"
-        headers = {k.decode(): v.decode() for k, v in response.headers.items()}
-        if response.body and 'Content-Length' not in headers:
-            headers['Content-Length'] = str(len(response.body))
-        header_lines = ''.join(f"{k}: {v}\r\n" for k, v in headers.items())
-        conn.sendall((status_line + header_lines + "\r\n").encode('utf-8'))
-        if response.body:
-            conn.sendall(response.body)
+    def _send_response(self, conn: socket.socket, response: Response_t, http_version: str, method: str) -> bool:
+        """ Response_t를 기반으로 HTTP 응답 전송, 연결을 유지할 수 있으면 True """
+        if response.body_stream is None:
+            conn.sendall(response_head(response, http_version))
+            if response.body:
+                conn.sendall(response.body)
+            return True
+
+        # 스트리밍 응답: 헤더를 먼저 보내고 바디는 도착하는 대로 전달
+        framing = body_framing(response, method, http_version)
+        try:
+            conn.sendall(response_head(response, http_version, framing))
+            for data in response.body_stream:
+                if framing is not None and data:
+                    conn.sendall(encode_chunk(data, framing))
+            if framing == 'chunked':
+                conn.sendall(encode_chunk(b'', framing))
+        finally:
+            response.body_stream.close()
+        return framing != 'close'
 
 class ProxyServer:
     """
@@ -161,28 +309,241 @@ class ProxyServer:
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((conf.host, conf.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(conf.backlog)
         print(f"Proxy listening on {conf.host}:{conf.port}")
 
     def serve_forever(self):
         try:
             while True:
+                # 인증서 발급은 CONNECT를 처리하는 핸들러 스레드에서 (accept 루프를 막지 않음)
                 client_sock, client_addr = self.server_socket.accept()
-                peeked = client_sock.recv(65535, socket.MSG_PEEK).decode(errors='ignore')
-                target = peeked.split(" ")[1]
-                url = urlparse(target)
-                if url.hostname is None:
-                    host, port = target.split(":", 1) if ":" in target else (target, 443)
-                else:
-                    host, port = (url.hostname, url.port) if url.port else (url.hostname, 443)
-                cert, key = generate_cert(host)  # 도메인별 인증서 생성
-                handler = ProxyHandler(client_sock, client_addr, key, cert)
+                handler = ProxyHandler(client_sock, client_addr)
                 handler.start()
         except KeyboardInterrupt:
             print("Proxy shutting down")
         finally:
             self.server_socket.close()
 
+class AsyncProxyServer:
+    """
+    asyncio 프록시 서버: 연결마다 task 하나로 처리하고, 버퍼링된 StreamReader로 요청을 파싱.
+    fetch는 블로킹 함수이므로 전용 스레드 풀에서 실행.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=conf.fetch_workers, thread_name_prefix='fetch')
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_client, conf.host, conf.port,
+            backlog=conf.backlog, reuse_address=True, reuse_port=True
+        )
+        print(f"Proxy listening on {conf.host}:{conf.port}")
+
+    async def serve(self):
+        await self.start()
+        assert self.server is not None
+        async with self.server:
+            await self.server.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Proxy shutting down")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await self._handle_client(reader, writer)
+        except Exception as e:
+            logger.log(logging.ERROR, f"[Error] {e}")
+        finally:
+            writer.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        is_tls = False
+        cert_seconds = None
+        while True:
+            data = await reader.readline()
+            if not data.endswith(b"\r\n"):
+                break
+            started = time()
+            parts = data.decode('utf-8').strip().split()
+            if len(parts) != 3:
+                break
+            method, path, version = parts
+
+            # 헤더 읽기
+            headers = {}
+            while True:
+                header_line = await reader.readline()
+                if not header_line.endswith(b"\r\n") or header_line == b"\r\n":
+                    break
+                line = header_line.decode('utf-8')
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    headers[key.strip()] = value.strip()
+
+            # CONNECT 처리 (HTTPS 터널링 시작)
+            if method.upper() == 'CONNECT':
+                host = path.split(':')[0]
+                cert_started = time()
+                context = await asyncio.wrap_future(cert_store.future(host))
+                cert_seconds = time() - cert_started
+
+                # ClientHello가 평문 버퍼로 읽히지 않도록 start_tls 전까지 읽기 중단
+                writer.transport.pause_reading()
+                writer.write(f"{version} 200 Connection Established\r\n\r\n".encode('utf-8'))
+                await writer.drain()
+                try:
+                    await writer.start_tls(context)
+                except Exception as e:
+                    logger.log(logging.ERROR, f"[TLS] Handshake failed: {e}")
+                    break
+                is_tls = True
+                continue
+
+            # 바디는 fetch 스레드가 업스트림으로 보내면서 읽음 (이벤트 루프의 reader를 블로킹으로 호출)
+            body_stream = request_body(
+                headers,
+                lambda: self._in_loop(loop, reader.readline()),
+                lambda size: self._in_loop(loop, reader.read(size)),
+                lambda: self._in_loop(loop, self._write(writer, f"{version} 100 Continue\r\n\r\n".encode('utf-8'))),
+            )
+            trace = start_trace(started, cert_seconds)
+            cert_seconds = None
+            request = build_request(method, path, headers, is_tls, body_stream, trace)
+            try:
+                logger.log(logging.INFO, f"> {request.method} {request.url}")
+                response = await loop.run_in_executor(self.executor, fetch, request, (conf.proxy_addr, conf.proxy_port))
+                logger.log(logging.INFO, f"< {response.status_code} {response.url}")
+
+                # 응답 전에 남은 바디를 비워야 클라이언트가 쓰기에서 막히지 않음
+                if body_stream is not None:
+                    await loop.run_in_executor(self.executor, discard, body_stream)
+
+                # 응답 전송
+                kept = await self._send_response(writer, response, version, method)
+            except Exception as e:
+                if trace is not None:
+                    trace.finish(error=repr(e))
+                raise
+            if trace is not None:
+                trace.mark('last_byte')
+                trace.finish(status=response.status_code)
+            if not kept:
+                break
+
+            if not keep_alive(version, headers):
+                break
+
+            stat.log_stats()
+
+    @staticmethod
+    def _in_loop(loop: asyncio.AbstractEventLoop, coro):
+        """ fetch 스레드에서 이벤트 루프의 코루틴을 실행하고 결과를 기다림 """
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, data: bytes):
+        writer.write(data)
+        await writer.drain()
+
+    async def _send_response(self, writer: asyncio.StreamWriter, response: Response_t, http_version: str, method: str) -> bool:
+        """ Response_t를 기반으로 HTTP 응답 전송, 연결을 유지할 수 있으면 True """
+        if response.body_stream is None:
+            writer.write(response_head(response, http_version))
+            if response.body:
+                writer.write(response.body)
+            await writer.drain()
+            return True
+
+        # 스트리밍 응답: 블로킹 이터레이터는 스레드 풀에서 읽고, drain()으로 클라이언트 속도에 맞춤
+        loop = asyncio.get_running_loop()
+        framing = body_framing(response, method, http_version)
+        try:
+            writer.write(response_head(response, http_version, framing))
+            while (data := await loop.run_in_executor(self.executor, next, response.body_stream, None)) is not None:
+                if framing is not None and data:
+                    writer.write(encode_chunk(data, framing))
+                    await writer.drain()
+            if framing == 'chunked':
+                writer.write(encode_chunk(b'', framing))
+            await writer.drain()
+        finally:
+            response.body_stream.close()
+        return framing != 'close'
+
+def serve():
+    if conf.frontend == 'asyncio':
+        AsyncProxyServer().serve_forever()
+    else:
+        ProxyServer().serve_forever()
+
+def run_worker():
+    # fork로 상속된 부모의 SIGTERM 핸들러 대신 기본 동작 (종료)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # 메트릭은 부모가 모아서 제공하므로 워커는 주기적으로 공유 캐시에 게시
+    metrics.start_worker()
+    try:
+        serve()
+    finally:
+        # multiprocessing 워커는 atexit 핸들러를 실행하지 않음
+        metrics.publish()
+        tracing.writer.flush()
+
+def serve_workers(workers: int):
+    """
+    워커 프로세스 workers개가 같은 포트에서 리스닝 (SO_REUSEPORT, 커널이 연결을 분배).
+    부모는 워커를 감시하고 비정상 종료된 워커를 다시 띄움. 캐시는 fork 전에 만든 공유 캐시로 공유.
+    """
+    # 공유 캐시와 stat 카운터는 fork 전에 만들어져 있어야 워커끼리 공유됨
+    shared_cache.create()
+    context = multiprocessing.get_context('fork')
+    running: list[tuple[multiprocessing.Process, float]] = []     # (worker, start time)
+    stopping = False
+
+    def start_worker(n: int):
+        # 워커는 자식 프로세스(SNIC 연결, 키 풀)를 만들므로 daemon이 아님
+        worker = context.Process(target=run_worker, name=f'worker-{n}')
+        worker.start()
+        running.append((worker, time()))
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for worker, _ in running:
+            if worker.pid is not None:
+                os.kill(worker.pid, signal.SIGINT)
+
+    signal.signal(signal.SIGTERM, stop)
+    for n in range(workers):
+        start_worker(n)
+    # 처음 워커들이 리스닝 소켓을 상속하지 않도록 fork 후에 시작 (재시작된 워커는 닫음)
+    metrics.serve()
+    try:
+        while running:
+            # sentinel은 워커의 자식 프로세스에도 상속되어 워커가 죽어도 닫히지 않을 수 있으므로 폴링
+            sleep(WORKER_POLL_INTERVAL)
+            for worker, started in [entry for entry in running if not entry[0].is_alive()]:
+                running.remove((worker, started))
+                if stopping:
+                    continue
+                if time() - started < WORKER_MIN_UPTIME:
+                    logger.log(logging.ERROR, f"[workers] {worker.name} exited with {worker.exitcode} right after starting")
+                    continue
+                logger.log(logging.WARN, f"[workers] {worker.name} exited with {worker.exitcode}, restarting")
+                start_worker(int(worker.name.split('-')[1]))
+    except KeyboardInterrupt:
+        # Ctrl-C는 워커에도 전달되므로 각자 종료함
+        stopping = True
+        for worker, _ in running:
+            worker.join()
+    print("Proxy shutting down")
+
 def parse_args():
     parser = argparse.ArgumentParser(
         prog='snic_proxy',
@@ -190,6 +551,7 @@ def parse_args():
     )
     parser.add_argument('--config', help='Path to a config file (.toml)', required=False)
     parser.add_argument('--loglevel', help='Log level', default='INFO')
+    parser.add_argument('--workers', help='Number of proxy processes listening on the port (overrides workers of the config file)', type=int)
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -198,7 +560,12 @@ if __name__ == "__main__":
     logging.basicConfig(level=args.loglevel)
     logging.getLogger('quic').setLevel(logging.ERROR)
     config.configure_from_file(args.config)
+    if args.workers is not None:
+        conf.workers = args.workers
 
     # start proxy server
-    proxy = ProxyServer()
-    proxy.serve_forever()
+    if conf.workers > 1:
+        serve_workers(conf.workers)
+    else:
+        metrics.serve()
+        serve()
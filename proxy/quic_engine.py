@@ -0,0 +1,513 @@
+# single-event-loop QUIC engine:
+#   - drives every SNIC QuicConnection/H3Connection from one asyncio loop in a background thread
+#   - EngineSNICConnection has the same connect / check_migration / fetch / close API as SNICConnection
+#   - no process or multiprocessing.Queue per connection, so process count stays flat with host count
+
+import asyncio
+import logging
+import queue
+import socket
+import socks
+import threading
+from time import time
+from concurrent.futures import Future
+from typing import Callable, Coroutine, Generator, Optional
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.h3.connection import H3Connection, ErrorCode
+from aioquic.tls import SessionTicket
+import aioquic.quic.events
+import aioquic.h3.events
+
+from proxy import happy_eyeballs, quic_tickets, stat
+from proxy.config import conf
+from proxy.interface import Request, Response
+from proxy.fetch_snic import (
+    SNICQuicConnection, early_data_allowed, early_safe, h3_request_headers, record_early_data, record_handshake,
+    secrets_log_file,
+)
+
+logger = logging.getLogger(__name__)
+
+class QuicEngine:
+    """ owns the event loop thread shared by all EngineSNICConnections """
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="quic-engine", daemon=True).start()
+            return self.loop
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    def call_soon(self, callback: Callable, *args):
+        self.get_loop().call_soon_threadsafe(callback, *args)
+
+engine = QuicEngine()
+
+class _DatagramPath(asyncio.DatagramProtocol):
+    """ feeds datagrams of one UDP socket (tunneled or direct) into a connection """
+    def __init__(self, conn: "_EngineConnection", via_proxy: bool):
+        self.conn = conn
+        self.via_proxy = via_proxy
+
+    def datagram_received(self, data: bytes, addr):
+        self.conn.datagram_received(data, addr, self.via_proxy)
+
+    def error_received(self, exc: Exception):
+        logger.log(logging.DEBUG, f"{self.conn.hostname}: datagram error: {exc}")
+
+class _Upload:
+    """ request body sent from the caller's thread, never more than the connection has granted """
+    def __init__(self):
+        self.stream_id: Optional[int] = None
+        self.credit = 0
+        self.held = 0       # uploaded bytes not yet granted back, only touched from the engine loop
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def open(self, stream_id: int):
+        with self.cond:
+            self.stream_id = stream_id
+            self.credit += conf.stream_window
+            self.cond.notify()
+
+    def grant(self, size: int):
+        with self.cond:
+            self.credit += size
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def acquire(self, size: int) -> bool:
+        """ waits until size bytes may be sent, False if the upload is stopped """
+        with self.cond:
+            self.credit -= size
+            while (self.stream_id is None or self.credit < 0) and not self.stopped:
+                self.cond.wait()
+            return not self.stopped
+
+class _EngineConnection:
+    """ state of a single QUIC connection; only touched from the engine loop """
+    def __init__(self, hostname: str, dst_addr: tuple[str, int], proxy_addr: tuple[str, int]):
+        self.hostname = hostname
+        self.dst_addr = dst_addr
+        self.proxy_addr = proxy_addr
+        self.loop = asyncio.get_running_loop()
+        self.quic_conn = None
+        self.h3_conn = None
+        self.transport_proxy = None
+        self.transport = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.connected = asyncio.Event()
+        self.migrated = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.is_migrated = False
+        self.early_data = False
+        self.early_sent: Optional[float] = None
+        self.early_accepted = False
+        self.resp_map: dict[int, Response] = {}             # key: stream ID, value: response
+        self.req_map: dict[int, Request] = {}               # key: stream ID, value: request
+        self.waiters: dict[int, asyncio.Future] = {}        # key: stream ID, value: response future
+        self.body_map: dict[int, list[bytes]] = {}          # key: stream ID, value: body parts of buffered responses
+        self.body_queues: dict[int, queue.Queue] = {}       # key: stream ID, value: chunks of streamed responses
+        self.uploads: dict[int, _Upload] = {}               # key: stream ID, value: request body being uploaded
+        self.total_sent_proxy = 0
+        self.total_received_proxy = 0
+        self.total_sent_without_proxy = 0
+        self.total_received_without_proxy = 0
+
+    async def start(self, session_ticket: Optional[SessionTicket] = None):
+        # create socks UDP socket; binding performs the blocking UDP ASSOCIATE handshake
+        sock_proxy = socks.socksocket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock_proxy.set_proxy(proxy_type=socks.SOCKS5, addr=self.proxy_addr[0], port=self.proxy_addr[1])
+        await asyncio.to_thread(sock_proxy.bind, ('', 0))
+        sock_proxy.setblocking(False)
+        self.transport_proxy, _ = await self.loop.create_datagram_endpoint(
+            lambda: _DatagramPath(self, via_proxy=True), sock=sock_proxy
+        )
+
+        # create underlying UDP socket
+        local_addr = ('::', 0) if happy_eyeballs.is_ipv6(self.dst_addr[0]) else ('0.0.0.0', 0)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _DatagramPath(self, via_proxy=False), local_addr=local_addr
+        )
+
+        # create QUIC and H3 connection
+        quic_config = QuicConfiguration(
+            alpn_protocols=["h3"],
+            is_client=True,
+            server_name=self.hostname,
+            secrets_log_file=secrets_log_file(),
+            session_ticket=session_ticket,
+        )
+        if conf.ca_file is not None:
+            quic_config.load_verify_locations(conf.ca_file)
+        self.quic_conn = SNICQuicConnection(configuration=quic_config, session_ticket_handler=quic_tickets.store.add)
+        self.h3_conn = H3Connection(self.quic_conn)
+        self.early_data = early_data_allowed(session_ticket)
+
+        # initiate QUIC connection
+        self.quic_conn.connect(self.dst_addr, now=time())
+        self.transmit()
+
+    def datagram_received(self, data: bytes, addr, via_proxy: bool):
+        if self.closed.is_set():
+            return
+        if via_proxy:
+            self.total_received_proxy += len(data)
+        else:
+            self.total_received_without_proxy += len(data)
+        self.quic_conn.receive_datagram(data, addr[:2], now=time())     # IPv6 sockets add flow info and scope ID
+        self.process_events()
+        self.transmit()
+
+    def transmit(self):
+        # transmit data
+        for data, addr in self.quic_conn.datagrams_to_send(now=time()):
+            if self.is_migrated:
+                self.transport.sendto(data, addr)
+                self.total_sent_without_proxy += len(data)
+            else:
+                self.transport_proxy.sendto(data, addr)
+                self.total_sent_proxy += len(data)
+
+        # let uploaders send more once the peer has taken what they sent
+        for stream_id, upload in self.uploads.items():
+            if upload.held and self.quic_conn.unsent(stream_id) < conf.stream_window:
+                upload.grant(upload.held)
+                upload.held = 0
+
+        # re-arm timer from the QUIC deadline
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if (t := self.quic_conn.get_timer()) is not None and not self.closed.is_set():
+            self.timer = self.loop.call_at(self.loop.time() + max(0, t - time()), self.handle_timer)
+
+    def handle_timer(self):
+        self.timer = None
+        self.quic_conn.handle_timer(now=time())
+        self.process_events()
+        self.transmit()
+
+    def process_events(self):
+        while (evt := self.quic_conn.next_event()) is not None:
+            if isinstance(evt, aioquic.quic.events.ConnectionTerminated):
+                logger.debug(f"[event] connection terminated, reason: {evt.reason_phrase}")
+                self.terminated()
+            elif isinstance(evt, aioquic.quic.events.HandshakeCompleted):
+                logger.debug(f"[event] handshake completed, negotiated protocols: {evt.alpn_protocol}")
+                self.early_accepted = evt.early_data_accepted
+                record_handshake(evt.session_resumed)
+                self.quic_conn.send_ping(41)
+            elif isinstance(evt, aioquic.quic.events.PingAcknowledged):
+                logger.debug(f"[event] ping acked, uid={evt.uid}")
+                if evt.uid == 42:
+                    self.migrated.set()
+                elif evt.uid == 41:
+                    self.connected.set()
+                    if self.early_sent is not None:
+                        record_early_data(self.hostname, self.early_sent, self.early_accepted)
+                    # trigger migration once connection is established
+                    self.is_migrated = True
+                    logger.debug(f"{self.hostname}: QUIC connection migrated")
+                    self.quic_conn.send_ping(42)
+            elif isinstance(evt, aioquic.quic.events.StopSendingReceived):
+                logger.debug("[event] stop sending received")
+                if (upload := self.uploads.pop(evt.stream_id, None)) is not None:
+                    upload.stop()
+            elif isinstance(evt, aioquic.quic.events.StreamDataReceived):
+                for h3_evt in self.h3_conn.handle_event(evt):
+                    self.handle_h3_event(h3_evt)
+
+    def handle_h3_event(self, evt):
+        if (req := self.req_map.get(evt.stream_id)) is None:
+            return      # cancelled, what was in flight still arrives
+        if isinstance(evt, aioquic.h3.events.HeadersReceived):
+            # create new response object
+            headers = {k: v for k, v in evt.headers}
+            res = Response(
+                status_code=int(headers[b':status'].decode()),
+                url=req.url,
+                headers=headers,
+                req_id=req.req_id,
+                body=None
+            )
+            if req.stream:
+                # hand headers over right away, body follows through body_queues
+                res.body_stream = self.body_stream(evt.stream_id, self.body_queues[evt.stream_id])
+                self.waiters.pop(evt.stream_id).set_result(res)
+                if evt.stream_ended:
+                    self.body_queues[evt.stream_id].put((b'', True))
+            else:
+                self.resp_map[evt.stream_id] = res
+                self.body_map[evt.stream_id] = []
+        elif isinstance(evt, aioquic.h3.events.DataReceived):
+            if req.stream:
+                self.quic_conn.delivered(evt.stream_id, len(evt.data))
+                self.body_queues[evt.stream_id].put((evt.data, evt.stream_ended))
+            else:
+                self.body_map[evt.stream_id].append(evt.data)
+        else:
+            logger.debug(f"unknown H3 event: {evt}")
+            return
+
+        if evt.stream_ended:
+            # response complete before the request body, cancel the rest of the upload
+            if (upload := self.uploads.pop(evt.stream_id, None)) is not None:
+                self.quic_conn.reset_stream(evt.stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+                upload.stop()
+
+            del self.req_map[evt.stream_id]
+            if req.stream:
+                del self.body_queues[evt.stream_id]
+                self.quic_conn.finished(evt.stream_id)
+            else:
+                res = self.resp_map.pop(evt.stream_id)
+                if (body := self.body_map.pop(evt.stream_id)):
+                    res.body = b''.join(body)
+                waiter = self.waiters.pop(evt.stream_id)
+                if not waiter.done():
+                    waiter.set_result(res)
+            self.flush_stats()
+
+    def body_stream(self, stream_id: int, chunks: queue.Queue) -> Generator[bytes, None, None]:
+        """ runs in the consumer's thread; returns window to the engine loop as the body is consumed """
+        unacked = 0
+        finished = False    # the whole body arrived, or the connection terminated
+        try:
+            while (chunk := chunks.get()) is not None:
+                data, end = chunk
+                if data:
+                    yield data
+                if end:
+                    finished = True
+                    return
+
+                # consumer asked for more, give the connection its window back in batches
+                unacked += len(data)
+                if unacked >= conf.stream_window // 4:
+                    engine.call_soon(self.consumed, stream_id, unacked)
+                    unacked = 0
+            finished = True
+            raise ConnectionError(f"{self.hostname}: QUIC connection terminated while streaming response")
+        finally:
+            # closed by the consumer before the end, e.g. the client went away or the response lost a race
+            if not finished:
+                engine.call_soon(self.cancel, stream_id)
+
+    def cancel(self, stream_id: int):
+        """ stops a stream whose response is no longer read, what is buffered for it is dropped """
+        if self.closed.is_set() or self.req_map.pop(stream_id, None) is None:
+            return
+        upload = self.uploads.pop(stream_id, None)
+        self.quic_conn.cancel(stream_id, uploading=upload is not None)
+        if upload is not None:
+            upload.stop()
+        self.resp_map.pop(stream_id, None)
+        self.body_map.pop(stream_id, None)
+        self.body_queues.pop(stream_id, None)
+        if (waiter := self.waiters.pop(stream_id, None)) is not None and not waiter.done():
+            waiter.set_result(None)
+        self.transmit()
+
+    def cancel_upload(self, upload: _Upload):
+        """ cancels the request of a failed upload, whether or not its stream is open yet """
+        upload.stop()
+        if upload.stream_id is not None:
+            self.cancel(upload.stream_id)
+
+    def consumed(self, stream_id: int, size: int):
+        if not self.closed.is_set():
+            self.quic_conn.consumed(stream_id, size)
+            self.transmit()
+
+    async def fetch(self, req: Request, upload: Optional[_Upload] = None) -> Optional[Response]:
+        # when resuming, safe requests go right away as 0-RTT early data
+        if self.connected.is_set() or not (self.early_data and early_safe(req)):
+            await self.connected.wait()
+        elif self.early_sent is None:
+            self.early_sent = time()
+        if self.closed.is_set() or (upload is not None and upload.stopped):
+            if upload is not None:
+                upload.stop()
+            return None
+
+        stream_id = self.quic_conn.get_next_available_stream_id(is_unidirectional=False)
+        self.req_map[stream_id] = req
+        waiter = self.loop.create_future()
+        self.waiters[stream_id] = waiter
+        if req.stream:
+            self.body_queues[stream_id] = queue.Queue()
+
+        self.h3_conn.send_headers(stream_id, h3_request_headers(req), end_stream=(req.body is None and upload is None))
+        if req.body is not None:
+            self.h3_conn.send_data(stream_id, req.body, end_stream=True)
+        elif upload is not None:
+            # body follows through send_body, the uploader may start with a full window
+            self.uploads[stream_id] = upload
+            upload.open(stream_id)
+        logger.debug(f"{req.method} {req.url} (stream id: {stream_id})")
+        self.transmit()
+        return await waiter
+
+    def send_body(self, stream_id: int, data: bytes, end: bool):
+        if (upload := self.uploads.get(stream_id)) is None:
+            return
+        self.h3_conn.send_data(stream_id, data, end_stream=end)
+        if end:
+            del self.uploads[stream_id]
+        else:
+            upload.held += len(data)
+        self.transmit()
+
+    def close(self):
+        if self.quic_conn is not None and not self.closed.is_set():
+            self.quic_conn.close()
+            self.transmit()
+        self.terminated()
+
+    def terminated(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for transport in (self.transport_proxy, self.transport):
+            if transport is not None:
+                transport.close()
+
+        # wake up requests still waiting for a response
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+        for chunks in self.body_queues.values():
+            chunks.put(None)
+        self.body_queues.clear()
+        for upload in self.uploads.values():
+            upload.stop()
+        self.uploads.clear()
+        self.connected.set()
+        logger.debug(f"{self.hostname}: QUIC connection terminated")
+        self.flush_stats()
+
+    def flush_stats(self):
+        stat.increase_total_sent_proxy(self.total_sent_proxy)
+        stat.increase_total_received_proxy(self.total_received_proxy)
+        stat.increase_total_sent_snic(self.total_sent_without_proxy)
+        stat.increase_total_received_snic(self.total_received_without_proxy)
+        self.total_sent_proxy = self.total_received_proxy = 0
+        self.total_sent_without_proxy = self.total_received_without_proxy = 0
+
+class EngineSNICConnection:
+    """ SNICConnection counterpart whose connection lives on the shared QuicEngine loop """
+    def __init__(self, hostname: str, dst_addr: tuple[str, int], proxy_addr: tuple[str, int]):
+        self.hostname = hostname
+        self.dst_addr = dst_addr
+        self.proxy_addr = proxy_addr
+        self.conn: Optional[_EngineConnection] = None
+        self.closing: Optional[Future] = None
+        self.early: Optional[tuple[int, Future]] = None     # (request ID, response) of the request sent as 0-RTT early data
+
+        # bookkeeping for SNICConnectionPool
+        self.created = time()
+        self.last_used = self.created
+        self.streams = 0
+        self.in_flight = 0
+
+    @property
+    def key(self) -> tuple[str, str, int]:
+        return (self.hostname, self.dst_addr[0], self.dst_addr[1])
+
+    def is_alive(self) -> bool:
+        return self.conn is not None and not self.conn.closed.is_set()
+
+    async def _start(self, early: Optional[Request]):
+        self.conn = _EngineConnection(self.hostname, self.dst_addr, self.proxy_addr)
+        ticket = quic_tickets.store.take(self.hostname)
+        try:
+            await self.conn.start(ticket)
+        except OSError as e:
+            logger.log(logging.DEBUG, f"{self.hostname}: failed to start QUIC connection: {e}")
+            self.conn.terminated()
+            return
+        if early is not None and early_data_allowed(ticket) and early_safe(early):
+            self.early = (early.req_id, asyncio.ensure_future(self.conn.fetch(early)))
+
+    async def _wait(self, evt_name: str, timeout: Optional[float]) -> bool:
+        assert self.conn is not None
+        evt = getattr(self.conn, evt_name)
+        try:
+            await asyncio.wait_for(evt.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self.conn.closed.is_set()
+
+    async def connect(self, timeout: Optional[float] = None, early: Optional[Request] = None) -> bool:
+        """ early is sent right away as 0-RTT early data if the connection resumes a session that allows it """
+        async def start_and_wait():
+            await self._start(early)
+            return await self._wait("connected", timeout)
+        return await asyncio.wrap_future(engine.submit(start_and_wait()))
+
+    async def check_migration(self, timeout: Optional[float] = None) -> bool:
+        return await asyncio.wrap_future(engine.submit(self._wait("migrated", timeout)))
+
+    async def fetch(self, req: Request) -> Optional[Response]:
+        assert self.conn is not None
+        if self.early is not None and self.early[0] == req.req_id:
+            # sent already by connect()
+            early, self.early = self.early[1], None
+            return await asyncio.wrap_future(engine.submit(self._early_response(early)))
+        if req.body_stream is None:
+            return await asyncio.wrap_future(engine.submit(self.conn.fetch(req)))
+
+        upload = _Upload()
+        res = engine.submit(self.conn.fetch(req, upload))
+        try:
+            await asyncio.to_thread(self._upload, req.body_stream, upload)
+        except BaseException:
+            # the request body broke off (the client disconnected, a bad chunk size), so does the request
+            engine.call_soon(self.conn.cancel_upload, upload)
+            raise
+        return await asyncio.wrap_future(res)
+
+    async def _early_response(self, early: asyncio.Future) -> Optional[Response]:
+        return await early
+
+    def _upload(self, body_stream: Generator[bytes, None, None], upload: _Upload):
+        assert self.conn is not None
+        for data in body_stream:
+            if not upload.acquire(len(data)):
+                return
+            engine.call_soon(self.conn.send_body, upload.stream_id, data, False)
+        if upload.acquire(0):
+            engine.call_soon(self.conn.send_body, upload.stream_id, b'', True)
+
+    def terminate(self):
+        """ asks the connection to close without waiting for it """
+        if self.conn is not None and self.closing is None:
+            self.closing = engine.submit(self._close())
+
+    async def _close(self):
+        assert self.conn is not None
+        self.conn.close()
+
+    async def close(self):
+        self.terminate()
+        if self.closing is not None:
+            await asyncio.wrap_future(self.closing)
+
+    def _wait_join(self):
+        if self.closing is not None:
+            self.closing.result()
@@ -0,0 +1,136 @@
+# QUIC session tickets of SNIC connections:
+#   - the latest ticket per server name, taken by the next connection to resume the TLS session
+#     and, if the ticket allows it, to send a safe request as 0-RTT early data
+#   - a ticket is used once, every connection receives new ones from the server
+#   - kept in memory, and in conf.snic_ticket_file across restarts when set: as JSON, written
+#     SAVE_DELAY after a change on a timer thread (never on the loop that received the ticket),
+#     one file per worker of the proxy so that no two processes resume with the same ticket
+
+import atexit
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+from aioquic.tls import CipherSuite, SessionTicket
+
+from proxy.config import conf
+
+logger = logging.getLogger(__name__)
+
+MAX_TICKETS = 1024      # server names whose ticket is kept, least recently received ones are dropped first
+SAVE_DELAY = 1          # seconds changes are collected before the file is written
+
+def ticket_path() -> Optional[str]:
+    """ conf.snic_ticket_file, suffixed with the worker name in a worker of the proxy (which keeps it across restarts) """
+    path = conf.snic_ticket_file
+    name = multiprocessing.current_process().name
+    if path is None or not name.startswith('worker-'):
+        return path
+    return f"{path}.{name}"
+
+def encode_ticket(ticket: SessionTicket) -> dict:
+    return {
+        'age_add': ticket.age_add,
+        'cipher_suite': int(ticket.cipher_suite),
+        'not_valid_after': ticket.not_valid_after.isoformat(),
+        'not_valid_before': ticket.not_valid_before.isoformat(),
+        'resumption_secret': base64.b64encode(ticket.resumption_secret).decode(),
+        'server_name': ticket.server_name,
+        'ticket': base64.b64encode(ticket.ticket).decode(),
+        'max_early_data_size': ticket.max_early_data_size,
+        'other_extensions': [[kind, base64.b64encode(value).decode()] for kind, value in ticket.other_extensions],
+    }
+
+def decode_ticket(fields: dict) -> SessionTicket:
+    """ raises ValueError, KeyError or TypeError for anything but what encode_ticket wrote """
+    max_early_data_size = fields['max_early_data_size']
+    return SessionTicket(
+        age_add=int(fields['age_add']),
+        cipher_suite=CipherSuite(fields['cipher_suite']),
+        not_valid_after=datetime.fromisoformat(fields['not_valid_after']),
+        not_valid_before=datetime.fromisoformat(fields['not_valid_before']),
+        resumption_secret=base64.b64decode(fields['resumption_secret'], validate=True),
+        server_name=str(fields['server_name']),
+        ticket=base64.b64decode(fields['ticket'], validate=True),
+        max_early_data_size=None if max_early_data_size is None else int(max_early_data_size),
+        other_extensions=[(int(kind), base64.b64decode(value, validate=True)) for kind, value in fields['other_extensions']],
+    )
+
+class QuicTicketStore:
+    def __init__(self):
+        self.tickets: OrderedDict[str, SessionTicket] = OrderedDict()   # key: server name
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.save_timer: Optional[threading.Timer] = None
+        self.save_lock = threading.Lock()     # held while writing, so that an older snapshot never overwrites a newer one
+
+    def _load(self):
+        self.loaded = True
+        path = ticket_path()
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                tickets = [decode_ticket(fields) for fields in json.load(f)]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.log(logging.WARN, f"[tickets] cannot read {path}: {e}")
+            return
+        self.tickets.update((ticket.server_name, ticket) for ticket in tickets if ticket.is_valid)
+
+    def _changed(self):
+        # called with the lock held, the file is written once per SAVE_DELAY at most
+        if ticket_path() is None or self.save_timer is not None:
+            return
+        self.save_timer = threading.Timer(SAVE_DELAY, self.save)
+        self.save_timer.daemon = True
+        self.save_timer.start()
+
+    def save(self):
+        """ writes the tickets to the file, also at exit """
+        with self.save_lock:
+            with self.lock:
+                if self.save_timer is None:
+                    return      # nothing changed
+                self.save_timer.cancel()
+                self.save_timer = None
+                data = json.dumps([encode_ticket(ticket) for ticket in self.tickets.values()])
+            path = ticket_path()
+            assert path is not None
+            # write to a temporary file first so that a crash never leaves a partial file, readable by this user only
+            tmp_path = f"{path}.tmp"
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with open(fd, "w") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.log(logging.DEBUG, f"[tickets] cannot write {path}: {e}")
+
+    def take(self, server_name: str) -> Optional[SessionTicket]:
+        """ the ticket to resume a connection to server_name with, if there is a valid one """
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            ticket = self.tickets.pop(server_name, None)
+            if ticket is not None:
+                self._changed()     # so that it is not used again after a restart
+        return ticket if ticket is not None and ticket.is_valid else None
+
+    def add(self, ticket: SessionTicket):
+        """ session_ticket_handler of the connections """
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            self.tickets[ticket.server_name] = ticket
+            self.tickets.move_to_end(ticket.server_name)
+            while len(self.tickets) > MAX_TICKETS:
+                self.tickets.popitem(last=False)
+            self._changed()
+
+store = QuicTicketStore()
+atexit.register(store.save)
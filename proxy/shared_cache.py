@@ -0,0 +1,96 @@
+# cache shared by the workers of a multi-worker proxy (--workers, see proxy/proxy.py):
+#   - SQLite file in a temporary directory made by the parent process before it forks the workers,
+#     removed when the parent exits
+#   - key/value entries of one kind per table, each with an expiry, so that what one worker looks up
+#     is found by the others instead of being looked up again
+#   - a single proxy process has no shared cache, every lookup misses and nothing is written
+#   - WAL mode with a busy timeout, like the verdict database (see proxy/verdicts.py)
+
+import atexit
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from threading import Lock
+from time import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+BUSY_TIMEOUT = 5        # seconds a write waits for another worker holding the database
+TABLES = ('dns', 'metrics')
+
+class SharedCache:
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = Lock()
+
+    def create(self):
+        """ makes the database in the parent process, before forking the workers that share it """
+        directory = tempfile.mkdtemp(prefix='snic-')
+        self.path = os.path.join(directory, 'cache.sqlite3')
+        owner = os.getpid()
+        # forked workers inherit the atexit handler, only the parent removes the directory
+        atexit.register(lambda: os.getpid() == owner and shutil.rmtree(directory, ignore_errors=True))
+        db = self._connect()
+        db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        assert self.path is not None
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")    # the cache does not outlive the proxy
+        for table in TABLES:
+            db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+        return db
+
+    def _execute(self, sql: str, params: tuple) -> list[tuple]:
+        with self.lock:
+            if self.db is None:
+                # opened by each worker after the fork, a connection must not be shared between processes
+                self.db = self._connect()
+            return self.db.execute(sql, params).fetchall()
+
+    def get(self, table: str, key: str) -> Optional[tuple[Any, float]]:
+        """ (value, expiry timestamp) of key, None if it is not cached (anymore) """
+        if self.path is None:
+            return None
+        try:
+            rows = self._execute(f"SELECT value, expires FROM {table} WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.log(logging.DEBUG, f"[shared] cannot read {table} {key}: {e}")
+            return None
+        if not rows or rows[0][1] < time():
+            return None
+        return json.loads(rows[0][0]), rows[0][1]
+
+    def items(self, table: str) -> list[tuple[str, Any]]:
+        """ every (key, value) of table that has not expired """
+        if self.path is None:
+            return []
+        try:
+            rows = self._execute(f"SELECT key, value FROM {table} WHERE expires >= ?", (time(),))
+        except sqlite3.Error as e:
+            logger.log(logging.DEBUG, f"[shared] cannot read {table}: {e}")
+            return []
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def put(self, table: str, key: str, value: Any, ttl: float, max_entries: int):
+        """ caches the JSON-serializable value of key for ttl seconds, keeping at most max_entries of table """
+        if self.path is None:
+            return
+        try:
+            self._execute(f"INSERT OR REPLACE INTO {table} (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), time() + ttl))
+            # entries expiring first go first, the in-memory caches of the workers are the LRUs
+            self._execute(
+                f"DELETE FROM {table} WHERE expires < ? OR key IN "
+                f"(SELECT key FROM {table} ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (time(), max_entries),
+            )
+        except sqlite3.Error as e:
+            logger.log(logging.DEBUG, f"[shared] cannot write {table} {key}: {e}")
+
+cache = SharedCache()
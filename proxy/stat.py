@@ -1,12 +1,39 @@
 import logging
-from multiprocessing import Lock, Value
+import threading
+
+from proxy.config import conf
+from proxy.metrics import Counter, Histogram
 
 logger = logging.getLogger(__name__)
 
-total_sent_proxy = Value('i', 0)
-total_received_proxy = Value('i', 0)
-total_sent_snic = Value('i', 0)
-total_received_snic = Value('i', 0)
+# counters and histograms of the proxy, see proxy/metrics.py for how they are kept and served
+
+total_sent_proxy = Counter('snic_proxy_sent_bytes_total', 'Bytes sent through the SOCKS5 proxy')
+total_received_proxy = Counter('snic_proxy_received_bytes_total', 'Bytes received through the SOCKS5 proxy')
+total_sent_snic = Counter('snic_direct_sent_bytes_total', 'Bytes sent directly by migrated SNIC connections')
+total_received_snic = Counter('snic_direct_received_bytes_total', 'Bytes received directly by migrated SNIC connections')
+dns_cache_hits = Counter('snic_dns_cache_hits_total', 'DNS lookups answered from the cache')
+dns_cache_misses = Counter('snic_dns_cache_misses_total', 'DNS lookups sent to the DNS server')
+dns_coalesced = Counter('snic_dns_coalesced_total', 'DNS lookups that waited for the same lookup in flight')
+dns_associations = Counter('snic_dns_associations_total', 'UDP associations (or QUIC connections) opened for DNS')
+tls_resumed = Counter('snic_tls_resumed_total', 'TLS handshakes through the proxy that resumed a session')
+tls_full_handshakes = Counter('snic_tls_full_handshakes_total', 'TLS handshakes through the proxy without resumption')
+snic_resumed = Counter('snic_quic_resumed_total', 'QUIC handshakes of SNIC connections that resumed a session')
+snic_full_handshakes = Counter('snic_quic_full_handshakes_total', 'QUIC handshakes of SNIC connections without resumption')
+snic_early_data = Counter('snic_quic_early_data_total', 'Requests accepted as 0-RTT early data')
+snic_early_saved = Counter('snic_quic_early_saved_seconds_total', 'Time to first byte saved by 0-RTT early data')
+
+requests = Counter('snic_requests_total', 'Requests fetched, by host and path (snic or tunnel)', ('host', 'path'))
+request_seconds = Counter('snic_request_seconds_total', 'Time spent fetching requests, by host and path', ('host', 'path'))
+request_failures = Counter('snic_request_failures_total', 'Requests that failed on every path, by host', ('host',))
+dns_seconds = Histogram('snic_dns_seconds', 'Time to resolve a hostname with the DNS server')
+connect_seconds = Histogram('snic_connect_seconds', 'Time to connect to a host, by path (TCP and TLS through the proxy, or QUIC)', ('path',))
+migration_seconds = Histogram('snic_migration_seconds', 'Time to migrate a connected SNIC connection off the proxy')
+ttfb_seconds = Histogram('snic_ttfb_seconds', 'Time to the response headers of a request (to the whole response unless streamed), by path', ('path',))
+total_seconds = Histogram('snic_request_seconds', 'Time to the end of the response body of a request, by path', ('path',))
+
+hosts: set[str] = set()     # hosts with labels of their own, conf.metrics_max_hosts at most
+hosts_lock = threading.Lock()
 
 # from https://stackoverflow.com/a/43750422
 def human_size(bytes, units=[' bytes','KB','MB','GB','TB', 'PB', 'EB']):
@@ -14,30 +41,87 @@ def human_size(bytes, units=[' bytes','KB','MB','GB','TB', 'PB', 'EB']):
     return str(bytes) + units[0] if bytes < 1024 else human_size(bytes>>10, units[1:])
 
 def increase_total_sent_proxy(by: int):
-    global total_sent_proxy
-    with total_sent_proxy.get_lock():
-        total_sent_proxy.value += by
+    total_sent_proxy.inc(by)
 
 def increase_total_received_proxy(by: int):
-    global total_received_proxy
-    with total_received_proxy.get_lock():
-        total_received_proxy.value += by
+    total_received_proxy.inc(by)
 
 def increase_total_sent_snic(by: int):
-    global total_sent_snic
-    with total_sent_snic.get_lock():
-        total_sent_snic.value += by
+    total_sent_snic.inc(by)
 
 def increase_total_received_snic(by: int):
-    global total_received_snic
-    with total_received_snic.get_lock():
-        total_received_snic.value += by
+    total_received_snic.inc(by)
 
+def increase_dns_cache_hits(by: int):
+    dns_cache_hits.inc(by)
 
-def log_stats():
-    logger.info(f"total_sent_proxy = {human_size(total_sent_proxy.value)}")
-    logger.info(f"total_received_proxy = {human_size(total_received_proxy.value)}")
-    logger.info(f"total_sent_snic = {human_size(total_sent_snic.value)}")
-    logger.info(f"total_received_snic = {human_size(total_received_snic.value)}")
+def increase_dns_cache_misses(by: int):
+    dns_cache_misses.inc(by)
+
+def increase_dns_coalesced(by: int):
+    dns_coalesced.inc(by)
+
+def increase_dns_associations(by: int):
+    dns_associations.inc(by)
+
+def increase_tls_resumed(by: int):
+    tls_resumed.inc(by)
+
+def increase_tls_full_handshakes(by: int):
+    tls_full_handshakes.inc(by)
+
+def increase_snic_resumed(by: int):
+    snic_resumed.inc(by)
+
+def increase_snic_full_handshakes(by: int):
+    snic_full_handshakes.inc(by)
 
+def increase_snic_early_data(by: int):
+    snic_early_data.inc(by)
+
+def increase_snic_early_saved_seconds(by: float):
+    snic_early_saved.inc(by)
+
+def host_label(host: str) -> str:
+    """ host itself, or 'other' once conf.metrics_max_hosts hosts have labels """
+    if host in hosts:
+        return host
+    with hosts_lock:
+        if len(hosts) < conf.metrics_max_hosts:
+            hosts.add(host)
+            return host
+    return 'other'
+
+def record_dns(seconds: float):
+    dns_seconds.observe(seconds)
+
+def record_connect(path: str, seconds: float):
+    connect_seconds.observe(seconds, path)
+
+def record_migration(seconds: float):
+    migration_seconds.observe(seconds)
+
+def record_ttfb(path: str, seconds: float):
+    ttfb_seconds.observe(seconds, path)
+
+def record_request(host: str, path: str, seconds: float):
+    host = host_label(host)
+    requests.inc(1, host, path)
+    request_seconds.inc(seconds, host, path)
+    total_seconds.observe(seconds, path)
+
+def record_failure(host: str):
+    request_failures.inc(1, host_label(host))
+
+def log_stats():
+    # logged after every request, so only this process is read (not the other workers, see metrics.collect)
+    def total(counter: Counter) -> int:
+        return round(counter.local_value)
 
+    logger.info(f"total_sent_proxy = {human_size(total(total_sent_proxy))}")
+    logger.info(f"total_received_proxy = {human_size(total(total_received_proxy))}")
+    logger.info(f"total_sent_snic = {human_size(total(total_sent_snic))}")
+    logger.info(f"total_received_snic = {human_size(total(total_received_snic))}")
+    logger.info(f"dns_cache = {total(dns_cache_hits)} hits, {total(dns_cache_misses)} misses, {total(dns_coalesced)} coalesced, {total(dns_associations)} UDP associations")
+    logger.info(f"tls_sessions = {total(tls_resumed)} resumed, {total(tls_full_handshakes)} full handshakes")
+    logger.info(f"snic_handshakes = {total(snic_resumed)} resumed ({total(snic_early_data)} with 0-RTT, {round(snic_early_saved.local_value * 1000)} ms to first byte saved), {total(snic_full_handshakes)} full")
@@ -0,0 +1,22 @@
+from proxy.fetch_adaptive import parse_alt_svc
+from proxy.verdicts import NO_H3
+
+def test_h3_on_same_host():
+    assert parse_alt_svc('h3=":443"; ma=86400') == (443, 86400)
+
+def test_default_max_age():
+    assert parse_alt_svc('h3=":8443"') == (8443, 24 * 60 * 60)
+
+def test_first_h3_alternative():
+    assert parse_alt_svc('h2=":443", h3-29=":443", h3=":4433"; ma=60, h3=":443"; ma=90') == (4433, 60)
+
+def test_other_host_skipped():
+    assert parse_alt_svc('h3="alt.example.com:443"; ma=60, h3=":8443"; ma=30') == (8443, 30)
+
+def test_no_h3():
+    assert parse_alt_svc('h2=":443"; ma=60') == (NO_H3, 0)
+    assert parse_alt_svc('clear') == (NO_H3, 0)
+
+def test_malformed():
+    assert parse_alt_svc('h3=":port"; ma=60') == (NO_H3, 0)
+    assert parse_alt_svc('h3=":443"; ma=soon') == (443, 24 * 60 * 60)
@@ -0,0 +1,72 @@
+import asyncio
+import socket
+
+import pytest
+
+from proxy import dns
+from proxy.bench import standins
+from proxy.config import conf
+
+RECORDS = {"dual.test": ["192.0.2.1", "192.0.2.2", "2001:db8::1"], "v4only.test": ["192.0.2.3"]}
+
+def test_encode_query():
+    query = dns.encode_query(0x1234, "www.example.com.", "AAAA")
+    assert query[:4] == b"\x12\x34\x01\x00"
+    assert query[12:] == b"\x03www\x07example\x03com\x00\x00\x1c\x00\x01"
+
+def test_encode_query_invalid_hostname():
+    with pytest.raises(socket.gaierror):
+        dns.encode_query(1, "a..b", "A")
+    with pytest.raises(socket.gaierror):
+        dns.encode_query(1, "x" * 64 + ".test", "A")
+
+@pytest.mark.parametrize("qtype, ips", [("A", ["192.0.2.1", "192.0.2.2"]), ("AAAA", ["2001:db8::1"])])
+def test_decode_answer(qtype, ips):
+    answer = dns.decode_answer(standins.dns_answer(dns.encode_query(7, "dual.test", qtype), RECORDS, ttl=300))
+    assert answer.id == 7 and answer.rcode == 0
+    assert dns.parse_answer("dual.test", answer, qtype) == [(ip, 300) for ip in ips]
+
+def test_decode_answer_without_records():
+    answer = dns.decode_answer(standins.dns_answer(dns.encode_query(8, "v4only.test", "AAAA"), RECORDS))
+    assert answer.rcode == 0 and dns.parse_answer("v4only.test", answer, "AAAA") == []
+
+def test_decode_answer_nxdomain():
+    answer = dns.decode_answer(standins.dns_answer(dns.encode_query(9, "missing.test", "A"), RECORDS))
+    assert answer.rcode == 3
+    with pytest.raises(socket.gaierror):
+        dns.parse_answer("missing.test", answer, "A")
+
+def test_decode_answer_truncated():
+    pkt = standins.dns_answer(dns.encode_query(10, "dual.test", "A"), RECORDS)
+    with pytest.raises(ValueError):
+        dns.decode_answer(pkt[:-3])
+
+def test_resolve_through_socks5(monkeypatch):
+    loop = standins.LoopThread()
+    socks5 = standins.Socks5Server()
+    loop.run(socks5.start())
+    server = standins.DNSServer(RECORDS)
+    loop.run(server.start())
+    try:
+        monkeypatch.setattr(conf, "dns_backend", "udp")
+        ips = asyncio.run(dns.resolve("dual.test", (server.host, server.port), (socks5.host, socks5.port)))
+        assert sorted(ips) == sorted(RECORDS["dual.test"])
+        assert socks5.associations == 1
+    finally:
+        # the association ends first, so that its handler in the stand-in is done before the loop stops
+        channel = dns.get_channel()
+        if channel.loop is not None:
+            channel.submit(close_channel(channel)).result()
+        loop.run(socks5.stop())
+        loop.run(server.stop())
+        loop.run(settle())
+        loop.stop()
+        loop.loop.close()
+
+async def close_channel(channel):
+    channel.reset()
+
+async def settle():
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    if tasks:
+        await asyncio.wait(tasks, timeout=5)
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from proxy.proxy import _read_body
+
+def read_body(data: bytes, chunked: bool = True, length: int = 0) -> bytes:
+    stream = io.BytesIO(data)
+    return b"".join(_read_body(chunked, length, stream.readline, stream.read, None))
+
+def test_content_length():
+    assert read_body(b"hello world", chunked=False, length=5) == b"hello"
+
+def test_chunked():
+    assert read_body(b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n") == b"hello world"
+
+def test_chunk_extension_and_trailer():
+    stream = io.BytesIO(b"5;name=value\r\nhello\r\n0\r\nExpires: never\r\n\r\nGET / HTTP/1.1\r\n")
+    assert b"".join(_read_body(True, 0, stream.readline, stream.read, None)) == b"hello"
+    assert stream.read() == b"GET / HTTP/1.1\r\n"     # the next request is left for the parser
+
+def test_large_chunk():
+    assert read_body(b"20000\r\n" + b"x" * 0x20000 + b"\r\n0\r\n\r\n") == b"x" * 0x20000
+
+def test_continue_sent_on_first_read():
+    sent = []
+    body = _read_body(False, 2, io.BytesIO(b"ok").readline, io.BytesIO(b"ok").read, lambda: sent.append(True))
+    assert not sent
+    assert next(body) == b"ok" and sent == [True]
+
+@pytest.mark.parametrize("data", [b"5\r\nhel", b"5\r\nhello\r\n", b"5"])
+def test_closed_mid_body(data):
+    with pytest.raises(ConnectionError):
+        read_body(data)
+
+def test_invalid_chunk_size():
+    with pytest.raises(ValueError):
+        read_body(b"zz\r\nhello\r\n0\r\n\r\n")
@@ -0,0 +1,71 @@
+# TLS resumption for connections through the proxy:
+#   - one client SSLContext shared by every connection, sessions only resume within the context that made them
+#   - the latest session (TLS 1.3 ticket) of each (hostname, port) is offered when connecting to it again,
+#     saving a round trip and the certificate chain through the tunnel
+#   - LRU of conf.proxy_tls_session_cache_size hosts, expired sessions are dropped
+
+import logging
+import ssl
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Optional
+
+from proxy import stat
+from proxy.config import conf
+
+logger = logging.getLogger(__name__)
+
+class TLSSessionCache:
+    def __init__(self):
+        self.context: Optional[ssl.SSLContext] = None
+        self.sessions: OrderedDict[tuple[str, int], ssl.SSLSession] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_context(self) -> ssl.SSLContext:
+        with self.lock:
+            if self.context is None:
+                self.context = ssl.create_default_context(cafile=conf.ca_file)
+                self.context.set_alpn_protocols(['h2', 'http/1.1'] if conf.proxy_http2 else ['http/1.1'])
+            return self.context
+
+    def get(self, key: tuple[str, int]) -> Optional[ssl.SSLSession]:
+        with self.lock:
+            if (session := self.sessions.get(key)) is None:
+                return None
+            if session.time + session.timeout < time():
+                del self.sessions[key]
+                return None
+            self.sessions.move_to_end(key)
+            return session
+
+    def put(self, key: tuple[str, int], sock: ssl.SSLSocket) -> bool:
+        """ keeps the session of sock for key, False if it cannot be resumed (yet) """
+        try:
+            session = sock.session
+            # TLS 1.3 sessions resume with a ticket, which arrives after the handshake
+            resumable = session is not None and (session.has_ticket or (sock.version() != 'TLSv1.3' and session.id))
+        except (OSError, ValueError):
+            return False
+        if not resumable:
+            return False
+        with self.lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > conf.proxy_tls_session_cache_size:
+                self.sessions.popitem(last=False)
+        return True
+
+    def wrap(self, sock, hostname: str, port: int) -> ssl.SSLSocket:
+        """ TLS handshake on sock, resuming the last session with (hostname, port) if there is one """
+        session = self.get((hostname, port))
+        tls_sock = self.get_context().wrap_socket(sock, server_hostname=hostname, session=session)
+        if tls_sock.session_reused:
+            stat.increase_tls_resumed(1)
+        else:
+            stat.increase_tls_full_handshakes(1)
+            if session is not None:
+                logger.log(logging.DEBUG, f"{hostname}: TLS session not resumed")
+        return tls_sock
+
+cache = TLSSessionCache()
@@ -0,0 +1,126 @@
+# per-request traces, one JSON line per request appended to conf.trace_file (no traces unless it is set):
+#   - when the request line arrived, and milliseconds spent in each phase: parsing the request, the cert lookup
+#     of the CONNECT it came through, DNS (and how the cache answered), the QUIC handshake and path migration
+#     of SNIC or the connection through the proxy, then the first and the last byte of the response
+#   - the path that served the request (snic or tunnel), why it was chosen, and the body bytes sent and received on it
+#   - conf.trace_sample_rate of the requests are traced, a background thread serializes and writes the lines
+#   - code deep in a fetch records into the trace of the request it works for through the current context variable
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from contextvars import ContextVar
+from time import time
+from typing import Generator, Optional
+
+from proxy.config import conf
+
+logger = logging.getLogger(__name__)
+
+class Trace:
+    def __init__(self, start: float):
+        self.start = start
+        self.phases: dict[str, float] = {}     # value: milliseconds
+        self.info: dict[str, object] = {}
+        self.bytes: dict[str, dict[str, int]] = {}     # key: path, value: {'sent': ..., 'received': ...}
+
+    def phase(self, name: str, seconds: float):
+        """ duration of a phase, the first one counts if it happens more than once (e.g. DNS, then its cached answer) """
+        self.phases.setdefault(name, round(seconds * 1000, 3))
+
+    def mark(self, name: str):
+        """ time since the request line arrived, for the first byte and the last byte """
+        self.phase(name, time() - self.start)
+
+    def note(self, **info):
+        for key, value in info.items():
+            self.info.setdefault(key, value)
+
+    def count(self, path: str, direction: str, size: int):
+        counts = self.bytes.setdefault(path, {'sent': 0, 'received': 0})
+        counts[direction] += size
+
+    def counted(self, direction: str, body_stream: Generator[bytes, None, None]) -> Generator[bytes, None, None]:
+        """ body_stream, counting its bytes on the path noted by the time they pass """
+        for data in body_stream:
+            self.count(str(self.info.get('path', 'unknown')), direction, len(data))
+            yield data
+
+    def finish(self, **info):
+        self.note(**info)
+        # copied, the losing side of a race may still record into the trace while the line is written
+        writer.write({
+            'start': round(self.start, 6),
+            'pid': os.getpid(),
+            **self.info,
+            'phases': dict(self.phases),
+            'bytes': {path: dict(counts) for path, counts in list(self.bytes.items())},
+        })
+
+current: ContextVar[Optional[Trace]] = ContextVar('trace', default=None)
+
+def start(started: float) -> Optional[Trace]:
+    """ a trace of the request whose request line arrived at started, None if it is not traced """
+    if conf.trace_file is None or random.random() >= conf.trace_sample_rate:
+        return None
+    return Trace(started)
+
+def phase(name: str, seconds: float):
+    if (trace := current.get()) is not None:
+        trace.phase(name, seconds)
+
+def note(**info):
+    if (trace := current.get()) is not None:
+        trace.note(**info)
+
+class TraceWriter:
+    """ appends traces to conf.trace_file from a background thread, so that requests never wait for the disk """
+    def __init__(self):
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def write(self, line: dict):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                    self.thread.start()
+        self.queue.put(line)
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            self._write(lines)
+
+    def _write(self, lines: list[dict]):
+        # whatever else arrived meanwhile goes in the same write
+        while True:
+            try:
+                lines.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not lines:
+            return
+        data = ''.join(json.dumps(line, separators=(',', ':')) + '\n' for line in lines).encode()
+        try:
+            with self.lock:
+                # one append per batch, so that the lines of several workers do not interleave
+                fd = os.open(conf.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+        except (OSError, TypeError) as e:
+            logger.log(logging.WARN, f"[trace] cannot write {conf.trace_file}: {e}")
+
+    def flush(self):
+        """ writes the traces still queued, at exit """
+        self._write([])
+
+writer = TraceWriter()
+atexit.register(writer.flush)
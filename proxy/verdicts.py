@@ -0,0 +1,95 @@
+# SNIC verdicts of fetch_adaptive, kept in SQLite (conf.fetch_adaptive_verdict_db):
+#   - one row per host: whether SNIC worked the last time it was checked, when, and how often it worked or failed
+#   - a verdict goes stale after conf.fetch_adaptive_verdict_ttl (conf.fetch_adaptive_verdict_failure_ttl if SNIC failed),
+#     stale verdicts are still used while fetch_adaptive checks the host again in the background
+#   - also the HTTP/3 port each host advertises with Alt-Svc (or that it advertises none), until the advertisement expires
+#   - WAL mode with a busy timeout, so several proxy processes can share one database
+
+import logging
+import os
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Optional
+
+from proxy.config import conf
+
+logger = logging.getLogger(__name__)
+
+FORGET_AFTER = 30 * 24 * 60 * 60    # rows not checked for this long are removed when the database is opened
+BUSY_TIMEOUT = 5                    # seconds a write waits for another process holding the database
+NO_H3 = 0                           # port recorded for hosts that advertise no HTTP/3
+
+class VerdictStore:
+    def __init__(self):
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        path = conf.fetch_adaptive_verdict_db
+        try:
+            if path is None:
+                raise sqlite3.OperationalError("no database configured")
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            db = self._connect(path)
+        except (OSError, sqlite3.Error) as e:
+            if path is not None:
+                logger.log(logging.WARN, f"[verdicts] cannot open {path}, verdicts are kept in memory only: {e}")
+            db = self._connect(":memory:")
+        return db
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")     # a verdict lost in a power cut is simply checked again
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "host TEXT PRIMARY KEY, works INTEGER NOT NULL, checked REAL NOT NULL, "
+            "successes INTEGER NOT NULL, failures INTEGER NOT NULL)"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS alt_svc (host TEXT PRIMARY KEY, port INTEGER NOT NULL, expires REAL NOT NULL)")
+        db.execute("DELETE FROM verdicts WHERE checked < ?", (time() - FORGET_AFTER,))
+        db.execute("DELETE FROM alt_svc WHERE expires < ?", (time(),))
+        return db
+
+    def _execute(self, sql: str, params: tuple) -> list[tuple]:
+        with self.lock:
+            if self.db is None:
+                self.db = self._open()
+            return self.db.execute(sql, params).fetchall()
+
+    def get(self, host: str) -> Optional[tuple[bool, bool]]:
+        """ (works, stale) of host, None if it was never checked """
+        rows = self._execute("SELECT works, checked FROM verdicts WHERE host = ?", (host,))
+        if not rows:
+            return None
+        works, checked = bool(rows[0][0]), rows[0][1]
+        ttl = conf.fetch_adaptive_verdict_ttl if works else conf.fetch_adaptive_verdict_failure_ttl
+        return works, checked + ttl < time()
+
+    def record(self, host: str, works: bool):
+        """ stores the result of a check, the latest one decides the verdict """
+        self._execute(
+            "INSERT INTO verdicts (host, works, checked, successes, failures) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (host) DO UPDATE SET works = excluded.works, checked = excluded.checked, "
+            "successes = successes + excluded.successes, failures = failures + excluded.failures",
+            (host, int(works), time(), int(works), int(not works)),
+        )
+
+    def h3_port(self, host: str) -> Optional[int]:
+        """ port host advertises HTTP/3 on, NO_H3 if it advertises none, None if not known (anymore) """
+        rows = self._execute("SELECT port, expires FROM alt_svc WHERE host = ?", (host,))
+        if not rows or rows[0][1] < time():
+            return None
+        return rows[0][0]
+
+    def record_alt_svc(self, host: str, port: int, max_age: float):
+        """ remembers the HTTP/3 port (or NO_H3) of host for max_age seconds """
+        now = time()
+        rows = self._execute("SELECT port, expires FROM alt_svc WHERE host = ?", (host,))
+        if rows and rows[0][0] == port and rows[0][1] - now > max_age / 2:
+            return      # nothing new, spare the write
+        self._execute("INSERT OR REPLACE INTO alt_svc (host, port, expires) VALUES (?, ?, ?)", (host, port, now + max_age))
+
+store = VerdictStore()